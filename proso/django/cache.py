@@ -17,6 +17,8 @@ CACHE_MISS = 'proso-apps-cache-miss'
 
 _request_cache = {}
 _request_permanent_cache = {}
+# threads currently processing a request
+_active_requests = set()
 _installed_middleware = False
 
 
@@ -73,17 +75,29 @@ class cache_pure:
 
 
 def get_from_request_permenent_cache(key):
-    return _request_permanent_cache[currentThread()].get(key)
+    return _request_permanent_cache.get(currentThread(), {}).get(key)
 
 
 def set_to_request_permanent_cache(key, value):
-    _request_permanent_cache[currentThread()][key] = value
+    # outside a request, nothing would drop the value
+    if not is_request_active():
+        return
+    _request_permanent_cache.setdefault(currentThread(), {})[key] = value
 
 
 def is_cache_prepared():
     return _installed_middleware
 
 
+def is_request_active():
+    """
+    True if the current thread processes a request, i.e., the request caches
+    are dropped when the request ends (unlike, e.g., in management commands
+    or background threads).
+    """
+    return _installed_middleware and currentThread() in _active_requests
+
+
 def get_request_cache():
     assert _installed_middleware, 'RequestCacheMiddleware not loaded'
     return _request_cache[currentThread()]
@@ -107,4 +121,11 @@ class RequestCacheMiddleware(object):
                 cache = _request_cache.get(currentThread()) or RequestCache()
                 _request_cache[currentThread()] = cache
                 _request_permanent_cache[currentThread()] = {}
+                _active_requests.add(currentThread())
                 cache.clear()
+
+        def process_response(self, request, response):
+            # objects in the permanent cache must not outlive the request
+            _request_permanent_cache[currentThread()] = {}
+            _active_requests.discard(currentThread())
+            return response
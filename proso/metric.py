@@ -1,3 +1,4 @@
+import math
 import numpy
 
 
@@ -30,3 +31,40 @@ def confidence_value_to_json(confidence_value):
 
 def format_number(x):
     return float('{0:.2f}'.format(x))
+
+
+def rmse(predictions, real):
+    return math.sqrt(numpy.mean((predictions - real) ** 2))
+
+
+def log_loss(predictions, real, eps=1e-15):
+    predictions = numpy.clip(predictions, eps, 1 - eps)
+    return -numpy.mean(real * numpy.log(predictions) + (1 - real) * numpy.log(1 - predictions))
+
+
+def brier(predictions, real, bins=20):
+    counts = numpy.zeros(bins)
+    correct = numpy.zeros(bins)
+    prediction = numpy.zeros(bins)
+    for p, r in zip(predictions, real):
+        bin = min(int(p * bins), bins - 1)
+        counts[bin] += 1
+        correct[bin] += r
+        prediction[bin] += p
+    prediction_means = prediction / counts
+    prediction_means[numpy.isnan(prediction_means)] = ((numpy.arange(bins) + 0.5) / bins)[numpy.isnan(prediction_means)]
+    correct_means = correct / counts
+    correct_means[numpy.isnan(correct_means)] = 0
+    size = len(predictions)
+    answer_mean = sum(correct) / size
+    return {
+        "reliability": sum(counts * (correct_means - prediction_means) ** 2) / size,
+        "resolution": sum(counts * (correct_means - answer_mean) ** 2) / size,
+        "uncertainty": answer_mean * (1 - answer_mean),
+        "detail": {
+            "bin_count": bins,
+            "bin_counts": list(counts),
+            "bin_prediction_means": list(prediction_means),
+            "bin_correct_means": list(correct_means),
+        }
+    }
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmarks of the models working on the synthetic data. Each
+benchmark is repeated and the best time is reported, so the results of
+different commits can be compared (see compare).
+"""
+from proso.models.environment import InMemoryEnvironment
+from proso.models.evaluation import replay
+from proso.models.item_selection import ScoreItemSelection
+from proso.models.option_selection import CompetitiveOptionSelection, ConstantOptionsNumber
+from proso.models.prediction import PFAEStaircase
+import datetime
+import numpy
+import time
+
+
+BENCHMARKS = [
+    'environment_write',
+    'environment_read',
+    'environment_read_more_items',
+    'replay',
+    'predict_phase_more_items',
+    'item_selection',
+    'option_selection',
+]
+
+
+def run(data, number_of_answers, predictive_model_factory=PFAEStaircase, environment_factory=InMemoryEnvironment, repeat=3, samples=100, chunk_size=1000, benchmarks=None):
+    """
+    Args:
+        data (proso.models.synthetic.SyntheticData): generator of the data
+        number_of_answers (int): number of answers replayed before the
+            benchmarks of prediction and selection
+        predictive_model_factory (callable): returns a new predictive model
+        environment_factory (callable): returns a new empty environment
+        repeat (int): number of repetitions of each benchmark
+        samples (int): number of operations measured by the benchmarks of
+            environment, prediction and selection
+        chunk_size (int): number of answers passed to
+            predict_and_update_many at once
+        benchmarks (list): names of benchmarks to run, all by default
+
+    Returns:
+        dict: name of benchmark -> number of operations, the best time in
+        seconds and the number of operations per second
+    """
+    if benchmarks is None:
+        benchmarks = BENCHMARKS
+    random = numpy.random.RandomState(data.seed)
+    users = random.choice(data.users, samples).tolist()
+    items = random.choice(data.items, samples).tolist()
+    results = {}
+
+    def _measure(name, operations, setup, fun):
+        if name not in benchmarks:
+            return
+        durations = []
+        for i in range(repeat):
+            prepared = setup()
+            start = time.perf_counter()
+            fun(prepared)
+            durations.append(time.perf_counter() - start)
+        results[name] = _result(operations, min(durations))
+
+    def _written():
+        environment = environment_factory()
+        for user, item in zip(users, items):
+            environment.write('benchmark', 1, user=user, item=item)
+        return environment
+
+    _measure(
+        'environment_write', samples, environment_factory,
+        lambda environment: [environment.write('benchmark', 1, user=user, item=item) for user, item in zip(users, items)])
+    _measure(
+        'environment_read', samples, _written,
+        lambda environment: [environment.read('benchmark', user=user, item=item) for user, item in zip(users, items)])
+    _measure(
+        'environment_read_more_items', samples, _written,
+        lambda environment: [environment.read_more_items('benchmark', data.items.tolist(), user=user) for user in users])
+
+    def _replay(predictive_model, environment):
+        # the answers are generated and replayed chunk by chunk, so they are
+        # never held in memory at once; only the replay itself is measured
+        duration = 0
+        relations = data.relations()
+        last_time = None
+        for answers in data.answers(number_of_answers):
+            start = time.perf_counter()
+            replay(predictive_model, answers, relations, chunk_size=chunk_size, environment=environment)
+            duration += time.perf_counter() - start
+            relations = None
+            last_time = answers['time'][-1]
+        return duration, last_time
+
+    if 'replay' in benchmarks:
+        durations = [_replay(predictive_model_factory(), environment_factory())[0] for i in range(repeat)]
+        results['replay'] = _result(number_of_answers, min(durations))
+    if not set(benchmarks) & {'predict_phase_more_items', 'item_selection', 'option_selection'}:
+        return results
+
+    # the remaining benchmarks work with the environment after the replay
+    predictive_model = predictive_model_factory()
+    environment = environment_factory()
+    last_time = _replay(predictive_model, environment)[1]
+    now = (last_time + numpy.timedelta64(1, 'h')).item() if last_time is not None else datetime.datetime.now()
+    all_items = data.items.tolist()
+    prepared_data = [predictive_model.prepare_phase_more_items(environment, user, all_items, now) for user in users]
+    _measure(
+        'predict_phase_more_items', samples * len(all_items), lambda: None,
+        lambda _: [predictive_model.predict_phase_more_items(d, user, all_items, now) for d, user in zip(prepared_data, users)])
+    _measure(
+        'item_selection', samples, lambda: None,
+        lambda _: [ScoreItemSelection(predictive_model).select(environment, user, all_items, now, None, 10) for user in users])
+
+    def _option_selectors():
+        selectors = []
+        for user in users:
+            item_selector = ScoreItemSelection(predictive_model)
+            item_selector.get_predictions(environment, user, all_items, now)
+            selectors.append(CompetitiveOptionSelection(item_selector, ConstantOptionsNumber(data.max_options - 1, max_options=data.max_options)))
+        return selectors
+
+    _measure(
+        'option_selection', samples, _option_selectors,
+        lambda selectors: [
+            selector.select_options(environment, user, item, now, data.siblings(item))
+            for selector, user, item in zip(selectors, users, items)
+        ])
+    return results
+
+
+def compare(previous, current):
+    """
+    Compare two results of the benchmarks.
+
+    Returns:
+        dict: name of benchmark -> ratio of the current and previous number
+        of operations per second (greater is better)
+    """
+    return {
+        name: current[name]['per_second'] / previous[name]['per_second']
+        for name in sorted(set(previous) & set(current))
+        if previous[name]['per_second'] and current[name]['per_second']
+    }
+
+
+def _result(operations, seconds):
+    return {
+        'operations': operations,
+        'seconds': seconds,
+        'per_second': operations / seconds if seconds > 0 else None,
+    }
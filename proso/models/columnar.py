@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar export of environments to NumPy structured arrays and encoding of
+the arrays to the binary format of PostgreSQL COPY. The encoder works on
+whole columns, so its speed does not depend on per-row string formatting.
+"""
+from itertools import islice
+from proso.models.snapshot import NONE_ID
+import datetime
+import numpy
+import struct
+
+
+COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+COPY_BINARY_TRAILER = struct.pack('>h', -1)
+
+_POSTGRES_EPOCH = numpy.datetime64('2000-01-01T00:00:00', 'us')
+_UNIX_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+_NAT = numpy.iinfo('int64').min
+
+_COPY_TYPES = {
+    'int4': '>i4',
+    'int8': '>i8',
+    'float8': '>f8',
+    'bool': '?',
+    'timestamp': '>i8',
+}
+
+
+def to_structured_array(rows, columns):
+    """
+    Convert the given rows to the NumPy structured array.
+
+    Args:
+        rows (iterable): tuples with values of the columns
+        columns (list): (name, dtype) pairs, the 'key' column is stored as
+            bytes of the minimal width, None in int64 columns as -1
+
+    Returns:
+        numpy.ndarray
+    """
+    rows = list(rows)
+    data = {}
+    encoded_keys = {}
+    for i, (name, dtype) in enumerate(columns):
+        if name == 'key':
+            column = [encoded_keys.get(row[i]) or encoded_keys.setdefault(row[i], row[i].encode()) for row in rows]
+            dtype = 'S{}'.format(max([len(k) for k in encoded_keys.values()] + [1]))
+        elif dtype == 'int64':
+            column = [NONE_ID if row[i] is None else row[i] for row in rows]
+        elif dtype == 'datetime64[us]':
+            # much faster than the conversion of datetime objects by NumPy
+            column = [_NAT if row[i] is None else (row[i] - _UNIX_EPOCH) // _MICROSECOND for row in rows]
+            data[name] = numpy.array(column, dtype='int64').view(dtype)
+            continue
+        else:
+            column = [row[i] for row in rows]
+        data[name] = numpy.array(column, dtype=dtype)
+    result = numpy.empty(len(rows), dtype=[(name, data[name].dtype) for name, _ in columns])
+    for name, _ in columns:
+        result[name] = data[name]
+    return result
+
+
+def iterate_structured_arrays(rows, columns, chunk_size=None):
+    """
+    Convert the given rows to a sequence of structured arrays (see
+    to_structured_array) with at most chunk_size rows. All rows are
+    converted to one array if the chunk size is not specified.
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if len(chunk) > 0 or chunk_size is None:
+            yield to_structured_array(chunk, columns)
+        if chunk_size is None or len(chunk) < chunk_size:
+            return
+
+
+def encode_copy_binary(columns):
+    """
+    Encode rows given by columns to the binary format of PostgreSQL COPY
+    (without header and trailer, see COPY_BINARY_HEADER and
+    COPY_BINARY_TRAILER). Rows are grouped by their layout (lengths of text
+    values and positions of NULLs), each group is encoded by one structured
+    array, so the order of rows is not preserved.
+
+    Args:
+        columns (list): (PostgreSQL type, values) pairs, the type is one of
+            'int4', 'int8', 'float8', 'bool', 'timestamp' and 'text'; the
+            values are a NumPy array or a scalar used for all rows; -1 in
+            integer columns and None scalars are encoded as NULL
+
+    Returns:
+        bytes
+    """
+    size = max([len(values) for _, values in columns if isinstance(values, numpy.ndarray)] + [0])
+    if size == 0:
+        return b''
+    prepared = []
+    layout = []
+    for pg_type, values in columns:
+        if not isinstance(values, numpy.ndarray):
+            prepared.append((pg_type, values, None))
+            continue
+        if pg_type == 'text':
+            lengths = numpy.char.str_len(values).astype('int32')
+            prepared.append((pg_type, values, len(layout)))
+            layout.append(lengths)
+        elif pg_type in ('int4', 'int8'):
+            prepared.append((pg_type, values, len(layout)))
+            layout.append(numpy.where(values == NONE_ID, -1, 0).astype('int32'))
+        else:
+            if pg_type == 'timestamp':
+                values = (values.astype('datetime64[us]') - _POSTGRES_EPOCH).astype('int64')
+            prepared.append((pg_type, values, None))
+    # rows with the same layout get the same code (mixed radix number)
+    codes = numpy.zeros(size, dtype='int64')
+    for layout_column in layout:
+        codes = codes * (int(layout_column.max()) + 2) + (layout_column + 1)
+    order = numpy.argsort(codes, kind='stable')
+    boundaries = numpy.nonzero(numpy.diff(codes[order]))[0] + 1
+    encoded = []
+    for selected in numpy.split(order, boundaries):
+        group_layout = [layout_column[selected[0]] for layout_column in layout]
+        dtype = [('count', '>i2')]
+        fields = []
+        for i, (pg_type, values, layout_index) in enumerate(prepared):
+            if not isinstance(values, numpy.ndarray):
+                if values is None:
+                    dtype.append(('length_{}'.format(i), '>i4'))
+                    fields.append((i, -1, None))
+                    continue
+                value_dtype = 'S{}'.format(len(values.encode())) if pg_type == 'text' else _COPY_TYPES[pg_type]
+                if pg_type == 'timestamp':
+                    values = (numpy.datetime64(values, 'us') - _POSTGRES_EPOCH).astype('int64')
+                elif pg_type == 'text':
+                    values = values.encode()
+            elif layout_index is not None and group_layout[layout_index] == -1:
+                dtype.append(('length_{}'.format(i), '>i4'))
+                fields.append((i, -1, None))
+                continue
+            elif pg_type == 'text':
+                value_dtype = 'S{}'.format(group_layout[layout_index])
+                values = values[selected]
+            else:
+                value_dtype = _COPY_TYPES[pg_type]
+                values = values[selected]
+            length = numpy.dtype(value_dtype).itemsize if value_dtype != 'S0' else 0
+            dtype.append(('length_{}'.format(i), '>i4'))
+            if length > 0:
+                dtype.append(('value_{}'.format(i), value_dtype))
+            fields.append((i, length, values if length > 0 else None))
+        rows = numpy.empty(len(selected), dtype=dtype)
+        rows['count'] = len(prepared)
+        for i, length, values in fields:
+            rows['length_{}'.format(i)] = length
+            if values is not None:
+                rows['value_{}'.format(i)] = values
+        encoded.append(rows.tobytes())
+    return b''.join(encoded)
+
+
+def write_copy_binary(output, chunks):
+    """
+    Write the complete binary COPY stream to the given file.
+
+    Args:
+        output (file): file opened in the binary mode
+        chunks (iterable): lists of columns accepted by encode_copy_binary
+    """
+    output.write(COPY_BINARY_HEADER)
+    for columns in chunks:
+        output.write(encode_copy_binary(columns))
+    output.write(COPY_BINARY_TRAILER)
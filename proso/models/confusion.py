@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Sparse confusion matrix of items stored in the CSR format. The row is the
+asked item, the column is the answered item and the value is the number of
+such wrong answers. The build_confusion_matrix command stores each pair in
+both directions (marked by 'symmetric' in the meta), because confusing
+factors do not depend on the order of items. The matrix file has the same layout as environment
+snapshots (magic string, JSON header and aligned columns), so it can be
+memory-mapped and shared by all processes without any parsing.
+"""
+import json
+import mmap
+import numpy
+import os
+import struct
+
+
+MAGIC = b'PROSOCFM'
+VERSION = 1
+
+
+class ConfusionMatrix:
+
+    def __init__(self, items, indptr, indices, data, meta=None):
+        """
+        Args:
+            items (numpy.ndarray): sorted identifiers of items (rows and
+                columns are positions in this array)
+            indptr (numpy.ndarray): CSR row pointers
+            indices (numpy.ndarray): CSR column positions, sorted in each row
+            data (numpy.ndarray): CSR values
+            meta (dict): JSON serializable information, e.g., the last
+                answer included in the matrix
+        """
+        self.items = items
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.meta = {} if meta is None else meta
+
+    @staticmethod
+    def from_counts(asked, answered, counts, meta=None):
+        """
+        Build the matrix from the (asked, answered, count) triples given as
+        three arrays, the counts of the same pair are summed.
+        """
+        asked = numpy.asarray(asked, dtype='int64')
+        answered = numpy.asarray(answered, dtype='int64')
+        counts = numpy.asarray(counts, dtype='int64')
+        items = numpy.unique(numpy.concatenate([asked, answered]))
+        rows = numpy.searchsorted(items, asked)
+        columns = numpy.searchsorted(items, answered)
+        order = numpy.lexsort((columns, rows))
+        rows, columns, counts = rows[order], columns[order], counts[order]
+        # sum duplicate cells
+        if len(rows) > 0:
+            starts = numpy.concatenate([[True], (numpy.diff(rows) != 0) | (numpy.diff(columns) != 0)])
+            counts = numpy.add.reduceat(counts, numpy.nonzero(starts)[0])
+            rows, columns = rows[starts], columns[starts]
+        indptr = numpy.zeros(len(items) + 1, dtype='int64')
+        numpy.cumsum(numpy.bincount(rows, minlength=len(items)), out=indptr[1:])
+        return ConfusionMatrix(items, indptr, columns.astype('int32'), counts, meta=meta)
+
+    def to_counts(self):
+        """
+        Returns:
+            (numpy.ndarray, numpy.ndarray, numpy.ndarray): asked items,
+            answered items and counts
+        """
+        rows = numpy.repeat(numpy.arange(len(self.items)), numpy.diff(self.indptr))
+        return self.items[rows], self.items[self.indices], numpy.asarray(self.data)
+
+    def merge(self, asked, answered, counts, meta=None):
+        """
+        Returns:
+            ConfusionMatrix: a new matrix with the given counts added
+        """
+        old_asked, old_answered, old_counts = self.to_counts()
+        return ConfusionMatrix.from_counts(
+            numpy.concatenate([old_asked, numpy.asarray(asked, dtype='int64')]),
+            numpy.concatenate([old_answered, numpy.asarray(answered, dtype='int64')]),
+            numpy.concatenate([old_counts, numpy.asarray(counts, dtype='int64')]),
+            meta=self.meta if meta is None else meta)
+
+    def get_more_items(self, item, items):
+        """
+        Returns:
+            list: number of answers to the given items when the given item
+            was asked
+        """
+        result = [0] * len(items)
+        row = numpy.searchsorted(self.items, item)
+        if row == len(self.items) or self.items[row] != item:
+            return result
+        start, stop = self.indptr[row], self.indptr[row + 1]
+        if start == stop:
+            return result
+        row_items = self.items[self.indices[start:stop]]
+        positions = numpy.searchsorted(row_items, items)
+        row_data = self.data[start:stop]
+        for i, position in enumerate(positions.tolist()):
+            if position < len(row_items) and row_items[position] == items[i]:
+                result[i] = row_data[position].item()
+        return result
+
+    def save(self, path):
+        """
+        Save the matrix atomically, processes which have already loaded the
+        previous version keep using it.
+        """
+        columns = [
+            ('items', numpy.asarray(self.items, dtype='int64')),
+            ('indptr', numpy.asarray(self.indptr, dtype='int64')),
+            ('indices', numpy.asarray(self.indices, dtype='int32')),
+            ('data', numpy.asarray(self.data, dtype='int64')),
+        ]
+        header = {'version': VERSION, 'meta': self.meta, 'columns': []}
+        offset = 0
+        for name, array in columns:
+            header['columns'].append([name, array.dtype.str, len(array), offset])
+            offset += _aligned(array.nbytes)
+        header_bytes = json.dumps(header).encode()
+        data_start = _aligned(len(MAGIC) + 8 + len(header_bytes))
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as matrix_file:
+            matrix_file.write(MAGIC)
+            matrix_file.write(struct.pack('<Q', len(header_bytes)))
+            matrix_file.write(header_bytes)
+            matrix_file.write(b'\0' * (data_start - len(MAGIC) - 8 - len(header_bytes)))
+            for name, array in columns:
+                matrix_file.write(array.tobytes())
+                matrix_file.write(b'\0' * (_aligned(array.nbytes) - array.nbytes))
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        """
+        Memory-map the matrix saved by the save method.
+        """
+        with open(path, 'rb') as matrix_file:
+            mapped = mmap.mmap(matrix_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapped[:len(MAGIC)] != MAGIC:
+            raise Exception('The file {} is not a confusion matrix.'.format(path))
+        header_length = struct.unpack('<Q', mapped[len(MAGIC):len(MAGIC) + 8])[0]
+        header = json.loads(mapped[len(MAGIC) + 8:len(MAGIC) + 8 + header_length].decode())
+        if header['version'] != VERSION:
+            raise Exception('Unsupported version {} of the confusion matrix.'.format(header['version']))
+        data_start = _aligned(len(MAGIC) + 8 + header_length)
+        columns = {
+            name: numpy.frombuffer(mapped, dtype=dtype, count=size, offset=data_start + offset)
+            for name, dtype, size, offset in header['columns']
+        }
+        return ConfusionMatrix(columns['items'], columns['indptr'], columns['indices'], columns['data'], meta=header['meta'])
+
+
+def _aligned(size):
+    return (size + 7) // 8 * 8
@@ -1,8 +1,30 @@
 # -*- coding: utf-8 -*-
 import abc
+import atexit
 import unittest
 import datetime
-from collections import defaultdict
+import logging
+import os
+import pickle
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+from array import array
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from itertools import chain, islice
+from proso.models.columnar import iterate_structured_arrays
+from proso.models.snapshot import save_snapshot, load_snapshot, iterate_snapshot_table, NONE_ID, VALUE_COLUMNS, AUDIT_COLUMNS
+from proso.models.structure import ItemStructure
+import numpy
+
+
+LOGGER = logging.getLogger('django.request')
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
 
 
 ################################################################################
@@ -80,6 +102,30 @@ class Environment(metaclass=abc.ABCMeta):
             key, update_fun(value), user=user,
             item=item, item_secondary=item_secondary, time=time, audit=audit, symmetric=symmetric, answer=answer)
 
+    def write_many(self, writes):
+        """
+        Write more variables at once. The writes are applied in the given
+        order.
+
+        Args:
+            writes (list): dictionaries with keyword arguments of the write
+                method, e.g., {'key': 'difficulty', 'value': 0.5, 'item': 1}
+        """
+        for write in writes:
+            self.write(**write)
+
+    def update_many(self, updates):
+        """
+        Update more variables at once. The updates are applied in the given
+        order, so the same variable can be updated more times.
+
+        Args:
+            updates (list): dictionaries with keyword arguments of the update
+                method
+        """
+        for update in updates:
+            self.update(**update)
+
     @abc.abstractmethod
     def time(self, key, user=None, item=None, item_secondary=None, symmetric=True):
         pass
@@ -118,11 +164,25 @@ class EnvironmentWriteHook(metaclass=abc.ABCMeta):
     def event(self, key, value, user, item, item_secondary, time, previous_value, answer):
         pass
 
+    def events(self, batch):
+        """
+        Process events of more writes at once, e.g., the whole batch passed
+        to Environment.write_many. Override this method when the hook can
+        handle the batch more efficiently than event by event.
+
+        Args:
+            batch (list): (key, value, user, item, item_secondary, time,
+                previous_value, answer) tuples in the order of writes
+        """
+        for event in batch:
+            self.event(*event)
+
 
 class CommonEnvironment(Environment):
 
     def __init__(self):
         self._write_hooks = []
+        self._write_hooks_batch = None
 
     @abc.abstractmethod
     def number_of_answers(self, user=None, item=None, context=None):
@@ -168,18 +228,111 @@ class CommonEnvironment(Environment):
     def rolling_success(self, user, window_size=10):
         pass
 
+    def update_rolling_success(self, user, correct, answer=None, context=None):
+        """
+        Notify the environment about a new answer of the given user, so it
+        can keep the rolling success up to date without reading the history.
+        """
+        pass
+
+    def item_structure(self):
+        """
+        Returns:
+            proso.models.structure.ItemStructure: parents and children of
+            items given by the 'parent' variables
+        """
+        return ItemStructure.from_environment(self)
+
     def add_write_hook(self, write_hook):
         self._write_hooks.append(write_hook)
 
+    def write_many(self, writes):
+        with self.batched_write_hooks():
+            Environment.write_many(self, writes)
+
+    def update_many(self, updates):
+        with self.batched_write_hooks():
+            Environment.update_many(self, updates)
+
     def call_write_hooks(self, key, value, user, item, item_secondary, time, previous_value, answer):
+        if self._write_hooks_batch is not None:
+            self._write_hooks_batch.append((key, value, user, item, item_secondary, time, previous_value, answer))
+            return
         for hook in self._write_hooks:
             hook.event(key, value, user, item, item_secondary, time, previous_value, answer)
 
+    @contextmanager
+    def batched_write_hooks(self):
+        """
+        Collect events of all writes inside the block and pass them to the
+        write hooks at once when the block ends.
+        """
+        if self._write_hooks_batch is not None or not self._write_hooks:
+            yield
+            return
+        self._write_hooks_batch = []
+        try:
+            yield
+        finally:
+            batch, self._write_hooks_batch = self._write_hooks_batch, None
+            if batch:
+                for hook in self._write_hooks:
+                    hook.events(batch)
+
+    @contextmanager
+    def buffered_writes(self):
+        """
+        Allow the environment to postpone writes made inside the block until
+        the block ends, e.g., to save them to the database at once. The
+        written values have to be visible to reads inside the block.
+        """
+        yield
+
 
 ################################################################################
 # Implementation
 ################################################################################
 
+class CorrectnessRing:
+    """
+    Correctness of the last SIZE answers of one user stored as a bitmask (the
+    newest answer is the lowest bit) together with the number of answers
+    pushed so far, so the rolling success is computed without reading the
+    history.
+    """
+
+    SIZE = 64
+
+    __slots__ = ('mask', 'count')
+
+    def __init__(self, mask=0, count=0):
+        self.mask = mask
+        self.count = count
+
+    @staticmethod
+    def from_history(correctness):
+        """
+        Args:
+            correctness (list): correctness of answers from the newest one
+        """
+        ring = CorrectnessRing()
+        for correct in reversed(correctness[:CorrectnessRing.SIZE]):
+            ring.push(correct)
+        ring.count = len(correctness)
+        return ring
+
+    def push(self, correct):
+        self.mask = ((self.mask << 1) | (1 if correct else 0)) & ((1 << self.SIZE) - 1)
+        self.count += 1
+
+    def success(self, window_size):
+        if window_size > self.SIZE:
+            raise Exception('The window size can be at most {}.'.format(self.SIZE))
+        if self.count < window_size:
+            return None
+        return bin(self.mask & ((1 << window_size) - 1)).count('1') / float(window_size)
+
+
 class InMemoryEnvironment(CommonEnvironment):
 
     NUMBER_OF_ANSWERS = 'number_of_answers'
@@ -188,11 +341,47 @@ class InMemoryEnvironment(CommonEnvironment):
     LAST_CORRECTNESS = 'last_correctness'
     CONFUSING_FACTOR = 'confusing_factor'
 
-    def __init__(self, audit_enabled=True):
+    AUDIT_RETENTION_ALL = 'all'
+    AUDIT_RETENTION_NONE = 'none'
+    AUDIT_RETENTION_SPILL = 'spill'
+    AUDIT_SPILL_SEGMENT_SIZE = 1000000
+
+    def __init__(self, audit_enabled=True, audit_retention=None, audit_spill_dir=None, audit_spill_window=10):
+        """
+        Args:
+            audit_enabled (bool):
+                if False, only the current values of variables are kept
+            audit_retention (dict):
+                key -> retention policy of the audit, the policy is one of:
+                'all' (default, keep the whole history in memory), 'none'
+                (keep only the current value and do not export audit for the
+                key), a positive number N (keep the last N values) or 'spill'
+                (keep the last 'audit_spill_window' values in memory and
+                stream the older ones to segment files in 'audit_spill_dir')
+            audit_spill_dir (str):
+                directory where the environment creates its own directory for
+                spilled audit segments, temporary directory is used by default
+            audit_spill_window (int):
+                number of values kept in memory for keys with the 'spill'
+                retention policy
+        """
         CommonEnvironment.__init__(self)
         # key -> user -> item_primary -> item_secondary -> [(permanent, time, value)]
         self._data = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(list))))
         self._audit_enabled = audit_enabled
+        self._audit_retention = {} if audit_retention is None else audit_retention
+        self._audit_windows = {}
+        self._audit_spill_dir = audit_spill_dir
+        self._audit_spill_window = audit_spill_window
+        # created with the first segment, see _open_audit_spill_segment
+        self._audit_spill_segments_dir = None
+        self._audit_spill_segments = []
+        self._audit_spill_file = None
+        self._audit_spill_rows = 0
+        # user -> CorrectnessRing
+        self._correctness_rings = {}
+        # compiled 'parent' variables, dropped when they change
+        self._item_structure = None
 
     def process_answer(self, user, item, asked, answered, time, answer, response_time, guess, **kwargs):
         if time is None:
@@ -210,6 +399,7 @@ class InMemoryEnvironment(CommonEnvironment):
         if asked == answered:
             update_all(self.NUMBER_OF_CORRECT_ANSWERS, 0, increment)
         self.write(self.LAST_CORRECTNESS, asked == answered, user=user, answer=answer)
+        self.update_rolling_success(user, asked == answered, answer=answer)
         if guess == 0 and asked != answered and answered is not None:
             self.update(self.CONFUSING_FACTOR, 0, increment, item=asked, item_secondary=answered, answer=answer)
             self.update(self.CONFUSING_FACTOR, 0, increment, item=asked, item_secondary=answered, user=user, answer=answer)
@@ -230,7 +420,7 @@ class InMemoryEnvironment(CommonEnvironment):
         return found
 
     def get_items_with_values(self, key, item, user=None):
-        return [(i_l[0], i_l[1][-1][3]) for i_l in list(self._data[key][user][item].items())]
+        return [(i_l[0], i_l[1][-1][3]) for i_l in list(self._data[key][user][item].items()) if i_l[1]]
 
     def get_items_with_values_more_items(self, key, items, user=None):
         return {i: self.get_items_with_values(key, i, user) for i in items}
@@ -251,12 +441,18 @@ class InMemoryEnvironment(CommonEnvironment):
             for key in keys
         }
 
+    def item_structure(self):
+        if self._item_structure is None:
+            self._item_structure = CommonEnvironment.item_structure(self)
+        return self._item_structure
+
     def read_all_with_key(self, key):
         found = []
         for user, d in self._data[key].items():
             for item, dd in d.items():
                 for item_secondary, f in dd.items():
-                    found.append((user, item, item_secondary, f[-1][3]))
+                    if f:
+                        found.append((user, item, item_secondary, f[-1][3]))
         return found
 
     def write(self, key, value, user=None, item=None, item_secondary=None, time=None, audit=True, symmetric=True, permanent=False, answer=None):
@@ -276,8 +472,14 @@ class InMemoryEnvironment(CommonEnvironment):
         previous_value = found[-1][3] if len(found) > 0 else None
         if (audit and self._audit_enabled) or not found:
             found.append((permanent, time, answer, value))
+            window = self._audit_window(key)
+            if window is not None and len(found) > window:
+                self._spill_audit(key, user, items[1], items[0], [x[1:] for x in found[:-window] if not x[0]])
+                del found[:-window]
         else:
             found[-1] = (permanent, time, answer, value)
+        if key == 'parent':
+            self._item_structure = None
         self.call_write_hooks(key, value, user, item, item_secondary, time, previous_value, answer)
 
     def delete(self, key, user=None, item=None, item_secondary=None, symmetric=True):
@@ -287,6 +489,8 @@ class InMemoryEnvironment(CommonEnvironment):
         found = self._data[key][user][items[1]][items[0]]
         if len(found) and not found[-1][0]:
             raise Exception("Can't delete variable %s which is not permanent." % key)
+        if key == 'parent':
+            self._item_structure = None
         del self._data[key][user][items[1]][items[0]]
         if len(self._data[key][user][items[1]]) == 0:
             del self._data[key][user][items[1]]
@@ -340,6 +544,8 @@ class InMemoryEnvironment(CommonEnvironment):
     def rolling_success(self, user, window_size=10, context=None):
         if context is not None:
             raise Exception('Using context is not supported.')
+        if window_size <= CorrectnessRing.SIZE and (user in self._correctness_rings or self._audit_enabled):
+            return self._correctness_ring(user).success(window_size)
         if not self._audit_enabled:
             raise Exception('Rolling success can not be retrieved, because audit is not enabled.')
         audit = self.audit(self.LAST_CORRECTNESS, user=user, limit=window_size)
@@ -349,6 +555,22 @@ class InMemoryEnvironment(CommonEnvironment):
         else:
             return sum(audit) / float(len(audit))
 
+    def update_rolling_success(self, user, correct, answer=None, context=None):
+        if user not in self._correctness_rings and not self._audit_enabled:
+            self._correctness_rings[user] = CorrectnessRing()
+        # the ring is already up to date when it is loaded from the audit
+        if user in self._correctness_rings:
+            self._correctness_rings[user].push(correct)
+
+    def _correctness_ring(self, user):
+        ring = self._correctness_rings.get(user)
+        if ring is None:
+            # e.g. after the environment is restored from a snapshot
+            audit = self.audit(self.LAST_CORRECTNESS, user=user, limit=CorrectnessRing.SIZE)
+            ring = CorrectnessRing.from_history([x_y[1] for x_y in audit])
+            self._correctness_rings[user] = ring
+        return ring
+
     def confusing_factor(self, item, item_secondary, user=None):
         return self.read(self.CONFUSING_FACTOR, item=item, item_secondary=item_secondary, user=user, default=0)
 
@@ -364,10 +586,15 @@ class InMemoryEnvironment(CommonEnvironment):
                             permanent, time, answer, value = values[-1]
                             yield (key, user, item_primary, item_secondary, permanent, time, answer, value)
 
-    def export_audit(self):
+    def export_audit(self, include_spilled=True):
         if not self._audit_enabled:
             raise Exception('Audit can not be exported, because it is not enabled.')
+        if include_spilled:
+            for row in self._export_spilled_audit():
+                yield row
         for key, users in self._data.items():
+            if self._audit_retention.get(key) == self.AUDIT_RETENTION_NONE:
+                continue
             for user, primaries in users.items():
                 for item_primary, secondaries in primaries.items():
                     for item_secondary, values in secondaries.items():
@@ -375,6 +602,114 @@ class InMemoryEnvironment(CommonEnvironment):
                             if not permanent:
                                 yield (key, user, item_primary, item_secondary, time, answer, value)
 
+    def export_values_arrays(self, chunk_size=None):
+        """
+        The same as export_values, but the values are returned as NumPy
+        structured arrays with VALUE_COLUMNS (see
+        proso.models.columnar.to_structured_array).
+
+        Args:
+            chunk_size (int): maximal number of rows in one array, all values
+                are returned in one array by default
+
+        Returns:
+            generator of numpy.ndarray
+        """
+        return iterate_structured_arrays(self.export_values(), VALUE_COLUMNS, chunk_size)
+
+    def export_audit_arrays(self, chunk_size=None, include_spilled=True):
+        """
+        The same as export_audit, but the audit is returned as NumPy
+        structured arrays with AUDIT_COLUMNS (see export_values_arrays).
+        """
+        return iterate_structured_arrays(self.export_audit(include_spilled=include_spilled), AUDIT_COLUMNS, chunk_size)
+
+    def audit_spill_segments(self):
+        """
+        Closes the currently written segment of the spilled audit and returns
+        paths to all segment files. Each line of a segment is formatted by
+        the _format_audit_row method.
+        """
+        if self._audit_spill_file is not None:
+            self._audit_spill_file.close()
+            self._audit_spill_file = None
+        return list(self._audit_spill_segments)
+
+    def discard_audit_spill(self):
+        """
+        Remove all spilled audit segments together with their directory, e.g.,
+        when they have been already processed or the processing failed.
+        """
+        self.audit_spill_segments()
+        if self._audit_spill_segments_dir is not None:
+            shutil.rmtree(self._audit_spill_segments_dir, ignore_errors=True)
+        self._audit_spill_segments_dir = None
+        self._audit_spill_segments = []
+
+    def spills_audit(self):
+        """
+        Returns:
+            bool: True if the audit of any key is spilled to segment files
+        """
+        return self.AUDIT_RETENTION_SPILL in self._audit_retention.values()
+
+    def snapshot(self, path, meta=None):
+        """
+        Save current values and the audit kept in memory to the binary
+        columnar file (see proso.models.snapshot). Spilled audit segments can
+        not be restored together with the snapshot, so the environment
+        spilling audit can not be snapshotted.
+
+        Args:
+            path (str): path to the snapshot file
+            meta (dict): JSON serializable information stored with the
+                snapshot, e.g., progress of the recomputation
+        """
+        if self.spills_audit():
+            raise Exception('The environment spilling audit can not be snapshotted.')
+        save_snapshot(path, self.export_values(), self._export_history(), meta=meta)
+
+    def restore(self, path):
+        """
+        Load the state of the environment from the snapshot created by the
+        snapshot method. The environment has to be empty.
+
+        Returns:
+            dict: meta information stored with the snapshot
+        """
+        if self._data:
+            raise Exception('The snapshot can be restored only to an empty environment.')
+        keys, meta, tables = load_snapshot(path)
+        keys = [sys.intern(k) for k in keys]
+        self._item_structure = None
+        for row in iterate_snapshot_table(keys, tables['values'], VALUE_COLUMNS):
+            self._restore_value(*row)
+        if self._audit_enabled:
+            for row in iterate_snapshot_table(keys, tables['audit'], AUDIT_COLUMNS):
+                self._restore_history(*row)
+        return meta
+
+    def _export_history(self):
+        if not self._audit_enabled:
+            return
+        for key, users in self._data.items():
+            for user, primaries in users.items():
+                for item_primary, secondaries in primaries.items():
+                    for item_secondary, values in secondaries.items():
+                        for permanent, time, answer, value in values[:-1]:
+                            if not permanent:
+                                yield (key, user, item_primary, item_secondary, time, answer, value)
+
+    def _restore_value(self, key, user, item_primary, item_secondary, permanent, time, answer, value):
+        self._data[key][user][item_primary][item_secondary].append((permanent, time, answer, value))
+
+    def _restore_history(self, key, user, item_primary, item_secondary, time, answer, value):
+        found = self._data[key][user][item_primary][item_secondary]
+        found.insert(len(found) - 1, (False, time, answer, value))
+
+    def _contains(self, key, user, item_primary, item_secondary):
+        return len(self._data.get(key, {}).get(user, {}).get(item_primary, {}).get(item_secondary, [])) > 0
+
     def _get(self, key, user=None, item=None, item_secondary=None, symmetric=True):
         items = [item_secondary, item]
         if symmetric and item is not None and item_secondary is not None:
@@ -385,6 +720,981 @@ class InMemoryEnvironment(CommonEnvironment):
         else:
             return None
 
+    def _audit_window(self, key):
+        window = self._audit_windows.get(key, False)
+        if window is not False:
+            return window
+        policy = self._audit_retention.get(key, self.AUDIT_RETENTION_ALL)
+        if policy == self.AUDIT_RETENTION_ALL:
+            window = None
+        elif policy == self.AUDIT_RETENTION_NONE:
+            window = 1
+        elif policy == self.AUDIT_RETENTION_SPILL:
+            window = max(1, self._audit_spill_window)
+        elif isinstance(policy, int) and policy > 0:
+            window = policy
+        else:
+            raise Exception('Unsupported audit retention policy "{}" for key {}.'.format(policy, key))
+        self._audit_windows[key] = window
+        return window
+
+    def _spill_audit(self, key, user, item_primary, item_secondary, entries):
+        if self._audit_retention.get(key) != self.AUDIT_RETENTION_SPILL:
+            return
+        for time, answer, value in entries:
+            row = self._format_audit_row(key, user, item_primary, item_secondary, time, answer, value)
+            if row is None:
+                continue
+            if self._audit_spill_file is None or self._audit_spill_rows >= self.AUDIT_SPILL_SEGMENT_SIZE:
+                self._open_audit_spill_segment()
+            self._audit_spill_file.write(row)
+            self._audit_spill_rows += 1
+
+    def _open_audit_spill_segment(self):
+        if self._audit_spill_file is not None:
+            self._audit_spill_file.close()
+        if self._audit_spill_segments_dir is None:
+            # the directory is unique even for environments in forked processes
+            self._audit_spill_segments_dir = tempfile.mkdtemp(
+                prefix='environment_audit_spill_{}_'.format(os.getpid()),
+                dir=tempfile.gettempdir() if self._audit_spill_dir is None else self._audit_spill_dir)
+        filename = os.path.join(self._audit_spill_segments_dir, 'segment_{}.csv'.format(len(self._audit_spill_segments)))
+        self._audit_spill_file = open(filename, 'w')
+        self._audit_spill_segments.append(filename)
+        self._audit_spill_rows = 0
+
+    def _export_spilled_audit(self):
+        def _parse_id(value):
+            return None if value == 'None' else int(value)
+
+        for filename in self.audit_spill_segments():
+            with open(filename, 'r') as segment:
+                for line in segment:
+                    key, user, item_primary, item_secondary, time, answer, value = line.rstrip('\n').split(',')[:7]
+                    yield (
+                        key, _parse_id(user), _parse_id(item_primary), _parse_id(item_secondary),
+                        datetime.datetime.strptime(time, '%Y-%m-%d %H:%M:%S'), _parse_id(answer), float(value)
+                    )
+
+    def _format_audit_row(self, key, user, item_primary, item_secondary, time, answer, value):
+        return '%s,%s,%s,%s,%s,%s,%s\n' % (key, user, item_primary, item_secondary, time.strftime('%Y-%m-%d %H:%M:%S'), answer, value)
+
+
+class VariableIndex:
+
+    """
+    Secondary index of variables by key and by (key, user, item_primary).
+    A key is indexed lazily when it is queried for the first time and since
+    then the index is maintained incrementally, so keys which are only read
+    and written one by one (e.g. counters) do not occupy any memory here.
+    """
+
+    def __init__(self):
+        # key -> (user, item_primary) -> {item_secondary}
+        self._index = {}
+
+    def is_indexed(self, key):
+        return key in self._index
+
+    def build(self, key, variables):
+        """
+        Args:
+            key (str): key to index
+            variables (iterable): (user, item_primary, item_secondary) triples
+                of all currently stored variables with the given key
+        """
+        index = {}
+        for user, item_primary, item_secondary in variables:
+            index.setdefault((user, item_primary), set()).add(item_secondary)
+        self._index[key] = index
+
+    def add(self, key, user, item_primary, item_secondary):
+        index = self._index.get(key)
+        if index is not None:
+            index.setdefault((user, item_primary), set()).add(item_secondary)
+
+    def remove(self, key, user, item_primary, item_secondary):
+        index = self._index.get(key)
+        if index is None:
+            return
+        secondaries = index.get((user, item_primary))
+        if secondaries is None:
+            return
+        secondaries.discard(item_secondary)
+        if not secondaries:
+            del index[user, item_primary]
+
+    def with_key(self, key):
+        for (user, item_primary), secondaries in self._index[key].items():
+            for item_secondary in secondaries:
+                yield user, item_primary, item_secondary
+
+    def with_item(self, key, user, item_primary):
+        return self._index[key].get((user, item_primary), ())
+
+
+class _CompactVariable:
+
+    """
+    The current state of one variable stored in CompactInMemoryEnvironment.
+    The history contains previous (time, answer, value) triples and it is
+    allocated only when the variable is audited.
+    """
+
+    __slots__ = ('permanent', 'time', 'answer', 'value', 'history')
+
+    def __init__(self, permanent, time, answer, value):
+        self.permanent = permanent
+        self.time = time
+        self.answer = answer
+        self.value = value
+        self.history = None
+
+
+class CompactInMemoryEnvironment(InMemoryEnvironment):
+
+    """
+    In-memory environment storing all variables in one flat dictionary keyed
+    by (key, user, item_primary, item_secondary) tuples. In contrast to
+    InMemoryEnvironment, reading a missing variable does not create any empty
+    entries and each variable occupies only one record with slots, so this
+    implementation is suitable for replaying a large number of answers.
+    """
+
+    def __init__(self, audit_enabled=True, audit_retention=None, audit_spill_dir=None, audit_spill_window=10):
+        InMemoryEnvironment.__init__(
+            self, audit_enabled=audit_enabled, audit_retention=audit_retention,
+            audit_spill_dir=audit_spill_dir, audit_spill_window=audit_spill_window)
+        # (key, user, item_primary, item_secondary) -> _CompactVariable
+        self._data = {}
+        self._index = VariableIndex()
+
+    def audit(self, key, user=None, item=None, item_secondary=None, limit=None, symmetric=True):
+        if not self._audit_enabled:
+            raise Exception('Audit can not be retrieved, because it is not enabled.')
+        found = self._data.get(self._data_key(key, user, item, item_secondary, symmetric))
+        if found is None or found.permanent:
+            return []
+        result = [(found.time, found.value)]
+        if found.history is not None:
+            result += [(t, v) for (t, a, v) in islice(reversed(found.history), None if limit is None else max(0, limit - 1))]
+        if limit is not None:
+            result = result[:limit]
+        return result
+
+    def get_items_with_values(self, key, item, user=None):
+        self._ensure_indexed(key)
+        return [
+            (item_secondary, self._data[key, user, item, item_secondary].value)
+            for item_secondary in self._index.with_item(key, user, item)
+        ]
+
+    def read(self, key, user=None, item=None, item_secondary=None, default=None, symmetric=True):
+        found = self._data.get(self._data_key(key, user, item, item_secondary, symmetric))
+        if found is None:
+            return default
+        return found.value
+
+    def read_all_with_key(self, key):
+        self._ensure_indexed(key)
+        return [
+            (user, item_primary, item_secondary, self._data[key, user, item_primary, item_secondary].value)
+            for user, item_primary, item_secondary in self._index.with_key(key)
+        ]
+
+    def write(self, key, value, user=None, item=None, item_secondary=None, time=None, audit=True, symmetric=True, permanent=False, answer=None):
+        value = float(value)
+        if permanent:
+            audit = False
+        if time is None:
+            time = datetime.datetime.now()
+        data_key = self._data_key(sys.intern(key), user, item, item_secondary, symmetric)
+        found = self._data.get(data_key)
+        if found is None:
+            self._data[data_key] = _CompactVariable(permanent, time, answer, value)
+            self._index.add(*data_key)
+            previous_value = None
+        else:
+            if found.permanent != permanent:
+                raise Exception("The variable %s for items %s, %s and user %s changed permamency from %s to %s" % (
+                    key, item, item_secondary, user, found.permanent, permanent
+                ))
+            previous_value = found.value
+            if audit and self._audit_enabled:
+                window = self._audit_window(key)
+                if window is None:
+                    if found.history is None:
+                        found.history = []
+                    found.history.append((found.time, found.answer, found.value))
+                elif window == 1:
+                    self._spill_audit(key, user, data_key[2], data_key[3], [(found.time, found.answer, found.value)])
+                else:
+                    if found.history is None:
+                        found.history = deque(maxlen=window - 1)
+                    elif len(found.history) == window - 1:
+                        self._spill_audit(key, user, data_key[2], data_key[3], [found.history.popleft()])
+                    found.history.append((found.time, found.answer, found.value))
+            found.time = time
+            found.answer = answer
+            found.value = value
+        if key == 'parent':
+            self._item_structure = None
+        self.call_write_hooks(key, value, user, item, item_secondary, time, previous_value, answer)
+
+    def delete(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        data_key = self._data_key(key, user, item, item_secondary, symmetric)
+        found = self._data.get(data_key)
+        if found is None:
+            return
+        if not found.permanent:
+            raise Exception("Can't delete variable %s which is not permanent." % key)
+        del self._data[data_key]
+        self._index.remove(*data_key)
+        if key == 'parent':
+            self._item_structure = None
+
+    def time(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        found = self._data.get(self._data_key(key, user, item, item_secondary, symmetric))
+        if found is None:
+            return None
+        return found.time
+
+    def export_values(self):
+        for (key, user, item_primary, item_secondary), variable in self._data.items():
+            yield (key, user, item_primary, item_secondary, variable.permanent, variable.time, variable.answer, variable.value)
+
+    def export_audit(self, include_spilled=True):
+        if not self._audit_enabled:
+            raise Exception('Audit can not be exported, because it is not enabled.')
+        if include_spilled:
+            for row in self._export_spilled_audit():
+                yield row
+        for (key, user, item_primary, item_secondary), variable in self._data.items():
+            if variable.permanent or self._audit_retention.get(key) == self.AUDIT_RETENTION_NONE:
+                continue
+            if variable.history is not None:
+                for time, answer, value in variable.history:
+                    yield (key, user, item_primary, item_secondary, time, answer, value)
+            yield (key, user, item_primary, item_secondary, variable.time, variable.answer, variable.value)
+
+    def _export_history(self):
+        if not self._audit_enabled:
+            return
+        for (key, user, item_primary, item_secondary), variable in self._data.items():
+            if variable.permanent or variable.history is None:
+                continue
+            for time, answer, value in variable.history:
+                yield (key, user, item_primary, item_secondary, time, answer, value)
+
+    def _restore_value(self, key, user, item_primary, item_secondary, permanent, time, answer, value):
+        self._data[key, user, item_primary, item_secondary] = _CompactVariable(permanent, time, answer, value)
+        self._index.add(key, user, item_primary, item_secondary)
+
+    def _restore_history(self, key, user, item_primary, item_secondary, time, answer, value):
+        found = self._data[key, user, item_primary, item_secondary]
+        if found.history is None:
+            window = self._audit_window(key)
+            found.history = [] if window is None else deque(maxlen=max(0, window - 1))
+        found.history.append((time, answer, value))
+
+    def _contains(self, key, user, item_primary, item_secondary):
+        return (key, user, item_primary, item_secondary) in self._data
+
+    def _get(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        found = self._data.get(self._data_key(key, user, item, item_secondary, symmetric))
+        if found is None:
+            return None
+        return (found.permanent, found.time, found.answer, found.value)
+
+    def _ensure_indexed(self, key):
+        if not self._index.is_indexed(key):
+            self._index.build(key, (data_key[1:] for data_key in self._data if data_key[0] == key))
+
+    def _data_key(self, key, user, item, item_secondary, symmetric):
+        if symmetric and item is not None and item_secondary is not None and item_secondary > item:
+            return (key, user, item_secondary, item)
+        return (key, user, item, item_secondary)
+
+
+class _ArrayColumn:
+
+    """
+    Values of one key in one scope (global, user, item or pair of user and
+    item) stored in typed arrays indexed by the position in the scope. Times
+    are stored as microseconds since the epoch, missing answers as NONE_ID.
+    """
+
+    SET = 1
+    PERMANENT = 2
+
+    __slots__ = ('values', 'times', 'answers', 'flags', 'log_positions', 'log')
+
+    def __init__(self, size, log):
+        self.values = array('d', bytes(8 * size))
+        self.times = array('q', bytes(8 * size))
+        self.answers = array('q', bytes(8 * size))
+        self.flags = bytearray(size)
+        # position of the current value in the log
+        self.log_positions = array('q', [NONE_ID]) * size
+        self.log = log
+
+    def ensure(self, size):
+        missing = size - len(self.flags)
+        if missing <= 0:
+            return
+        missing = max(missing, len(self.flags))
+        self.values.frombytes(bytes(8 * missing))
+        self.times.frombytes(bytes(8 * missing))
+        self.answers.frombytes(bytes(8 * missing))
+        self.flags.extend(bytes(missing))
+        self.log_positions.extend(array('q', [NONE_ID]) * missing)
+
+
+class _ArrayAuditLog:
+
+    """
+    Append-only audit of one _ArrayColumn. The i-th record consists of
+    (position, time, answer) stored in records[3 * i:3 * i + 3] and of
+    values[i].
+    """
+
+    __slots__ = ('records', 'values')
+
+    def __init__(self):
+        self.records = array('q')
+        self.values = array('d')
+
+    def append(self, position, time, answer, value):
+        self.records.extend((position, time, answer))
+        self.values.append(value)
+        return len(self.values) - 1
+
+    def replace(self, index, time, answer, value):
+        self.records[3 * index + 1] = time
+        self.records[3 * index + 2] = answer
+        self.values[index] = value
+
+    def columns(self):
+        """
+        Returns:
+            (numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray):
+            positions, times, answers and values of all records
+        """
+        records = _to_numpy(self.records, 'int64').reshape(-1, 3)
+        return records[:, 0], records[:, 1], records[:, 2], _to_numpy(self.values, 'float64')
+
+
+class ArrayEnvironment(CompactInMemoryEnvironment):
+
+    """
+    In-memory environment specialised for replays of answers, e.g., by the
+    recompute_model command. Variables of the given keys without the
+    secondary item are stored in typed arrays indexed directly by
+    identifiers of users and items (which are expected to be dense integer
+    ranges) or by slots allocated for pairs of user and item. Each slot is
+    shared by all keys, so the per-variable overhead is only a few bytes.
+    The audit of these keys is kept in append-only columnar logs and the
+    values and audit are exported to NumPy structured arrays without
+    building any Python tuples, so they can be encoded straight to the
+    binary COPY format.
+
+    Other keys, variables with the secondary item and keys with the audit
+    retention policy other than 'all' and 'none' are stored by
+    CompactInMemoryEnvironment. All times have to be naive.
+    """
+
+    ARRAY_KEYS = [
+        InMemoryEnvironment.NUMBER_OF_ANSWERS,
+        InMemoryEnvironment.NUMBER_OF_CORRECT_ANSWERS,
+        InMemoryEnvironment.NUMBER_OF_FIRST_ANSWERS,
+        InMemoryEnvironment.LAST_CORRECTNESS,
+        'prior_skill',
+        'difficulty',
+        'current_skill',
+        'skill',
+        'number_of_difficulty_updates',
+    ]
+
+    SCOPE_GLOBAL = 0
+    SCOPE_USER = 1
+    SCOPE_ITEM = 2
+    SCOPE_PAIR = 3
+
+    def __init__(self, audit_enabled=True, audit_retention=None, audit_spill_dir=None, audit_spill_window=10, array_keys=None, number_of_users=0, number_of_items=0):
+        """
+        Args:
+            array_keys (list): keys stored in arrays, ARRAY_KEYS by default
+            number_of_users (int): the highest expected identifier of user,
+                arrays are preallocated for it and grow when needed
+            number_of_items (int): the highest expected identifier of item
+
+        The remaining arguments are the same as for InMemoryEnvironment.
+        """
+        CompactInMemoryEnvironment.__init__(
+            self, audit_enabled=audit_enabled, audit_retention=audit_retention,
+            audit_spill_dir=audit_spill_dir, audit_spill_window=audit_spill_window)
+        self._array_keys = {
+            sys.intern(key) for key in (self.ARRAY_KEYS if array_keys is None else array_keys)
+            if self._audit_retention.get(key, self.AUDIT_RETENTION_ALL) in [self.AUDIT_RETENTION_ALL, self.AUDIT_RETENTION_NONE]
+        }
+        self._initial_sizes = {
+            self.SCOPE_GLOBAL: 1,
+            self.SCOPE_USER: number_of_users + 1,
+            self.SCOPE_ITEM: number_of_items + 1,
+            self.SCOPE_PAIR: 0,
+        }
+        # (key, scope) -> _ArrayColumn
+        self._columns = {}
+        # (user << 32) | item -> slot of the pair
+        self._pair_slots = {}
+        self._pair_users = array('q')
+        self._pair_items = array('q')
+        # the last converted time, writes during one answer share the time
+        self._last_time = (None, None)
+
+    def process_answer(self, user, item, asked, answered, time, answer, response_time, guess, **kwargs):
+        counters = [self.NUMBER_OF_ANSWERS, self.NUMBER_OF_FIRST_ANSWERS, self.NUMBER_OF_CORRECT_ANSWERS, self.LAST_CORRECTNESS]
+        if not all(key in self._array_keys for key in counters):
+            return CompactInMemoryEnvironment.process_answer(self, user, item, asked, answered, time, answer, response_time, guess, **kwargs)
+        if time is None:
+            time = datetime.datetime.now()
+        scopes = [
+            (self.SCOPE_GLOBAL, 0, None, None),
+            (self.SCOPE_USER, user, user, None),
+            (self.SCOPE_ITEM, item, None, item),
+            (self.SCOPE_PAIR, self._pair_slot(user, item, True), user, item),
+        ]
+        keys = [self.NUMBER_OF_ANSWERS]
+        if self.number_of_answers(user=user, item=item) == 0:
+            keys.insert(0, self.NUMBER_OF_FIRST_ANSWERS)
+        if asked == answered:
+            keys.append(self.NUMBER_OF_CORRECT_ANSWERS)
+        microseconds = _to_microseconds(time)
+        stored_answer = NONE_ID if answer is None else answer
+        for key in keys:
+            for scope, position, scope_user, scope_item in scopes:
+                column = self._columns.get((key, scope))
+                if column is None or position >= len(column.flags):
+                    column = self._column(key, scope, position)
+                flags = column.flags[position]
+                previous_value = column.values[position] if flags else None
+                if self._write_hooks or flags & _ArrayColumn.PERMANENT:
+                    self._write_array(key, column, position, 1.0 if flags == 0 else previous_value + 1, scope_user, scope_item, time, True, False, answer)
+                    continue
+                # inlined _write_array, counters are the most frequent writes
+                column.values[position] = 1.0 if flags == 0 else previous_value + 1
+                column.times[position] = microseconds
+                column.answers[position] = stored_answer
+                column.flags[position] = _ArrayColumn.SET
+                log = column.log
+                if log is not None:
+                    log.records.extend((position, microseconds, stored_answer))
+                    log.values.append(column.values[position])
+                    column.log_positions[position] = len(log.values) - 1
+        self._write_array(
+            self.LAST_CORRECTNESS, self._column(self.LAST_CORRECTNESS, self.SCOPE_USER, user), user,
+            float(asked == answered), user, None, datetime.datetime.now(), True, False, answer)
+        self.update_rolling_success(user, asked == answered, answer=answer)
+        if guess == 0 and asked != answered and answered is not None:
+            increment = lambda x: x + 1
+            self.update(self.CONFUSING_FACTOR, 0, increment, item=asked, item_secondary=answered, answer=answer)
+            self.update(self.CONFUSING_FACTOR, 0, increment, item=asked, item_secondary=answered, user=user, answer=answer)
+
+    def audit(self, key, user=None, item=None, item_secondary=None, limit=None, symmetric=True):
+        if item_secondary is not None or key not in self._array_keys:
+            return CompactInMemoryEnvironment.audit(self, key, user=user, item=item, item_secondary=item_secondary, limit=limit, symmetric=symmetric)
+        if not self._audit_enabled:
+            raise Exception('Audit can not be retrieved, because it is not enabled.')
+        column, position = self._find(key, user, item)
+        if column is None or position is None or position >= len(column.flags) or not column.flags[position] or column.flags[position] & _ArrayColumn.PERMANENT:
+            return []
+        if column.log is None:
+            return [(_from_microseconds(column.times[position]), column.values[position])]
+        current = column.log_positions[position]
+        positions, times, _, values = column.log.columns()
+        found = numpy.nonzero(positions == position)[0]
+        # the current value is the newest one even when restored before its history
+        found = [int(i) for i in found if i != current] + [current]
+        found.reverse()
+        if limit is not None:
+            found = found[:limit]
+        return [(_from_microseconds(int(times[i])), float(values[i])) for i in found]
+
+    def read(self, key, user=None, item=None, item_secondary=None, default=None, symmetric=True):
+        if item_secondary is not None or key not in self._array_keys:
+            return CompactInMemoryEnvironment.read(self, key, user=user, item=item, item_secondary=item_secondary, default=default, symmetric=symmetric)
+        column, position = self._find(key, user, item)
+        if column is None or position is None or position >= len(column.flags) or not column.flags[position]:
+            return default
+        return column.values[position]
+
+    def read_more_items(self, key, items, user=None, item=None, default=None, symmetric=True):
+        if item is not None or key not in self._array_keys:
+            return CompactInMemoryEnvironment.read_more_items(self, key, items, user=user, item=item, default=default, symmetric=symmetric)
+        result = {}
+        if user is None:
+            column = self._columns.get((key, self.SCOPE_ITEM))
+            size = 0 if column is None else len(column.flags)
+            for i in items:
+                result[i] = column.values[i] if i < size and column.flags[i] else default
+        else:
+            column = self._columns.get((key, self.SCOPE_PAIR))
+            size = 0 if column is None else len(column.flags)
+            pair_slots = self._pair_slots
+            for i in items:
+                slot = pair_slots.get((user << 32) | i)
+                result[i] = column.values[slot] if slot is not None and slot < size and column.flags[slot] else default
+        return result
+
+    def read_all_with_key(self, key):
+        found = CompactInMemoryEnvironment.read_all_with_key(self, key)
+        if key in self._array_keys:
+            for values in self._values_arrays(key):
+                found += [
+                    (_to_id(user), _to_id(item_primary), None, value)
+                    for user, item_primary, value in zip(values['user'].tolist(), values['item_primary'].tolist(), values['value'].tolist())
+                ]
+        return found
+
+    def write(self, key, value, user=None, item=None, item_secondary=None, time=None, audit=True, symmetric=True, permanent=False, answer=None):
+        if item_secondary is not None or key not in self._array_keys:
+            return CompactInMemoryEnvironment.write(
+                self, key, value, user=user, item=item, item_secondary=item_secondary, time=time,
+                audit=audit, symmetric=symmetric, permanent=permanent, answer=answer)
+        if time is None:
+            time = datetime.datetime.now()
+        scope, position = self._position(user, item, True)
+        self._write_array(key, self._column(key, scope, position), position, float(value), user, item, time, audit, permanent, answer)
+
+    def delete(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        if item_secondary is not None or key not in self._array_keys:
+            return CompactInMemoryEnvironment.delete(self, key, user=user, item=item, item_secondary=item_secondary, symmetric=symmetric)
+        column, position = self._find(key, user, item)
+        if column is None or position is None or position >= len(column.flags) or not column.flags[position]:
+            return
+        if not column.flags[position] & _ArrayColumn.PERMANENT:
+            raise Exception("Can't delete variable %s which is not permanent." % key)
+        column.flags[position] = 0
+
+    def time(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        if item_secondary is not None or key not in self._array_keys:
+            return CompactInMemoryEnvironment.time(self, key, user=user, item=item, item_secondary=item_secondary, symmetric=symmetric)
+        column, position = self._find(key, user, item)
+        if column is None or position is None or position >= len(column.flags) or not column.flags[position]:
+            return None
+        return _from_microseconds(column.times[position])
+
+    def update_rolling_success(self, user, correct, answer=None, context=None):
+        # the ring is kept for all users, loading it from the audit would
+        # scan the whole log
+        ring = self._correctness_rings.get(user)
+        if ring is None:
+            ring = self._correctness_rings[user] = CorrectnessRing()
+        ring.push(correct)
+
+    def export_values(self):
+        for row in CompactInMemoryEnvironment.export_values(self):
+            yield row
+        for values in self._values_arrays():
+            for key, user, item_primary, item_secondary, permanent, time, answer, value in values.tolist():
+                yield (key.decode(), _to_id(user), _to_id(item_primary), None, permanent, time, _to_id(answer), value)
+
+    def export_audit(self, include_spilled=True):
+        for row in CompactInMemoryEnvironment.export_audit(self, include_spilled=include_spilled):
+            yield row
+        for audit in self._audit_arrays():
+            for row in _audit_rows(audit):
+                yield row
+
+    def export_values_arrays(self, chunk_size=None):
+        return _iterate_chunks(chain(
+            iterate_structured_arrays(CompactInMemoryEnvironment.export_values(self), VALUE_COLUMNS, chunk_size),
+            self._values_arrays()
+        ), chunk_size)
+
+    def export_audit_arrays(self, chunk_size=None, include_spilled=True):
+        return _iterate_chunks(chain(
+            iterate_structured_arrays(CompactInMemoryEnvironment.export_audit(self, include_spilled=include_spilled), AUDIT_COLUMNS, chunk_size),
+            self._audit_arrays()
+        ), chunk_size)
+
+    def restore(self, path):
+        if self._columns:
+            raise Exception('The snapshot can be restored only to an empty environment.')
+        meta = CompactInMemoryEnvironment.restore(self, path)
+        self._restore_correctness_rings()
+        return meta
+
+    def _export_history(self):
+        for row in CompactInMemoryEnvironment._export_history(self):
+            yield row
+        for audit in self._audit_arrays(history_only=True):
+            for row in _audit_rows(audit):
+                yield row
+
+    def _restore_value(self, key, user, item_primary, item_secondary, permanent, time, answer, value):
+        if item_secondary is not None or key not in self._array_keys:
+            return CompactInMemoryEnvironment._restore_value(self, key, user, item_primary, item_secondary, permanent, time, answer, value)
+        scope, position = self._position(user, item_primary, True)
+        column = self._column(key, scope, position)
+        time = _to_microseconds(time)
+        answer = NONE_ID if answer is None else answer
+        column.values[position] = value
+        column.times[position] = time
+        column.answers[position] = answer
+        column.flags[position] = _ArrayColumn.SET | (_ArrayColumn.PERMANENT if permanent else 0)
+        if column.log is not None and not permanent:
+            column.log_positions[position] = column.log.append(position, time, answer, value)
+
+    def _restore_history(self, key, user, item_primary, item_secondary, time, answer, value):
+        if item_secondary is not None or key not in self._array_keys:
+            return CompactInMemoryEnvironment._restore_history(self, key, user, item_primary, item_secondary, time, answer, value)
+        scope, position = self._position(user, item_primary, True)
+        column = self._column(key, scope, position)
+        if column.log is not None:
+            column.log.append(position, _to_microseconds(time), NONE_ID if answer is None else answer, value)
+
+    def _restore_correctness_rings(self):
+        column = self._columns.get((self.LAST_CORRECTNESS, self.SCOPE_USER))
+        if column is None or column.log is None:
+            return
+        users, _, _, values = column.log.columns()
+        current = numpy.zeros(len(users), dtype=bool)
+        log_positions = _to_numpy(column.log_positions, 'int64')
+        current[log_positions[log_positions != NONE_ID]] = True
+        # history of each user in the order of writes, the current value last
+        order = numpy.lexsort((numpy.arange(len(users)), current, users))
+        values = values[order]
+        users = users[order]
+        boundaries = numpy.nonzero(numpy.diff(users))[0] + 1
+        for user_values, user in zip(numpy.split(values, boundaries), users[numpy.append([0], boundaries)] if len(users) > 0 else []):
+            self._correctness_rings[int(user)] = CorrectnessRing.from_history(user_values[::-1].tolist())
+
+    def _contains(self, key, user, item_primary, item_secondary):
+        if item_secondary is not None or key not in self._array_keys:
+            return CompactInMemoryEnvironment._contains(self, key, user, item_primary, item_secondary)
+        column, position = self._find(key, user, item_primary)
+        return column is not None and position is not None and position < len(column.flags) and bool(column.flags[position])
+
+    def _get(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        if item_secondary is not None or key not in self._array_keys:
+            return CompactInMemoryEnvironment._get(self, key, user=user, item=item, item_secondary=item_secondary, symmetric=symmetric)
+        column, position = self._find(key, user, item)
+        if column is None or position is None or position >= len(column.flags) or not column.flags[position]:
+            return None
+        return (
+            bool(column.flags[position] & _ArrayColumn.PERMANENT), _from_microseconds(column.times[position]),
+            _to_id(column.answers[position]), column.values[position])
+
+    def _write_array(self, key, column, position, value, user, item, time, audit, permanent, answer):
+        flags = column.flags[position]
+        if flags and bool(flags & _ArrayColumn.PERMANENT) != permanent:
+            raise Exception("The variable %s for items %s, %s and user %s changed permamency from %s to %s" % (
+                key, item, None, user, bool(flags & _ArrayColumn.PERMANENT), permanent
+            ))
+        previous_value = column.values[position] if flags else None
+        if time is self._last_time[0]:
+            microseconds = self._last_time[1]
+        else:
+            microseconds = _to_microseconds(time)
+            self._last_time = (time, microseconds)
+        stored_answer = NONE_ID if answer is None else answer
+        column.values[position] = value
+        column.times[position] = microseconds
+        column.answers[position] = stored_answer
+        column.flags[position] = _ArrayColumn.SET | (_ArrayColumn.PERMANENT if permanent else 0)
+        log = column.log
+        if log is not None and not permanent:
+            log_position = column.log_positions[position]
+            if audit or log_position == NONE_ID:
+                log.records.extend((position, microseconds, stored_answer))
+                log.values.append(value)
+                column.log_positions[position] = len(log.values) - 1
+            else:
+                log.replace(log_position, microseconds, stored_answer, value)
+        if self._write_hooks:
+            self.call_write_hooks(key, value, user, item, None, time, previous_value, answer)
+
+    def _find(self, key, user, item):
+        if user is None:
+            if item is None:
+                return self._columns.get((key, self.SCOPE_GLOBAL)), 0
+            return self._columns.get((key, self.SCOPE_ITEM)), item
+        if item is None:
+            return self._columns.get((key, self.SCOPE_USER)), user
+        return self._columns.get((key, self.SCOPE_PAIR)), self._pair_slots.get((user << 32) | item)
+
+    def _position(self, user, item, create):
+        if user is None:
+            if item is None:
+                return self.SCOPE_GLOBAL, 0
+            return self.SCOPE_ITEM, item
+        if item is None:
+            return self.SCOPE_USER, user
+        return self.SCOPE_PAIR, self._pair_slot(user, item, create)
+
+    def _pair_slot(self, user, item, create):
+        code = (user << 32) | item
+        slot = self._pair_slots.get(code)
+        if slot is None and create:
+            slot = self._pair_slots[code] = len(self._pair_users)
+            self._pair_users.append(user)
+            self._pair_items.append(item)
+        return slot
+
+    def _column(self, key, scope, position):
+        column = self._columns.get((key, scope))
+        if column is None:
+            log = None
+            if self._audit_enabled and self._audit_retention.get(key) != self.AUDIT_RETENTION_NONE:
+                log = _ArrayAuditLog()
+            column = self._columns[key, scope] = _ArrayColumn(self._initial_sizes[scope], log)
+        column.ensure(position + 1)
+        return column
+
+    def _scope_ids(self, scope, positions):
+        none = numpy.full(len(positions), NONE_ID, dtype='int64')
+        if scope == self.SCOPE_GLOBAL:
+            return none, none
+        if scope == self.SCOPE_USER:
+            return positions, none
+        if scope == self.SCOPE_ITEM:
+            return none, positions
+        return _to_numpy(self._pair_users, 'int64')[positions], _to_numpy(self._pair_items, 'int64')[positions]
+
+    def _values_arrays(self, key=None):
+        for (column_key, scope), column in self._columns.items():
+            if key is not None and column_key != key:
+                continue
+            flags = _to_numpy(column.flags, 'uint8')
+            positions = numpy.nonzero(flags)[0]
+            result = numpy.empty(len(positions), dtype=_columns_dtype(VALUE_COLUMNS, column_key))
+            result['key'] = column_key.encode()
+            result['user'], result['item_primary'] = self._scope_ids(scope, positions)
+            result['item_secondary'] = NONE_ID
+            result['permanent'] = (flags[positions] & _ArrayColumn.PERMANENT) > 0
+            result['time'] = _to_numpy(column.times, 'int64')[positions].view('datetime64[us]')
+            result['answer'] = _to_numpy(column.answers, 'int64')[positions]
+            result['value'] = _to_numpy(column.values, 'float64')[positions]
+            yield result
+
+    def _audit_arrays(self, history_only=False):
+        for (key, scope), column in self._columns.items():
+            if column.log is None:
+                continue
+            positions, times, answers, values = column.log.columns()
+            selected = numpy.ones(len(values), dtype=bool)
+            if history_only:
+                log_positions = _to_numpy(column.log_positions, 'int64')
+                selected[log_positions[log_positions != NONE_ID]] = False
+            positions = positions[selected]
+            result = numpy.empty(len(positions), dtype=_columns_dtype(AUDIT_COLUMNS, key))
+            result['key'] = key.encode()
+            result['user'], result['item_primary'] = self._scope_ids(scope, positions)
+            result['item_secondary'] = NONE_ID
+            result['time'] = times[selected].view('datetime64[us]')
+            result['answer'] = answers[selected]
+            result['value'] = values[selected]
+            yield result
+
+
+def _to_numpy(buffer, dtype):
+    # copy, so the buffer can grow while the array is used
+    return numpy.frombuffer(buffer, dtype=dtype).copy()
+
+
+def _to_microseconds(time):
+    return (time - _EPOCH) // _MICROSECOND
+
+
+def _from_microseconds(microseconds):
+    return _EPOCH + datetime.timedelta(microseconds=microseconds)
+
+
+def _to_id(value):
+    return None if value == NONE_ID else value
+
+
+def _columns_dtype(columns, key):
+    return [('key', 'S{}'.format(max(len(key.encode()), 1)))] + [(name, dtype) for name, dtype in columns if name != 'key']
+
+
+def _iterate_chunks(arrays, chunk_size):
+    """
+    Split the given structured arrays to chunks with at most chunk_size rows,
+    or concatenate them to one array if the chunk size is not specified.
+    """
+    if chunk_size is None:
+        arrays = list(arrays)
+        width = max([a.dtype['key'].itemsize for a in arrays] + [1])
+        dtype = [('key', 'S{}'.format(width))] + [(name, a_dtype) for name, (a_dtype, _) in arrays[0].dtype.fields.items() if name != 'key']
+        yield numpy.concatenate([a.astype(dtype) for a in arrays])
+        return
+    for a in arrays:
+        for start in range(0, len(a), chunk_size):
+            yield a[start:start + chunk_size]
+
+
+def _audit_rows(audit):
+    for key, user, item_primary, item_secondary, time, answer, value in audit.tolist():
+        yield (key.decode(), _to_id(user), _to_id(item_primary), None, time, _to_id(answer), value)
+
+
+class AsyncWriteHookDispatcher(EnvironmentWriteHook):
+
+    """
+    Write hook which queues events and delivers them in batches to the
+    wrapped hooks from a background thread, so slow hooks do not slow down
+    writes. The queue is bounded and when it is full, the behaviour is given
+    by the backpressure policy: 'block' (wait for a free slot), 'drop'
+    (forget the event) or 'spill' (append the event to a file in
+    'spill_dir', it is delivered when the queue is drained). Queued events
+    are delivered when the process exits.
+    """
+
+    BACKPRESSURE_BLOCK = 'block'
+    BACKPRESSURE_DROP = 'drop'
+    BACKPRESSURE_SPILL = 'spill'
+
+    _STOP = object()
+
+    def __init__(self, hooks, queue_size=10000, batch_size=1000, flush_interval=1.0, backpressure='block', spill_dir=None):
+        if backpressure not in [self.BACKPRESSURE_BLOCK, self.BACKPRESSURE_DROP, self.BACKPRESSURE_SPILL]:
+            raise Exception('Unsupported backpressure policy "{}".'.format(backpressure))
+        self._hooks = hooks
+        self._queue_size = queue_size
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._backpressure = backpressure
+        self._spill_dir = spill_dir
+        self._spill_lock = threading.Lock()
+        # notified when all spilled events are delivered
+        self._spill_delivered = threading.Condition(self._spill_lock)
+        self._spill_filename = None
+        self._spill_pending = 0
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self.dropped = 0
+        self.spilled = 0
+        atexit.register(self.close)
+
+    def event(self, key, value, user, item, item_secondary, time, previous_value, answer):
+        self._put((key, value, user, item, item_secondary, time, previous_value, answer))
+
+    def events(self, batch):
+        for event in batch:
+            self._put(event)
+
+    def flush(self):
+        """
+        Wait until all events emitted so far are delivered.
+        """
+        if self._queue is None or self._pid != os.getpid():
+            return
+        self._queue.join()
+        with self._spill_delivered:
+            while self._spill_pending > 0 and self._thread.is_alive():
+                # the timeout only checks the thread has not died
+                self._spill_delivered.wait(self._flush_interval)
+
+    def close(self):
+        """
+        Deliver all queued events and stop the background thread.
+        """
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        self._queue.put(self._STOP)
+        self._thread.join()
+
+    def _put(self, event):
+        self._ensure_started()
+        if self._backpressure == self.BACKPRESSURE_BLOCK:
+            self._queue.put(event)
+            return
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            if self._backpressure == self.BACKPRESSURE_DROP:
+                self.dropped += 1
+            else:
+                self._spill(event)
+
+    def _ensure_started(self):
+        # the thread does not survive fork, so each process has its own one
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self._queue_size)
+            self._spill_filename = None
+            self._spill_pending = 0
+            self._thread = threading.Thread(target=self._run, name='environment-write-hooks', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = []
+            try:
+                event = self._queue.get(timeout=self._flush_interval)
+                while True:
+                    if event is self._STOP:
+                        stop = True
+                    else:
+                        batch.append(event)
+                    if stop or len(batch) >= self._batch_size:
+                        break
+                    event = self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._deliver(batch)
+            for _ in range(len(batch) + (1 if stop else 0)):
+                self._queue.task_done()
+            if stop or self._queue.empty():
+                self._deliver_spilled()
+
+    def _deliver(self, batch):
+        if len(batch) == 0:
+            return
+        for hook in self._hooks:
+            try:
+                hook.events(batch)
+            except Exception:
+                LOGGER.exception('Write hook {} failed to process {} events.'.format(hook, len(batch)))
+
+    def _spill(self, event):
+        with self._spill_lock:
+            if self._spill_filename is None:
+                spill_dir = tempfile.gettempdir() if self._spill_dir is None else self._spill_dir
+                self._spill_filename = os.path.join(spill_dir, 'environment_write_hooks_{}_{}.pickle'.format(os.getpid(), id(self)))
+            with open(self._spill_filename, 'ab') as spill_file:
+                pickle.dump(event, spill_file)
+            self._spill_pending += 1
+            self.spilled += 1
+
+    def _deliver_spilled(self):
+        with self._spill_lock:
+            if self._spill_pending == 0:
+                return
+            events = []
+            with open(self._spill_filename, 'rb') as spill_file:
+                while True:
+                    try:
+                        events.append(pickle.load(spill_file))
+                    except EOFError:
+                        break
+            os.remove(self._spill_filename)
+        for i in range(0, len(events), self._batch_size):
+            self._deliver(events[i:i + self._batch_size])
+        with self._spill_delivered:
+            self._spill_pending -= len(events)
+            if self._spill_pending == 0:
+                self._spill_delivered.notify_all()
+
 
 ################################################################################
 # Tests
@@ -427,7 +1737,7 @@ class TestEnvironment(unittest.TestCase, metaclass=abc.ABCMeta):
                 })
 
             @property
-            def events(self):
+            def received(self):
                 return self._events
 
         env = self.generate_environment()
@@ -454,7 +1764,42 @@ class TestEnvironment(unittest.TestCase, metaclass=abc.ABCMeta):
                 'value': 2,
                 'answer': None,
             },
-        ], test_hook.events)
+        ], test_hook.received)
+
+    def test_write_many(self):
+
+        class TestHook(EnvironmentWriteHook):
+
+            def __init__(self):
+                self.batches = []
+
+            def event(self, key, value, user, item, item_secondary, time, previous_value, answer):
+                raise Exception('Events are expected to be batched.')
+
+            def events(self, batch):
+                self.batches.append([(key, value, previous_value) for (key, value, _, _, _, _, previous_value, _) in batch])
+
+        env = self.generate_environment()
+        test_hook = TestHook()
+        env.add_write_hook(test_hook)
+        user = self.generate_user()
+        items = [self.generate_item() for i in range(3)]
+        env.write_many([
+            {'key': 'key', 'value': 1, 'user': user},
+            {'key': 'key', 'value': 2, 'user': user},
+            {'key': 'other', 'value': 3, 'item': items[0], 'item_secondary': items[1]},
+        ])
+        self.assertEqual(2, env.read('key', user=user))
+        self.assertEqual(3, env.read('other', item=items[1], item_secondary=items[0]))
+        self.assertEqual([[('key', 1, None), ('key', 2, 1), ('other', 3, None)]], test_hook.batches)
+        env.update_many([
+            {'key': 'key', 'init_value': 0, 'update_fun': lambda x: x + 1, 'user': user},
+            {'key': 'key', 'init_value': 0, 'update_fun': lambda x: x * 10, 'user': user},
+            {'key': 'key', 'init_value': 5, 'update_fun': lambda x: x + 1, 'item': items[2]},
+        ])
+        self.assertEqual(30, env.read('key', user=user))
+        self.assertEqual(6, env.read('key', item=items[2]))
+        self.assertEqual([('key', 3, 2), ('key', 30, 3), ('key', 6, None)], test_hook.batches[1])
 
     def test_permanent(self):
         items = [self.generate_item() for i in range(3)]
@@ -535,6 +1880,19 @@ class TestEnvironment(unittest.TestCase, metaclass=abc.ABCMeta):
         self.assertEqual(9 * 3 + 2, len(env.read_all_with_key('k1')))
         self.assertEqual(9 * 3 + 2, len(env.read_all_with_key('k2')))
 
+    def test_get_items_with_values_after_delete(self):
+        env = self.generate_environment()
+        parent = self.generate_item()
+        children = [self.generate_item() for _ in range(5)]
+        env.write('parent', 1, item=parent, item_secondary=children[0], symmetric=False, permanent=True)
+        self.assertEqual([(children[0], 1)], env.get_items_with_values('parent', parent))
+        for child in children[1:]:
+            env.write('parent', 1, item=parent, item_secondary=child, symmetric=False, permanent=True)
+        env.delete('parent', item=parent, item_secondary=children[0], symmetric=False)
+        self.assertEqual(sorted([(c, 1) for c in children[1:]]), sorted(env.get_items_with_values('parent', parent)))
+        self.assertEqual([], env.get_items_with_values('parent', children[1]))
+        self.assertEqual(4, len(env.read_all_with_key('parent')))
+
     def test_audit(self):
         env = self.generate_environment()
         for value in range(100):
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Offline evaluation of predictive models: the answers are kept in one
+structured NumPy array (which can be saved and memory-mapped by more
+processes) and replayed through a predictive model in a fresh in-memory
+environment.
+"""
+from proso.metric import brier, log_loss, rmse
+from proso.models.environment import InMemoryEnvironment
+import numpy
+
+
+ANSWER_DTYPE = numpy.dtype([
+    ('id', 'int64'),
+    ('user', 'int64'),
+    ('item', 'int64'),
+    ('item_asked', 'int64'),
+    # -1 stands for no answered item
+    ('item_answered', 'int64'),
+    ('time', 'datetime64[us]'),
+    ('response_time', 'int64'),
+    ('guess', 'float64'),
+])
+
+
+def answers_to_array(rows):
+    """
+    Args:
+        rows (list): (id, user, item, item_asked, item_answered, time,
+            response_time, guess) tuples, e.g., fetched from the answer table
+
+    Returns:
+        numpy.ndarray: structured array with ANSWER_DTYPE
+    """
+    return numpy.array([
+        (answer_id, user, item, asked, -1 if answered is None else answered, time, response_time, guess)
+        for answer_id, user, item, asked, answered, time, response_time, guess in rows
+    ], dtype=ANSWER_DTYPE)
+
+
+def iterate_answers(answers, chunk_size=100000):
+    """
+    Generate answers from the given array as dictionaries accepted by
+    predict_and_update_many. The array is converted to Python objects by
+    chunks of the given size, so a memory-mapped array is never loaded at
+    once.
+    """
+    for start in range(0, len(answers), chunk_size):
+        chunk = answers[start:start + chunk_size]
+        columns = [chunk[name].tolist() for name in ANSWER_DTYPE.names]
+        for answer_id, user, item, asked, answered, time, response_time, guess in zip(*columns):
+            answered = None if answered == -1 else answered
+            yield {
+                'user': user,
+                'item': item,
+                'correct': asked == answered,
+                'time': time,
+                'item_answered': answered,
+                'item_asked': asked,
+                'guess': guess,
+                'answer_id': answer_id,
+                'response_time': response_time,
+            }
+
+
+def replay(predictive_model, answers, relations=None, chunk_size=1000, environment=None):
+    """
+    Process the given answers by the given predictive model in the given
+    order.
+
+    Args:
+        predictive_model (proso.models.prediction.PredictiveModel): model
+        answers (numpy.ndarray): structured array with ANSWER_DTYPE
+        relations (list): (child, parent, value) triples written as 'parent'
+            variables before the first answer
+        chunk_size (int): number of answers passed to
+            predict_and_update_many at once
+        environment (proso.models.environment.Environment): environment,
+            the new in-memory environment without audit by default
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): predictions and correctness of the
+        answers
+    """
+    if environment is None:
+        environment = InMemoryEnvironment(audit_enabled=False)
+    for child, parent, value in (relations or []):
+        environment.write('parent', value, item=child, item_secondary=parent, symmetric=False, permanent=True)
+    predictions = numpy.empty(len(answers))
+    correct = answers['item_asked'] == answers['item_answered']
+    chunk = []
+    processed = 0
+    for answer in iterate_answers(answers, chunk_size=chunk_size):
+        chunk.append(answer)
+        if len(chunk) == chunk_size:
+            predictions[processed:processed + len(chunk)] = predictive_model.predict_and_update_many(environment, chunk, process_answers=True)
+            processed += len(chunk)
+            chunk = []
+    if len(chunk) > 0:
+        predictions[processed:processed + len(chunk)] = predictive_model.predict_and_update_many(environment, chunk, process_answers=True)
+    return predictions, correct
+
+
+def evaluate(predictions, correct):
+    """
+    Returns:
+        dict: RMSE, log-loss and brier score decomposition of the given
+        predictions
+    """
+    correct = numpy.asarray(correct, dtype=float)
+    brier_score = brier(predictions, correct)
+    return {
+        'number_of_answers': len(predictions),
+        'rmse': rmse(predictions, correct),
+        'log_loss': log_loss(predictions, correct),
+        'brier': {
+            'reliability': brier_score['reliability'],
+            'resolution': brier_score['resolution'],
+            'uncertainty': brier_score['uncertainty'],
+        },
+    }
+
+
+def calibration_buckets(predictions, correct, buckets=10):
+    """
+    Aggregate the given predictions in equally wide buckets by the predicted
+    probability. Aggregates of more batches of answers can be summed and
+    summarized by summarize_calibration, e.g., when the answers are evaluated
+    online.
+
+    Returns:
+        dict: bucket -> (number of answers, number of correct answers, sum of
+        predictions, sum of squared errors), only for non-empty buckets
+    """
+    predictions = numpy.asarray(predictions, dtype=float)
+    correct = numpy.asarray(correct, dtype=float)
+    positions = numpy.clip((predictions * buckets).astype(int), 0, buckets - 1)
+    counts = numpy.bincount(positions, minlength=buckets)
+    correct_counts = numpy.bincount(positions, weights=correct, minlength=buckets)
+    prediction_sums = numpy.bincount(positions, weights=predictions, minlength=buckets)
+    error_sums = numpy.bincount(positions, weights=(predictions - correct) ** 2, minlength=buckets)
+    return {
+        int(bucket): (int(counts[bucket]), int(correct_counts[bucket]), float(prediction_sums[bucket]), float(error_sums[bucket]))
+        for bucket in numpy.flatnonzero(counts)
+    }
+
+
+def summarize_calibration(aggregates, buckets=10):
+    """
+    Args:
+        aggregates (dict): bucket -> (number of answers, number of correct
+            answers, sum of predictions, sum of squared errors), see
+            calibration_buckets
+
+    Returns:
+        dict: brier score with its decomposition (reliability, resolution and
+        uncertainty) and the mean prediction and success rate of each bucket
+    """
+    number_of_answers = sum(a[0] for a in aggregates.values())
+    calibration = []
+    for bucket in range(buckets):
+        count, correct, prediction_sum, _ = aggregates.get(bucket, (0, 0, 0, 0))
+        calibration.append({
+            'lower': bucket / buckets,
+            'upper': (bucket + 1) / buckets,
+            'number_of_answers': count,
+            'mean_prediction': prediction_sum / count if count > 0 else None,
+            'success_rate': correct / count if count > 0 else None,
+        })
+    if number_of_answers == 0:
+        return {
+            'number_of_answers': 0,
+            'brier': None,
+            'reliability': None,
+            'resolution': None,
+            'uncertainty': None,
+            'calibration': calibration,
+        }
+    success_rate = sum(a[1] for a in aggregates.values()) / number_of_answers
+    return {
+        'number_of_answers': number_of_answers,
+        'brier': sum(a[3] for a in aggregates.values()) / number_of_answers,
+        'reliability': sum(count * (correct / count - prediction_sum / count) ** 2 for count, correct, prediction_sum, _ in aggregates.values()) / number_of_answers,
+        'resolution': sum(count * (correct / count - success_rate) ** 2 for count, correct, _, _ in aggregates.values()) / number_of_answers,
+        'uncertainty': success_rate * (1 - success_rate),
+        'calibration': calibration,
+    }
@@ -124,12 +124,13 @@ class ScoreItemSelection(ItemSelection):
         self._time_ago_max = time_ago_max
 
     def select(self, environment, user, items, time, practice_context, n, **kwargs):
-        parents = environment.get_items_with_values_more_items('parent', items=items)
+        structure = environment.item_structure()
+        parents = structure.get_parents_more_items(items)
         if self._estimate_parent_factors:
             related_items = items
         else:
             parent_ids = set(sum([[p for p, v in ps] for ps in list(parents.values())], []))
-            children = environment.get_items_with_values_more_items('child', items=parent_ids)
+            children = structure.get_children_more_items(parent_ids)
             related_items = sum([[i for i, v in c] for c in list(children.values())], [])
             parents = defaultdict(lambda: [])
             for parent, childs in list(children.items()):
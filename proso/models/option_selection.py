@@ -32,8 +32,8 @@ class OptionSelection(metaclass=abc.ABCMeta):
 
     def select_options(self, environment, user, item, time, options, allow_zero_options=True, **kwargs):
         return self.select_options_more_items(
-            environment, user, [item], time, {item: allow_zero_options}, **kwargs
-        )
+            environment, user, [item], time, {item: options}, allow_zero_options={item: allow_zero_options}, **kwargs
+        )[0]
 
     def select_options_more_items(self, environment, user, items, time, options, allow_zero_options=None, **kwargs):
         if allow_zero_options is None:
@@ -1,11 +1,8 @@
-from functools import reduce
 from math import exp
 from proso.time import timeit
-from proso.django.cache import cache_pure
 from collections import defaultdict
 import abc
 import numpy
-import operator
 
 
 class PredictiveModel(metaclass=abc.ABCMeta):
@@ -35,6 +32,57 @@ class PredictiveModel(metaclass=abc.ABCMeta):
             environment, data, prediction, user, item, correct, time, answer_id, **kwargs)
         return prediction
 
+    def predict_and_update_many(self, environment, answers, process_answers=False):
+        """
+        The same as calling predict_and_update for each of the given answers
+        in the given order.
+
+        Args:
+            environment (proso.models.environment.Environment):
+                environment where all the important data are persist
+            answers (list):
+                dictionaries with keyword arguments of predict_and_update,
+                e.g., {'user': 1, 'item': 2, 'correct': True, 'time': time,
+                'answer_id': 3, 'guess': 0}
+            process_answers (bool):
+                if True, environment.process_answer is called after each
+                answer (using item_asked, item_answered, response_time and
+                guess from the answer)
+
+        Returns:
+            list: predictions for the given answers
+        """
+        predictions = []
+        for answer in answers:
+            predictions.append(self.predict_and_update(environment, **answer))
+            if process_answers:
+                _process_answer(environment, answer)
+        return predictions
+
+    def _predict_and_update_many_prefetched(self, environment, answers, process_answers):
+        """
+        Implementation of predict_and_update_many for models which are able
+        to prefetch all variables touched by the answers (see
+        _prefetch_many). The answers are processed one by one by the same
+        code as predict_and_update, but the variables are read from and
+        written to the local buffer, which is written back to the
+        environment at once.
+        """
+        buffered = _WriteBackEnvironment(environment)
+        self._prefetch_many(buffered, answers)
+        predictions = []
+        for answer in answers:
+            predictions.append(self.predict_and_update(buffered, **answer))
+            if process_answers:
+                # answers are processed directly, the environment does not
+                # touch the variables of the model
+                _process_answer(environment, answer)
+        buffered.write_back()
+        return predictions
+
+    def _prefetch_many(self, environment, answers):
+        pass
+
     @abc.abstractmethod
     def prepare_phase(self, environment, user, item, time, **kwargs):
         """
@@ -208,15 +256,27 @@ class PriorCurrentPredictiveModel(PredictiveModel):
             guess=kwargs.get('guess'))[0]
 
     def predict_phase_more_items(self, data, user, items, time, **kwargs):
-        preds = []
-        for i in items:
-            preds.append(self.predict_phase({
-                'prior_skill': data['prior_skill'],
-                'difficulty': data['difficulties'][i],
-                'current_skill': data['current_skills'][i],
-                'last_time': data['last_times'][i],
-            }, user, i, time, **kwargs))
-        return preds
+        current_skills = _to_array([data['current_skills'][i] for i in items])
+        difficulties = _to_array([data['difficulties'][i] for i in items])
+        seconds_ago = _seconds_ago_more_items(time, [data['last_times'][i] for i in items], 315460000)
+        skills = numpy.where(
+            numpy.isnan(current_skills),
+            data['prior_skill'] - difficulties,
+            current_skills + self._time_shift / numpy.maximum(seconds_ago, 0.001))
+        return predict_simple_more_items(
+            skills,
+            number_of_options=len(kwargs['options']) if 'options' in kwargs else 0,
+            guess=kwargs.get('guess')).tolist()
+
+    def predict_and_update_many(self, environment, answers, process_answers=False):
+        return self._predict_and_update_many_prefetched(environment, answers, process_answers)
+
+    def _prefetch_many(self, environment, answers):
+        items_per_user = _items_per_user(answers)
+        environment.read_more_items('difficulty', items=list(set(a['item'] for a in answers)))
+        for user, items in items_per_user.items():
+            environment.read('prior_skill', user=user)
+            environment.read_more_items('current_skill', user=user, items=items)
 
     def update_phase(self, environment, data, prediction, user, item, correct, time, answer_id, **kwargs):
         result = correct
@@ -272,7 +332,25 @@ class AlwaysLearningPredictiveModel(PredictiveModel):
             guess=kwargs.get('guess'))[0]
 
     def predict_phase_more_items(self, data, user, items, time, **kwargs):
-        return [self.predict_phase(data, user, i, time, **kwargs) for i in items]
+        # the skills depend on the structure of parents, so they are still
+        # computed per item
+        skills = _to_array([self._load_skill(i, data) for i in items])
+        difficulties = _to_array([data['difficulties'][i] for i in items])
+        return predict_simple_more_items(
+            skills - difficulties,
+            number_of_options=len(kwargs['options']) if 'options' in kwargs else 0,
+            guess=kwargs.get('guess')).tolist()
+
+    def predict_and_update_many(self, environment, answers, process_answers=False):
+        return self._predict_and_update_many_prefetched(environment, answers, process_answers)
+
+    def _prefetch_many(self, environment, answers):
+        items = list(set(a['item'] for a in answers))
+        parents = self._load_parents(environment, items, None)
+        all_items = list(set(items + [i for ps in parents.values() for (i, v) in ps]))
+        environment.read_more_items('difficulty', items=items)
+        for user in _items_per_user(answers):
+            environment.read_more_items('skill', items=all_items, user=user)
 
     def update_phase(self, environment, data, prediction, user, item, correct, time, answer_id, **kwargs):
         if data['last_times'][item] is None:
@@ -297,9 +375,10 @@ class AlwaysLearningPredictiveModel(PredictiveModel):
                 environment.write('skill', data['skills'][parent], item=parent, user=user, time=time, answer=answer_id)
 
     def _load_parents(self, environment, items, user):
+        structure = environment.item_structure()
         parents = {}
         while len(items) > 0:
-            found = environment.get_items_with_values_more_items('parent', items)
+            found = structure.get_parents_more_items(items)
             new_items = set()
             for i, ps in found.items():
                 new_items = new_items.union([x[0] for x in ps])
@@ -429,18 +508,53 @@ class PFAEStaircase(PredictiveModel):
             guess=kwargs.get('guess'))[0]
 
     def predict_phase_more_items(self, data, user, items, time, **kwargs):
-        preds = []
-        for i in items:
-            preds.append(self.predict_phase({
-                'prior_skill': data['prior_skill'],
-                'difficulties': data['difficulties'],
-                'current_skill': data['current_skills'][i],
-                'last_time': data['last_times'][i],
-                'item_first_answers': data['items_first_answers'][i],
-                'staircase': data['staircase'],
-                'parents': data['parents'][i],
-            }, user, i, time, **kwargs))
-        return preds
+        difficulties = data['difficulties']
+        item_difficulties = _to_array([difficulties[i] for i in items])
+        # weighted average of parents' difficulties, parents of all items are
+        # flattened to one array and summed per item
+        parent_positions, parent_difficulties, parent_weights = [], [], []
+        for position, i in enumerate(items):
+            for p, w in data['parents'][i].items():
+                parent_positions.append(position)
+                parent_difficulties.append(difficulties[p] * w)
+                parent_weights.append(w)
+        parent_positions = numpy.array(parent_positions, dtype=int)
+        total_parent_weights = numpy.bincount(parent_positions, weights=parent_weights, minlength=len(items))
+        has_parents = total_parent_weights > 0
+        parent_difficulty = numpy.bincount(parent_positions, weights=parent_difficulties, minlength=len(items))
+        parent_difficulty[has_parents] /= total_parent_weights[has_parents]
+        first_answers = _to_array([data['items_first_answers'][i] for i in items])
+        total_difficulty = numpy.where(
+            has_parents,
+            numpy.where(
+                first_answers == 0,
+                parent_difficulty,
+                (1 - self._parent_contribution) * item_difficulties + self._parent_contribution * parent_difficulty),
+            item_difficulties)
+        current_skills = _to_array([data['current_skills'][i] for i in items])
+        seconds_ago = _seconds_ago_more_items(time, [data['last_times'][i] for i in items], self._staircase[-1])
+        skills = numpy.where(
+            numpy.isnan(current_skills),
+            data['prior_skill'] - total_difficulty,
+            current_skills + self._get_shift_more_items(seconds_ago, data['staircase']))
+        return predict_simple_more_items(
+            skills,
+            number_of_options=len(kwargs['options']) if 'options' in kwargs else 0,
+            guess=kwargs.get('guess')).tolist()
+
+    def predict_and_update_many(self, environment, answers, process_answers=False):
+        return self._predict_and_update_many_prefetched(environment, answers, process_answers)
+
+    def _prefetch_many(self, environment, answers):
+        items = list(set(a['item'] for a in answers))
+        _, parent_ids = self._load_structure_for_items(environment, items)
+        environment.read_more_items('difficulty', items=items + parent_ids)
+        environment.read_more_items('number_of_difficulty_updates', items=parent_ids)
+        environment.read_more_keys(
+            ['staircase_val_{}'.format(i) for i in self._staircase] + ['staircase_count_{}'.format(i) for i in self._staircase])
+        for user, user_items in _items_per_user(answers).items():
+            environment.read('prior_skill', user=user)
+            environment.read_more_items('current_skill', user=user, items=user_items)
 
     def update_phase(self, environment, data, prediction, user, item, correct, time, answer_id, **kwargs):
         result = correct
@@ -462,29 +576,32 @@ class PFAEStaircase(PredictiveModel):
             current_skill = current_skill + self._pfae_good * diff
         else:
             current_skill = current_skill + self._pfae_bad * diff
-        environment.write('current_skill', current_skill, user=user, item=item, time=time, answer=answer_id)
+        writes = [{'key': 'current_skill', 'value': current_skill, 'user': user, 'item': item, 'time': time, 'answer': answer_id}]
         if data['use_prior']:
             alpha_fun = lambda n: self._elo_alpha / (1 + self._elo_dynamic_alpha * n)
             prior_skill_alpha = alpha_fun(data['user_first_answers'])
             difficulty_alpha = alpha_fun(data['item_first_answers'])
-            environment.write(
-                'prior_skill', data['prior_skill'] + prior_skill_alpha * diff,
-                user=user, time=time, answer=answer_id)
-            environment.write(
-                'difficulty', data['difficulties'][item] - difficulty_alpha * diff,
-                item=item, time=time, answer=answer_id)
+            writes.append({
+                'key': 'prior_skill', 'value': data['prior_skill'] + prior_skill_alpha * diff,
+                'user': user, 'time': time, 'answer': answer_id})
+            writes.append({
+                'key': 'difficulty', 'value': data['difficulties'][item] - difficulty_alpha * diff,
+                'item': item, 'time': time, 'answer': answer_id})
             for parent in data['parents']:
                 updates = data['parent_updates'][parent]
-                environment.write(
-                    'difficulty', data['difficulties'][parent] - alpha_fun(updates) * diff,
-                    item=parent, time=time, answer=answer_id, audit=False)
-                environment.update('number_of_difficulty_updates', 0, lambda x: x + 1, item=parent)
-
+                writes.append({
+                    'key': 'difficulty', 'value': data['difficulties'][parent] - alpha_fun(updates) * diff,
+                    'item': parent, 'time': time, 'answer': answer_id, 'audit': False})
+            environment.write_many(writes)
+            environment.update_many([
+                {'key': 'number_of_difficulty_updates', 'init_value': 0, 'update_fun': lambda x: x + 1, 'item': parent}
+                for parent in data['parents']
+            ])
         else:
             seconds_ago = _total_seconds_diff(time, data['last_time']) if data['last_time'] and time else self._staircase[-1]
-            self._update_shift(environment, seconds_ago, data['staircase'], diff)
+            environment.write_many(writes + self._update_shift(seconds_ago, data['staircase'], diff))
 
-    def _update_shift(self, environment, seconds_ago, staircase, diff):
+    def _update_shift(self, seconds_ago, staircase, diff):
         lower, upper, distance = self._get_staircase_bucket(seconds_ago)
         stored_lower = staircase[lower]
         stored_upper = staircase[upper]
@@ -492,22 +609,12 @@ class PFAEStaircase(PredictiveModel):
             stored_lower = (0, 0)
         if stored_upper is None:
             stored_upper = (0, 0)
-        environment.write(
-            'staircase_val_{}'.format(lower),
-            stored_lower[0] + diff * (1 - distance)
-        )
-        environment.write(
-            'staircase_count_{}'.format(lower),
-            stored_lower[1] + 1 - distance
-        )
-        environment.write(
-            'staircase_val_{}'.format(upper),
-            stored_upper[0] + diff * distance
-        )
-        environment.write(
-            'staircase_count_{}'.format(upper),
-            stored_upper[1] + distance
-        )
+        return [
+            {'key': 'staircase_val_{}'.format(lower), 'value': stored_lower[0] + diff * (1 - distance)},
+            {'key': 'staircase_count_{}'.format(lower), 'value': stored_lower[1] + 1 - distance},
+            {'key': 'staircase_val_{}'.format(upper), 'value': stored_upper[0] + diff * distance},
+            {'key': 'staircase_count_{}'.format(upper), 'value': stored_upper[1] + distance},
+        ]
 
     def _get_shift(self, seconds_ago, staircase):
         lower, upper, distance = self._get_staircase_bucket(seconds_ago)
@@ -523,6 +630,24 @@ class PFAEStaircase(PredictiveModel):
             distance * (0 if stored_upper[1] == 0 else stored_upper[0] / stored_upper[1]),
             4)
 
+    def _get_shift_more_items(self, seconds_ago, staircase):
+        """
+        The same as _get_shift, but for the array of seconds.
+        """
+        steps = numpy.array(self._staircase, dtype=float)
+        means = numpy.zeros(len(steps))
+        for position, step in enumerate(self._staircase):
+            stored = staircase[step]
+            if stored is not None and stored[1] != 0:
+                means[position] = stored[0] / stored[1]
+        seconds_ago = numpy.clip(seconds_ago, 0.01, steps[-1] - 1)
+        upper = numpy.searchsorted(steps, seconds_ago, side='right')
+        lower = upper - 1
+        lower_log = numpy.log(numpy.maximum(steps[lower], 1))
+        upper_log = numpy.log(steps[upper])
+        distance = (numpy.log(seconds_ago) - lower_log) / (upper_log - lower_log)
+        return numpy.round((1 - distance) * means[lower] + distance * means[upper], 4)
+
     def _get_staircase_bucket(self, seconds_ago):
         seconds_ago = max(0.01, min(self._staircase[-1] - 1, seconds_ago))
         lower = max([mod for mod in self._staircase if mod <= seconds_ago])
@@ -534,35 +659,105 @@ class PFAEStaircase(PredictiveModel):
         return lower, upper, distance
 
     def _load_structure_for_items(self, environment, item_ids):
+        structure = environment.item_structure()
         parents = {}
         parent_ids = set()
-        for item_id in item_ids:
-            item_parents = self._load_parents(environment, item_id)
-            parents[item_id] = item_parents
-            parent_ids |= set(item_parents.keys())
+        for item_id, item_parents in structure.get_parents_more_items(item_ids).items():
+            parents[item_id] = {p: 1 / (structure.number_of_children(p) + 1) for p, _ in item_parents}
+            parent_ids |= set(parents[item_id].keys())
         return parents, list(parent_ids)
 
     def _load_children(self, environment, item_id):
-        return self._get_structure(environment)[1].get(item_id, {})
+        structure = environment.item_structure()
+        return {c: 1 / (structure.number_of_parents(c) + 1) for c, _ in structure.get_children(item_id)}
 
     def _load_parents(self, environment, item_id):
-        return self._get_structure(environment)[0].get(item_id, {})
+        structure = environment.item_structure()
+        return {p: 1 / (structure.number_of_children(p) + 1) for p, _ in structure.get_parents(item_id)}
+
+
+class _WriteBackEnvironment:
+
+    """
+    Wrapper of the environment keeping all read and written variables in the
+    local dictionary. The writes are written back to the wrapped environment
+    at once by the write_back method, other methods are delegated to the
+    wrapped environment.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, environment):
+        self._environment = environment
+        # (key, user, item_primary, item_secondary) -> value
+        self._values = {}
+        self._writes = []
+
+    def __getattr__(self, name):
+        return getattr(self._environment, name)
+
+    def read(self, key, user=None, item=None, item_secondary=None, default=None, symmetric=True):
+        data_key = _data_key(key, user, item, item_secondary, symmetric)
+        value = self._values.get(data_key, self._MISSING)
+        if value is self._MISSING:
+            value = self._environment.read(key, user=user, item=item, item_secondary=item_secondary, symmetric=symmetric)
+            self._values[data_key] = value
+        return default if value is None else value
+
+    def read_more_items(self, key, items, user=None, item=None, default=None, symmetric=True):
+        data_keys = {i: _data_key(key, user, i, item, symmetric) for i in items}
+        to_find = [i for i, data_key in data_keys.items() if data_key not in self._values]
+        if len(to_find) > 0:
+            found = self._environment.read_more_items(key, to_find, user=user, item=item, symmetric=symmetric)
+            for i in to_find:
+                self._values[data_keys[i]] = found.get(i)
+        result = {}
+        for i, data_key in data_keys.items():
+            value = self._values[data_key]
+            result[i] = default if value is None else value
+        return result
+
+    def read_more_keys(self, keys, user=None, item=None, item_secondary=None, default=None, symmetric=True):
+        data_keys = {k: _data_key(k, user, item, item_secondary, symmetric) for k in keys}
+        to_find = [k for k, data_key in data_keys.items() if data_key not in self._values]
+        if len(to_find) > 0:
+            found = self._environment.read_more_keys(to_find, user=user, item=item, item_secondary=item_secondary, symmetric=symmetric)
+            for k in to_find:
+                self._values[data_keys[k]] = found.get(k)
+        result = {}
+        for k, data_key in data_keys.items():
+            value = self._values[data_key]
+            result[k] = default if value is None else value
+        return result
+
+    def write(self, key, value, user=None, item=None, item_secondary=None, time=None, audit=True, symmetric=True, permanent=False, answer=None):
+        if value is None:
+            raise Exception('Value has to be specified')
+        self._values[_data_key(key, user, item, item_secondary, symmetric)] = value
+        self._writes.append({
+            'key': key, 'value': value, 'user': user, 'item': item, 'item_secondary': item_secondary,
+            'time': time, 'audit': audit, 'symmetric': symmetric, 'permanent': permanent, 'answer': answer,
+        })
+
+    def write_many(self, writes):
+        for write in writes:
+            self.write(**write)
 
-    def _get_structure(self, environment):
-        if not hasattr(self, '_structure'):
-            self._structure = self._prepare_structure(environment)
-        return self._structure
+    def update(self, key, init_value, update_fun, user=None, item=None, item_secondary=None, time=None, audit=True, symmetric=True, answer=None):
+        value = self.read(
+            key, user=user, item=item, item_secondary=item_secondary, default=init_value, symmetric=symmetric)
+        self.write(
+            key, update_fun(value), user=user,
+            item=item, item_secondary=item_secondary, time=time, audit=audit, symmetric=symmetric, answer=answer)
 
-    @cache_pure()
-    def _prepare_structure(self, environment):
-        parents = defaultdict(lambda: [])
-        children = defaultdict(lambda: [])
-        for _, child, parent, value in environment.read_all_with_key('parent'):
-            parents[child].append((parent, value))
-            children[parent].append((child, value))
-        parents = {c: {p: 1 / (len(children[p]) + 1) for p, _ in ps} for c, ps in parents.items()}
-        children = {p: {c: 1 / (len(parents[c]) + 1) for c, _ in cs} for p, cs in children.items()}
-        return parents, children
+    def update_many(self, updates):
+        for update in updates:
+            self.update(**update)
+
+    def write_back(self):
+        writes, self._writes = self._writes, []
+        if len(writes) > 0:
+            self._environment.write_many(writes)
 
 
 def predict_simple(skill_asked, number_of_options=None, guess=None):
@@ -575,9 +770,28 @@ def predict_simple(skill_asked, number_of_options=None, guess=None):
     return (guess + (1 - guess) * _sigmoid(skill_asked), [])
 
 
+def predict_simple_more_items(skills_asked, number_of_options=None, guess=None):
+    """
+    The same as predict_simple, but for the array of skills and without
+    probabilities for options.
+
+    Returns:
+        numpy.ndarray: probabilities of the correct answers
+    """
+    if guess is None and number_of_options is None:
+        raise Exception('Either guess parameter or number of options has to be specified.')
+    if guess is None:
+        guess = 0.0
+        if number_of_options:
+            guess = 1.0 / number_of_options
+    return guess + (1 - guess) * _sigmoid_more_items(skills_asked)
+
+
 def predict(skill_asked, option_skills):
     """
-    Returns the probability of correct answer.
+    Returns the probability of correct answer. The user answers correctly
+    when they know the asked item, otherwise they choose uniformly at random
+    among the asked item and the options they do not know.
 
     Args:
         skill_asked (float):
@@ -595,38 +809,149 @@ def predict(skill_asked, option_skills):
 
     if len(option_skills) == 0:
         return (_sigmoid(skill_asked), [])
-
-    probs = [_sigmoid(x) for x in [skill_asked] + option_skills]
-    items = 2 ** len(probs)
-    asked_prob = 0
-    opt_wrong_probs = [0 for i in option_skills]
-
-    for i in range(items):
-        knows = _to_binary_reverse_list(i, len(probs))
-        guess_options = 1 if knows[0] else sum([1 - x for x in knows])
-        current_prob = reduce(
-            operator.mul,
-            [p_k[0] if p_k[1] else 1 - p_k[0] for p_k in zip(probs, knows)],
-            1)
-        asked_prob += (1.0 / guess_options) * current_prob
-        if guess_options > 1:
-            for j in range(0, len(option_skills)):
-                if knows[j + 1]:
-                    continue
-                opt_wrong_probs[j] += 1.0 / guess_options * current_prob
+    asked_unknown = 1 - _sigmoid(skill_asked)
+    options_unknown = [1 - _sigmoid(x) for x in option_skills]
+    # distribution[k]: probability that exactly k options are unknown
+    distribution = [1.0]
+    for unknown in options_unknown:
+        distribution = _add_option(distribution, unknown)
+    asked_prob = 1 - asked_unknown + asked_unknown * sum(p / (k + 1) for k, p in enumerate(distribution))
+    opt_wrong_probs = []
+    for unknown in options_unknown:
+        others = _remove_option(distribution, unknown)
+        opt_wrong_probs.append(asked_unknown * unknown * sum(p / (k + 2) for k, p in enumerate(others)))
     return (asked_prob, opt_wrong_probs)
 
 
+def predict_more_questions(skills_asked, option_skills):
+    """
+    The same as predict, but for more questions at once.
+
+    Args:
+        skills_asked (numpy.ndarray):
+            skills for the asked items, shape (questions,)
+        option_skills (numpy.ndarray):
+            skills for the options, shape (questions, options), questions
+            with fewer options are padded by NaN
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray):
+            probabilities of the correct answers, shape (questions,), and
+            probabilities of the options being answered instead of the asked
+            items, shape (questions, options), zero for padding
+    """
+    asked_unknown = 1 - _sigmoid_more_items(skills_asked)
+    option_skills = numpy.asarray(option_skills, dtype=float).reshape(len(asked_unknown), -1)
+    options_unknown = numpy.where(numpy.isnan(option_skills), 0.0, 1 - _sigmoid_more_items(option_skills))
+    questions, options = options_unknown.shape
+    distribution = numpy.zeros((questions, options + 1))
+    distribution[:, 0] = 1
+    for j in range(options):
+        distribution = _add_option(distribution, options_unknown[:, j])
+    asked_prob = 1 - asked_unknown + asked_unknown * distribution.dot(1.0 / numpy.arange(1, options + 2))
+    # without options, the user can't guess (see predict)
+    asked_prob = numpy.where(numpy.isnan(option_skills).all(axis=1), 1 - asked_unknown, asked_prob)
+    opt_wrong_probs = numpy.zeros((questions, options))
+    weights = 1.0 / numpy.arange(2, options + 2)
+    for j in range(options):
+        others = _remove_option(distribution, options_unknown[:, j])
+        opt_wrong_probs[:, j] = asked_unknown * options_unknown[:, j] * others.dot(weights)
+    return asked_prob, opt_wrong_probs
+
+
+def _add_option(distribution, unknown):
+    """
+    Given the distribution of the number of unknown options (the last axis),
+    returns the distribution with one more option which is unknown with the
+    given probability. Works for lists as well as for arrays of distributions.
+    """
+    if isinstance(distribution, list):
+        return [
+            (distribution[k] if k < len(distribution) else 0) * (1 - unknown) +
+            (distribution[k - 1] * unknown if k > 0 else 0)
+            for k in range(len(distribution) + 1)
+        ]
+    unknown = unknown[:, None]
+    result = distribution * (1 - unknown)
+    result[:, 1:] += distribution[:, :-1] * unknown
+    return result
+
+
+def _remove_option(distribution, unknown):
+    """
+    Inverse to _add_option. To keep the division numerically stable, the
+    distribution is reconstructed from the side where the divisor is at
+    least 0.5.
+    """
+    if isinstance(distribution, list):
+        n = len(distribution) - 1
+        result = [0.0] * n
+        if unknown <= 0.5:
+            for k in range(n):
+                result[k] = (distribution[k] - (result[k - 1] * unknown if k > 0 else 0)) / (1 - unknown)
+        else:
+            for k in reversed(range(n)):
+                result[k] = (distribution[k + 1] - (result[k + 1] * (1 - unknown) if k < n - 1 else 0)) / unknown
+        return result
+    questions, n = distribution.shape[0], distribution.shape[1] - 1
+    from_low = numpy.zeros((questions, n))
+    from_high = numpy.zeros((questions, n))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        for k in range(n):
+            from_low[:, k] = (distribution[:, k] - (from_low[:, k - 1] * unknown if k > 0 else 0)) / (1 - unknown)
+        for k in reversed(range(n)):
+            from_high[:, k] = (distribution[:, k + 1] - (from_high[:, k + 1] * (1 - unknown) if k < n - 1 else 0)) / unknown
+    return numpy.where((unknown <= 0.5)[:, None], from_low, from_high)
+
+
 def _sigmoid(x):
     return 1.0 / (1 + exp(-x))
 
 
-def _to_binary_reverse_list(number, length):
-    binary = []
-    for j in range(length):
-        binary.append(number % 2)
-        number = number / 2
-    return binary
+def _sigmoid_more_items(xs):
+    with numpy.errstate(over='ignore'):
+        return 1.0 / (1 + numpy.exp(-numpy.asarray(xs, dtype=float)))
+
+
+def _to_array(values):
+    """
+    Float array where None values are replaced by NaN.
+    """
+    return numpy.array([numpy.nan if v is None else v for v in values], dtype=float)
+
+
+def _seconds_ago_more_items(time, last_times, default):
+    return numpy.array([
+        _total_seconds_diff(time, last_time) if last_time and time else default
+        for last_time in last_times
+    ], dtype=float)
+
+
+def _data_key(key, user, item, item_secondary, symmetric):
+    items = [item_secondary, item]
+    if symmetric and item is not None and item_secondary is not None:
+        items.sort()
+    return key, user, items[1], items[0]
+
+
+def _items_per_user(answers):
+    result = defaultdict(set)
+    for answer in answers:
+        result[answer['user']].add(answer['item'])
+    return {user: list(items) for user, items in result.items()}
+
+
+def _process_answer(environment, answer):
+    environment.process_answer(
+        answer['user'],
+        answer['item'],
+        answer.get('item_asked', answer['item']),
+        answer.get('item_answered'),
+        answer['time'],
+        answer.get('answer_id'),
+        answer.get('response_time'),
+        answer.get('guess'),
+    )
 
 
 def _total_seconds_diff(a, b):
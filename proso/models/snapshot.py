@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Binary columnar snapshots of in-memory environments.
+
+The snapshot file consists of a magic string, the length of a JSON header,
+the header itself and fixed-width columns aligned to 8 bytes. The header
+contains the interned table of keys, optional meta information and offsets
+of the columns, so the columns can be memory-mapped without any parsing.
+"""
+import json
+import mmap
+import numpy
+import struct
+
+
+MAGIC = b'PROSOENV'
+VERSION = 1
+NONE_ID = -1
+
+VALUE_COLUMNS = [
+    ('key', 'int32'),
+    ('user', 'int64'),
+    ('item_primary', 'int64'),
+    ('item_secondary', 'int64'),
+    ('permanent', 'bool'),
+    ('time', 'datetime64[us]'),
+    ('answer', 'int64'),
+    ('value', 'float64'),
+]
+
+AUDIT_COLUMNS = [
+    ('key', 'int32'),
+    ('user', 'int64'),
+    ('item_primary', 'int64'),
+    ('item_secondary', 'int64'),
+    ('time', 'datetime64[us]'),
+    ('answer', 'int64'),
+    ('value', 'float64'),
+]
+
+
+def save_snapshot(path, values, audit, meta=None):
+    """
+    Save the given variables to the binary snapshot file.
+
+    Args:
+        path (str): path to the snapshot file
+        values (iterable): (key, user, item_primary, item_secondary,
+            permanent, time, answer, value) tuples
+        audit (iterable): (key, user, item_primary, item_secondary, time,
+            answer, value) tuples
+        meta (dict): JSON serializable information stored with the snapshot
+    """
+    keys = {}
+    tables = {
+        'values': _to_columns(values, VALUE_COLUMNS, keys),
+        'audit': _to_columns(audit, AUDIT_COLUMNS, keys),
+    }
+    header = {
+        'version': VERSION,
+        'keys': [k for k, _ in sorted(keys.items(), key=lambda k_i: k_i[1])],
+        'meta': {} if meta is None else meta,
+        'tables': {},
+    }
+    offset = 0
+    for table_name, (size, columns) in tables.items():
+        header['tables'][table_name] = {'size': size, 'columns': []}
+        for name, dtype, array in columns:
+            header['tables'][table_name]['columns'].append([name, dtype, offset])
+            offset += _aligned(array.nbytes)
+    header_bytes = json.dumps(header).encode()
+    data_start = _aligned(len(MAGIC) + 8 + len(header_bytes))
+    with open(path, 'wb') as snapshot_file:
+        snapshot_file.write(MAGIC)
+        snapshot_file.write(struct.pack('<Q', len(header_bytes)))
+        snapshot_file.write(header_bytes)
+        snapshot_file.write(b'\0' * (data_start - len(MAGIC) - 8 - len(header_bytes)))
+        for table_name, (size, columns) in tables.items():
+            for name, dtype, array in columns:
+                snapshot_file.write(array.tobytes())
+                snapshot_file.write(b'\0' * (_aligned(array.nbytes) - array.nbytes))
+
+
+def load_snapshot(path):
+    """
+    Memory-map the given snapshot file.
+
+    Returns:
+        (list, dict, dict): table of keys, meta information and
+        table name -> column name -> read-only numpy array
+    """
+    with open(path, 'rb') as snapshot_file:
+        mapped = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[:len(MAGIC)] != MAGIC:
+        raise Exception('The file {} is not an environment snapshot.'.format(path))
+    header_length = struct.unpack('<Q', mapped[len(MAGIC):len(MAGIC) + 8])[0]
+    header = json.loads(mapped[len(MAGIC) + 8:len(MAGIC) + 8 + header_length].decode())
+    if header['version'] != VERSION:
+        raise Exception('Unsupported version {} of the environment snapshot.'.format(header['version']))
+    data_start = _aligned(len(MAGIC) + 8 + header_length)
+    tables = {}
+    for table_name, table in header['tables'].items():
+        tables[table_name] = {
+            name: numpy.frombuffer(mapped, dtype=dtype, count=table['size'], offset=data_start + offset)
+            for name, dtype, offset in table['columns']
+        }
+    return header['keys'], header['meta'], tables
+
+
+def iterate_snapshot_table(keys, table, columns):
+    """
+    Convert the memory-mapped columns back to Python tuples, the first
+    column is always translated to keys and identifier columns to None if
+    they are not specified.
+    """
+    converted = []
+    for name, dtype in columns:
+        column = table[name].tolist()
+        if name == 'key':
+            column = [keys[k] for k in column]
+        elif dtype == 'int64':
+            column = [None if x == NONE_ID else x for x in column]
+        converted.append(column)
+    return zip(*converted)
+
+
+def _to_columns(rows, columns, keys):
+    rows = list(rows)
+    result = []
+    for i, (name, dtype) in enumerate(columns):
+        if name == 'key':
+            data = [keys.setdefault(row[i], len(keys)) for row in rows]
+        elif dtype == 'int64':
+            data = [NONE_ID if row[i] is None else row[i] for row in rows]
+        else:
+            data = [row[i] for row in rows]
+        result.append((name, dtype, numpy.array(data, dtype=dtype)))
+    return len(rows), result
+
+
+def _aligned(size):
+    return (size + 7) // 8 * 8
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled structure of items: parent and child relations stored in the CSR
+format. The structure is immutable, so it can be shared by all threads of
+the process; changes produce a new structure.
+"""
+import numpy
+
+
+class ItemStructure:
+
+    def __init__(self, items, parent_indptr, parent_indices, parent_values, child_indptr, child_indices, child_values):
+        """
+        Args:
+            items (numpy.ndarray): sorted identifiers of items (rows and
+                columns are positions in this array)
+            parent_indptr, parent_indices, parent_values (numpy.ndarray): CSR
+                arrays of parents, the row is the child
+            child_indptr, child_indices, child_values (numpy.ndarray): CSR
+                arrays of children, the row is the parent
+        """
+        self.items = items
+        self.parent_indptr = parent_indptr
+        self.parent_indices = parent_indices
+        self.parent_values = parent_values
+        self.child_indptr = child_indptr
+        self.child_indices = child_indices
+        self.child_values = child_values
+
+    @staticmethod
+    def from_relations(children, parents, values):
+        """
+        Build the structure from the (child, parent, value) triples given as
+        three arrays, e.g., from the 'parent' variables of the environment.
+        """
+        children = numpy.asarray(children, dtype='int64')
+        parents = numpy.asarray(parents, dtype='int64')
+        values = numpy.asarray(values, dtype='float64')
+        items = numpy.unique(numpy.concatenate([children, parents]))
+        child_positions = numpy.searchsorted(items, children)
+        parent_positions = numpy.searchsorted(items, parents)
+        parent_indptr, parent_indices, parent_values = _csr(len(items), child_positions, parent_positions, values)
+        child_indptr, child_indices, child_values = _csr(len(items), parent_positions, child_positions, values)
+        return ItemStructure(items, parent_indptr, parent_indices, parent_values, child_indptr, child_indices, child_values)
+
+    @staticmethod
+    def from_environment(environment):
+        relations = [(child, parent, value) for user, child, parent, value in environment.read_all_with_key('parent') if user is None]
+        return ItemStructure.from_relations(
+            [child for child, _, _ in relations],
+            [parent for _, parent, _ in relations],
+            [value for _, _, value in relations])
+
+    def to_relations(self):
+        """
+        Returns:
+            (numpy.ndarray, numpy.ndarray, numpy.ndarray): children, parents
+            and values
+        """
+        rows = numpy.repeat(numpy.arange(len(self.items)), numpy.diff(self.parent_indptr))
+        return self.items[rows], self.items[self.parent_indices], self.parent_values
+
+    def update(self, child, parent, value=None):
+        """
+        Returns:
+            ItemStructure: a new structure where the relation between the
+            given child and parent is replaced by the given value, or removed
+            if the value is None
+        """
+        return self.update_many([(child, parent, value)])
+
+    def update_many(self, changes):
+        """
+        Apply all the changes at once, so the structure is built only once.
+
+        Args:
+            changes (list): (child, parent, value) triples applied in the
+                given order, the relation is removed if the value is None
+
+        Returns:
+            ItemStructure: a new structure with the given changes
+        """
+        if len(changes) == 0:
+            return self
+        changed = {}
+        for child, parent, value in changes:
+            changed[child, parent] = value
+        children, parents, values = self.to_relations()
+        keep = ~numpy.isin(children, [child for child, _ in changed])
+        for position in numpy.nonzero(~keep)[0].tolist():
+            keep[position] = (children[position].item(), parents[position].item()) not in changed
+        added = [(child, parent, value) for (child, parent), value in changed.items() if value is not None]
+        return ItemStructure.from_relations(
+            numpy.concatenate([children[keep], numpy.array([child for child, _, _ in added], dtype='int64')]),
+            numpy.concatenate([parents[keep], numpy.array([parent for _, parent, _ in added], dtype='int64')]),
+            numpy.concatenate([values[keep], numpy.array([value for _, _, value in added], dtype='float64')]))
+
+    def get_parents(self, item):
+        """
+        Returns:
+            list: (parent, value) pairs of the given item
+        """
+        return self.get_parents_more_items([item])[item]
+
+    def get_parents_more_items(self, items):
+        return self._get_more_items(items, self.parent_indptr, self.parent_indices, self.parent_values)
+
+    def get_children(self, item):
+        """
+        Returns:
+            list: (child, value) pairs of the given item
+        """
+        return self.get_children_more_items([item])[item]
+
+    def get_children_more_items(self, items):
+        return self._get_more_items(items, self.child_indptr, self.child_indices, self.child_values)
+
+    def number_of_parents(self, item):
+        position = self._position(item)
+        return 0 if position is None else int(self.parent_indptr[position + 1] - self.parent_indptr[position])
+
+    def number_of_children(self, item):
+        position = self._position(item)
+        return 0 if position is None else int(self.child_indptr[position + 1] - self.child_indptr[position])
+
+    def _position(self, item):
+        position = numpy.searchsorted(self.items, item)
+        if position == len(self.items) or self.items[position] != item:
+            return None
+        return position
+
+    def _get_more_items(self, items, indptr, indices, values):
+        items = list(items)
+        result = {}
+        if len(items) == 0:
+            return result
+        positions = numpy.searchsorted(self.items, items).tolist()
+        for item, position in zip(items, positions):
+            if position == len(self.items) or self.items[position] != item:
+                result[item] = []
+                continue
+            start, stop = indptr[position], indptr[position + 1]
+            result[item] = list(zip(self.items[indices[start:stop]].tolist(), values[start:stop].tolist()))
+        return result
+
+
+def _csr(size, rows, columns, values):
+    order = numpy.lexsort((columns, rows))
+    rows, columns, values = rows[order], columns[order], values[order]
+    indptr = numpy.zeros(size + 1, dtype='int64')
+    numpy.cumsum(numpy.bincount(rows, minlength=size), out=indptr[1:])
+    return indptr, columns.astype('int32'), values
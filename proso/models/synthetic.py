@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Generator of synthetic data for benchmarks and offline experiments: a two
+level hierarchy of items, users with latent skills and a stream of answers
+(with options and response times) simulated from them. The answers are
+generated in chunks, so the size of the stream is not limited by memory.
+"""
+from proso.models.evaluation import ANSWER_DTYPE
+import datetime
+import numpy
+
+
+class SyntheticData:
+
+    def __init__(self, number_of_items=1000, number_of_users=1000, number_of_parents=20, max_options=6, seed=None):
+        """
+        Args:
+            number_of_items (int): number of practiced items, their
+                identifiers are 1, ..., number_of_items
+            number_of_users (int): number of users, their identifiers are 1,
+                ..., number_of_users
+            number_of_parents (int): number of parents, each practiced item
+                has exactly one of them, their identifiers follow the
+                practiced items
+            max_options (int): maximal number of options of a question
+                including the asked item, questions with no options are
+                open
+            seed (int): seed making the generated data reproducible
+        """
+        if number_of_parents < 1 or number_of_parents > number_of_items:
+            raise ValueError('The number of parents has to be between 1 and the number of items.')
+        self.number_of_items = number_of_items
+        self.number_of_users = number_of_users
+        self.number_of_parents = number_of_parents
+        self.max_options = max_options
+        self.seed = seed
+        random = numpy.random.RandomState(seed)
+        self.items = numpy.arange(1, number_of_items + 1)
+        self.parents = numpy.arange(number_of_items + 1, number_of_items + number_of_parents + 1)
+        self.users = numpy.arange(1, number_of_users + 1)
+        # practiced items are split into contiguous blocks, one per parent
+        self._parent_positions = numpy.arange(number_of_items) * number_of_parents // number_of_items
+        self._block_start = numpy.searchsorted(self._parent_positions, numpy.arange(number_of_parents))
+        self._block_size = numpy.diff(numpy.append(self._block_start, number_of_items))
+        self.difficulties = random.normal(0, 1, number_of_items)
+        self.skills = random.normal(0, 1, number_of_users)
+        self.parent_skills = random.normal(0, 0.5, number_of_parents)
+
+    def relations(self):
+        """
+        Returns:
+            list: (child, parent, value) triples of the hierarchy
+        """
+        return list(zip(self.items.tolist(), self.parents[self._parent_positions].tolist(), [1] * self.number_of_items))
+
+    def parent(self, item):
+        return int(self.parents[self._parent_positions[item - 1]])
+
+    def siblings(self, item):
+        """
+        Returns:
+            list: items with the same parent as the given one (including it)
+        """
+        position = self._parent_positions[item - 1]
+        start = self._block_start[position]
+        return self.items[start:start + self._block_size[position]].tolist()
+
+    def answers(self, number_of_answers, chunk_size=100000, start_time=datetime.datetime(2016, 1, 1)):
+        """
+        Simulate the given number of answers. The user knows the asked item
+        with probability given by the sigmoid of the user's skill, the skill
+        for the parent of the item and the difficulty of the item. Otherwise
+        the user guesses from the options or answers a sibling of the item.
+
+        Returns:
+            generator: structured arrays with ANSWER_DTYPE, each with at most
+            chunk_size answers, ordered by identifiers and time
+        """
+        random = numpy.random.RandomState(self.seed)
+        time = numpy.datetime64(start_time, 'us')
+        generated = 0
+        while generated < number_of_answers:
+            size = min(chunk_size, number_of_answers - generated)
+            answers = numpy.empty(size, dtype=ANSWER_DTYPE)
+            answers['id'] = numpy.arange(generated + 1, generated + size + 1)
+            users = random.randint(0, self.number_of_users, size)
+            items = random.randint(0, self.number_of_items, size)
+            parents = self._parent_positions[items]
+            options = random.randint(0, self.max_options + 1, size)
+            options[options == 1] = 0
+            options = numpy.minimum(options, self._block_size[parents])
+            options[options == 1] = 0
+            guess = numpy.where(options > 0, 1.0 / numpy.maximum(options, 1), 0.0)
+            knows = random.random_sample(size) < _sigmoid(self.skills[users] + self.parent_skills[parents] - self.difficulties[items])
+            guessed = random.random_sample(size) < guess
+            correct = knows | guessed
+            offsets = random.randint(1, numpy.maximum(self._block_size[parents], 2))
+            siblings = self._block_start[parents] + (items - self._block_start[parents] + offsets) % self._block_size[parents]
+            no_answer = (options == 0) & (random.random_sample(size) < 0.5)
+            answered = numpy.where(correct, items, numpy.where(no_answer | (siblings == items), -1, siblings))
+            answers['user'] = self.users[users]
+            answers['item'] = self.items[items]
+            answers['item_asked'] = self.items[items]
+            answers['item_answered'] = numpy.where(answered == -1, -1, answered + 1)
+            answers['guess'] = guess
+            answers['response_time'] = numpy.exp(random.normal(8, 0.7, size)).astype('int64')
+            gaps = random.exponential(10 ** 7, size).astype('int64') + 1
+            answers['time'] = time + numpy.cumsum(gaps).astype('timedelta64[us]')
+            time = answers['time'][-1]
+            generated += size
+            yield answers
+
+
+def _sigmoid(x):
+    return 1.0 / (1 + numpy.exp(-x))
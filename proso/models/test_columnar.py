@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from . import columnar
+from .snapshot import VALUE_COLUMNS
+import datetime
+import struct
+import unittest
+
+
+def _decode_copy_binary(encoded):
+    rows = []
+    position = 0
+    while position < len(encoded):
+        count = struct.unpack('>h', encoded[position:position + 2])[0]
+        position += 2
+        row = []
+        for _ in range(count):
+            length = struct.unpack('>i', encoded[position:position + 4])[0]
+            position += 4
+            if length == -1:
+                row.append(None)
+            else:
+                row.append(encoded[position:position + length])
+                position += length
+        rows.append(tuple(row))
+    return rows
+
+
+class ColumnarTest(unittest.TestCase):
+
+    ROWS = [
+        ('key', 1, 2, None, False, datetime.datetime(2016, 1, 1, 10), 5, 0.5),
+        ('other_key', None, 3, 2, True, datetime.datetime(2000, 1, 1), None, 1.0),
+        ('key', 2, None, None, False, datetime.datetime(2016, 1, 1, 11), None, 2.5),
+    ]
+
+    def test_to_structured_array(self):
+        array = columnar.to_structured_array(self.ROWS, VALUE_COLUMNS)
+        self.assertEqual([b'key', b'other_key', b'key'], list(array['key']))
+        self.assertEqual([1, -1, 2], list(array['user']))
+        self.assertEqual([0.5, 1.0, 2.5], list(array['value']))
+        chunks = list(columnar.iterate_structured_arrays(iter(self.ROWS), VALUE_COLUMNS, chunk_size=2))
+        self.assertEqual([2, 1], [len(chunk) for chunk in chunks])
+
+    def test_encode_copy_binary(self):
+        array = columnar.to_structured_array(self.ROWS, VALUE_COLUMNS)
+        encoded = columnar.encode_copy_binary([
+            ('text', array['key']),
+            ('int4', array['user']),
+            ('int4', array['item_secondary']),
+            ('float8', array['value']),
+            ('timestamp', array['time']),
+            ('bool', array['permanent']),
+            ('int4', 7),
+            ('int4', None),
+        ])
+        expected = [
+            (b'key', struct.pack('>i', 1), None, struct.pack('>d', 0.5), struct.pack('>q', 504957600000000), b'\x00', struct.pack('>i', 7), None),
+            (b'other_key', None, struct.pack('>i', 2), struct.pack('>d', 1.0), struct.pack('>q', 0), b'\x01', struct.pack('>i', 7), None),
+            (b'key', struct.pack('>i', 2), None, struct.pack('>d', 2.5), struct.pack('>q', 504961200000000), b'\x00', struct.pack('>i', 7), None),
+        ]
+        self.assertEqual(sorted(expected, key=str), sorted(_decode_copy_binary(encoded), key=str))
+        self.assertEqual(b'', columnar.encode_copy_binary([('int4', array['user'][:0])]))
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from .confusion import ConfusionMatrix
+import tempfile
+import unittest
+
+
+class ConfusionMatrixTest(unittest.TestCase):
+
+    def test_get_more_items(self):
+        matrix = ConfusionMatrix.from_counts([1, 1, 2, 1], [2, 3, 1, 2], [1, 2, 5, 3])
+        self.assertEqual([4, 2, 0], matrix.get_more_items(1, [2, 3, 4]))
+        self.assertEqual([5, 0], matrix.get_more_items(2, [1, 3]))
+        self.assertEqual([0], matrix.get_more_items(3, [1]))
+        self.assertEqual([0], matrix.get_more_items(7, [1]))
+
+    def test_merge_and_save(self):
+        matrix = ConfusionMatrix.from_counts([1], [2], [1], meta={'answer': 10})
+        merged = matrix.merge([1, 5], [2, 1], [2, 1], meta={'answer': 12})
+        with tempfile.NamedTemporaryFile(suffix='.bin') as matrix_file:
+            merged.save(matrix_file.name)
+            loaded = ConfusionMatrix.load(matrix_file.name)
+        self.assertEqual({'answer': 12}, loaded.meta)
+        self.assertEqual([3, 0], loaded.get_more_items(1, [2, 5]))
+        self.assertEqual([1], loaded.get_more_items(5, [1]))
+
+    def test_empty(self):
+        matrix = ConfusionMatrix.from_counts([], [], [])
+        self.assertEqual([0, 0], matrix.get_more_items(1, [2, 3]))
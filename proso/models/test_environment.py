@@ -1,5 +1,13 @@
 #  -*- coding: utf-8 -*-
 from . import environment as environment
+from . import prediction as prediction
+import datetime
+import numpy
+import os
+import random
+import tempfile
+import threading
+import unittest
 
 
 class InMemoryEnvironmentTest(environment.TestCommonEnvironment):
@@ -20,5 +28,182 @@ class InMemoryEnvironmentTest(environment.TestCommonEnvironment):
         self._answer += 1
         return self._answer
 
-    def generate_environment(self):
-        return environment.InMemoryEnvironment()
+    def generate_environment(self, **kwargs):
+        return environment.InMemoryEnvironment(**kwargs)
+
+    def test_audit_retention_last_values(self):
+        env = self.generate_environment(audit_retention={'key': 5, environment.InMemoryEnvironment.LAST_CORRECTNESS: 10})
+        for value in range(100):
+            env.write('key', value)
+            env.write('other', value)
+        self.assertEqual([99.0, 98.0, 97.0, 96.0, 95.0], [v for t, v in env.audit('key')])
+        self.assertEqual([99.0, 98.0], [v for t, v in env.audit('key', limit=2)])
+        self.assertEqual(100, len(env.audit('other')))
+        user = self.generate_user()
+        item = self.generate_item()
+        for i in range(30):
+            env.process_answer(user, item, item, item if i >= 20 else None, None, self.generate_answer_id(), 1000, 0)
+        self.assertEqual(1.0, env.rolling_success(user))
+
+    def test_snapshot(self):
+        env = self.generate_environment()
+        users = [self.generate_user() for i in range(3)]
+        items = [self.generate_item() for i in range(5)]
+        for u in users:
+            for i in items:
+                env.process_answer(u, i, i, i if u % 2 else None, datetime.datetime(2016, 1, u, i), self.generate_answer_id(), 1000, 0)
+        env.write('parent', 1, item=items[0], item_secondary=items[1], symmetric=False, permanent=True)
+        with tempfile.NamedTemporaryFile(suffix='.snapshot') as snapshot_file:
+            env.snapshot(snapshot_file.name, meta={'processed': 15})
+            restored = self.generate_environment()
+            self.assertEqual({'processed': 15}, restored.restore(snapshot_file.name))
+        self.assertEqual(sorted(env.export_values(), key=str), sorted(restored.export_values(), key=str))
+        self.assertEqual(sorted(env.export_audit(), key=str), sorted(restored.export_audit(), key=str))
+        self.assertEqual(env.audit('number_of_answers'), restored.audit('number_of_answers'))
+        self.assertEqual(env.rolling_success(users[0], window_size=5), restored.rolling_success(users[0], window_size=5))
+        with self.assertRaises(Exception):
+            restored.restore(snapshot_file.name)
+
+    def test_rolling_success_without_audit(self):
+        env = self.generate_environment(audit_enabled=False)
+        user = self.generate_user()
+        item = self.generate_item()
+        for i in range(100):
+            env.process_answer(user, item, item, item if i % 4 else None, None, self.generate_answer_id(), 1000, 0)
+        self.assertEqual(0.75, env.rolling_success(user, window_size=20))
+        self.assertEqual(0.75, env.rolling_success(user, window_size=64))
+        with self.assertRaises(Exception):
+            env.rolling_success(user, window_size=65)
+
+    def test_audit_retention_none(self):
+        env = self.generate_environment(audit_retention={'key': 'none'})
+        for value in range(10):
+            env.write('key', value)
+        self.assertEqual(9, env.read('key'))
+        self.assertEqual([], [row for row in env.export_audit() if row[0] == 'key'])
+
+    def test_audit_retention_spill(self):
+        env = self.generate_environment(audit_retention={'key': 'spill'}, audit_spill_window=3)
+        user = self.generate_user()
+        for value in range(20):
+            env.write('key', value, user=user)
+        self.assertEqual([19.0, 18.0, 17.0], [v for t, v in env.audit('key', user=user)])
+        self.assertEqual(1, len(env.audit_spill_segments()))
+        exported = [row[6] for row in env.export_audit() if row[0] == 'key']
+        self.assertEqual(list(map(float, range(20))), sorted(exported))
+        self.assertEqual(3, len([row for row in env.export_audit(include_spilled=False) if row[0] == 'key']))
+        with self.assertRaises(Exception):
+            env.snapshot(os.path.join(tempfile.gettempdir(), 'environment_spill_snapshot.bin'))
+        spill_dir = os.path.dirname(env.audit_spill_segments()[0])
+        env.discard_audit_spill()
+        self.assertFalse(os.path.exists(spill_dir))
+        self.assertEqual([], env.audit_spill_segments())
+
+
+class CompactInMemoryEnvironmentTest(InMemoryEnvironmentTest):
+
+    def generate_environment(self, **kwargs):
+        return environment.CompactInMemoryEnvironment(**kwargs)
+
+    def test_read_does_not_insert(self):
+        env = self.generate_environment()
+        user = self.generate_user()
+        item = self.generate_item()
+        self.assertIsNone(env.read('key', user=user, item=item))
+        self.assertIsNone(env.time('key', user=user, item=item))
+        self.assertEqual(0, env.number_of_answers(user=user, item=item))
+        self.assertEqual([], list(env.export_values()))
+
+
+class ArrayEnvironmentTest(CompactInMemoryEnvironmentTest):
+
+    def generate_environment(self, **kwargs):
+        # keys used by the common tests are stored in arrays too
+        array_keys = environment.ArrayEnvironment.ARRAY_KEYS + ['key', 'key_permanent', 'k1', 'k2', 'k3', 'other']
+        return environment.ArrayEnvironment(array_keys=array_keys, **kwargs)
+
+    def test_replay(self):
+        random.seed(42)
+        envs = [environment.CompactInMemoryEnvironment(), self.generate_environment(number_of_users=3)]
+        items = [self.generate_item() for i in range(10)]
+        users = [self.generate_user() for i in range(5)]
+        time = datetime.datetime(2016, 1, 1)
+        model = prediction.PFAEStaircase()
+        for env in envs:
+            for item in items[2:]:
+                env.write('parent', 1, item=item, item_secondary=items[item % 2], symmetric=False, permanent=True)
+        for i in range(200):
+            user = random.choice(users)
+            item = random.choice(items[2:])
+            answered = random.choice([item, item, None, items[2 + i % 8]])
+            time += datetime.timedelta(seconds=random.randint(1, 100000))
+            answer = self.generate_answer_id()
+            predictions = [model.predict_and_update(env, user, item, item == answered, time, answer) for env in envs]
+            self.assertEqual(predictions[0], predictions[1])
+            for env in envs:
+                env.process_answer(user, item, item, answered, time, answer, 1000, 0)
+        self.assertEqual(envs[0].rolling_success(users[0]), envs[1].rolling_success(users[0]))
+        self.assertEqual(envs[0].audit('current_skill', user=users[0], item=items[2]), envs[1].audit('current_skill', user=users[0], item=items[2]))
+        # times of 'last_correctness' and confusing factors are the times of writes
+        self.assertEqual(*[sorted([row[:5] + row[6:] for row in env.export_values()], key=str) for env in envs])
+        self.assertEqual(*[sorted([row[:4] + row[5:] for row in env.export_audit()], key=str) for env in envs])
+        for chunk_size in [None, 100]:
+            for exported in ['export_values_arrays', 'export_audit_arrays']:
+                expected = list(getattr(envs[0], exported)())[0]['value']
+                found = numpy.concatenate([chunk['value'] for chunk in getattr(envs[1], exported)(chunk_size=chunk_size)])
+                self.assertEqual(sorted(expected.tolist()), sorted(found.tolist()))
+
+
+class CorrectnessRingTest(unittest.TestCase):
+
+    def test_success(self):
+        ring = environment.CorrectnessRing()
+        self.assertIsNone(ring.success(1))
+        for i in range(100):
+            ring.push(i % 2 == 0)
+        self.assertEqual(0.5, ring.success(10))
+        self.assertEqual(0.0, ring.success(1))
+        self.assertEqual(100, ring.count)
+        self.assertEqual(ring.mask, environment.CorrectnessRing.from_history([i % 2 == 1 for i in range(100)]).mask)
+
+
+class AsyncWriteHookDispatcherTest(unittest.TestCase):
+
+    class RecordingHook(environment.EnvironmentWriteHook):
+
+        def __init__(self):
+            self.received = []
+            self.released = threading.Event()
+            self.released.set()
+
+        def event(self, key, value, user, item, item_secondary, time, previous_value, answer):
+            self.released.wait()
+            self.received.append((key, value))
+
+    def test_delivery(self):
+        hook = self.RecordingHook()
+        dispatcher = environment.AsyncWriteHookDispatcher([hook], batch_size=3, flush_interval=0.01)
+        env = environment.InMemoryEnvironment()
+        env.add_write_hook(dispatcher)
+        for value in range(10):
+            env.write('key', value)
+        env.write_many([{'key': 'other', 'value': value} for value in range(5)])
+        dispatcher.flush()
+        self.assertEqual([('key', v) for v in range(10)] + [('other', v) for v in range(5)], hook.received)
+        dispatcher.close()
+
+    def test_backpressure(self):
+        for backpressure in ['drop', 'spill']:
+            hook = self.RecordingHook()
+            hook.released.clear()
+            dispatcher = environment.AsyncWriteHookDispatcher([hook], queue_size=2, batch_size=1, flush_interval=0.01, backpressure=backpressure)
+            for value in range(10):
+                dispatcher.event('key', value, None, None, None, None, None, None)
+            hook.released.set()
+            dispatcher.close()
+            if backpressure == 'drop':
+                self.assertEqual(10, len(hook.received) + dispatcher.dropped)
+                self.assertTrue(dispatcher.dropped > 0)
+            else:
+                self.assertEqual(list(range(10)), sorted(v for k, v in hook.received))
+                self.assertTrue(dispatcher.spilled > 0)
@@ -0,0 +1,66 @@
+#  -*- coding: utf-8 -*-
+from . import environment as environment
+from . import evaluation as evaluation
+from . import prediction as prediction
+from proso.metric import brier
+import datetime
+import numpy
+import random
+import unittest
+
+
+class ReplayTest(unittest.TestCase):
+
+    def test_replay(self):
+        random.seed(42)
+        items = list(range(1, 21))
+        relations = [(item, items[item % 5], 1) for item in items[5:]]
+        time = datetime.datetime(2016, 1, 1)
+        rows = []
+        for answer_id in range(1, 301):
+            item = random.choice(items)
+            time += datetime.timedelta(seconds=random.randint(1, 100000))
+            answered = item if random.random() < 0.7 else random.choice([None, items[(item + 1) % 20]])
+            rows.append((answer_id, random.randint(1, 5), item, item, answered, time, 1000, 0))
+        answers = evaluation.answers_to_array(rows)
+        env = environment.InMemoryEnvironment()
+        for child, parent, value in relations:
+            env.write('parent', value, item=child, item_secondary=parent, symmetric=False, permanent=True)
+        model = prediction.PFAEStaircase()
+        expected = []
+        for answer_id, user, item, asked, answered, time, response_time, guess in rows:
+            expected.append(model.predict_and_update(env, user, item, asked == answered, time, answer_id))
+            env.process_answer(user, item, asked, answered, time, answer_id, response_time, guess)
+        predictions, correct = evaluation.replay(prediction.PFAEStaircase(), answers, relations, chunk_size=70)
+        self.assertEqual(expected, predictions.tolist())
+        self.assertEqual([asked == answered for _, _, _, asked, answered, _, _, _ in rows], correct.tolist())
+        result = evaluation.evaluate(predictions, correct)
+        self.assertEqual(300, result['number_of_answers'])
+        self.assertGreater(result['log_loss'], 0)
+        self.assertGreater(result['rmse'], 0)
+
+
+class CalibrationTest(unittest.TestCase):
+
+    def test_summarize_calibration(self):
+        random.seed(42)
+        predictions = numpy.array([random.random() for i in range(500)])
+        correct = numpy.array([random.random() < p for p in predictions])
+        aggregates = evaluation.calibration_buckets(predictions[:200], correct[:200], buckets=20)
+        for bucket, values in evaluation.calibration_buckets(predictions[200:], correct[200:], buckets=20).items():
+            aggregates[bucket] = tuple(a + v for a, v in zip(aggregates.get(bucket, (0, 0, 0, 0)), values))
+        summary = evaluation.summarize_calibration(aggregates, buckets=20)
+        expected = brier(predictions, correct, bins=20)
+        self.assertEqual(500, summary['number_of_answers'])
+        self.assertAlmostEqual(numpy.mean((predictions - correct) ** 2), summary['brier'])
+        for key in ['reliability', 'resolution', 'uncertainty']:
+            self.assertAlmostEqual(expected[key], summary[key])
+        self.assertEqual(expected['detail']['bin_counts'], [b['number_of_answers'] for b in summary['calibration']])
+        # the brier score decomposition is exact up to the variance within the buckets
+        self.assertAlmostEqual(summary['brier'], summary['reliability'] - summary['resolution'] + summary['uncertainty'], places=2)
+
+    def test_summarize_no_answers(self):
+        summary = evaluation.summarize_calibration({})
+        self.assertEqual(0, summary['number_of_answers'])
+        self.assertIsNone(summary['brier'])
+        self.assertEqual(10, len(summary['calibration']))
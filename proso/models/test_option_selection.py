@@ -1,5 +1,8 @@
+from collections import defaultdict
+from mock import MagicMock
 import proso.models.option_selection
 import random
+import unittest
 
 
 class TestFullyRandomOptionsNumber(proso.models.option_selection.TestOptionsNumber):
@@ -59,3 +62,25 @@ class TestAdjustedOptionSelection(proso.models.option_selection.TestOptionSelect
 
     def get_option_selector(self, item_selector, options_number):
         return proso.models.option_selection.AdjustedOptionSelection(item_selector, options_number)
+
+
+class TestSelectOptions(unittest.TestCase):
+
+    def test_select_options(self):
+        environment = MagicMock()
+        environment.confusing_factor_more_items.side_effect = lambda item, items: [1] * len(items)
+        option_selector = proso.models.option_selection.CompetitiveOptionSelection(
+            self.get_item_selector(0.75),
+            proso.models.option_selection.ConstantOptionsNumber(0, max_options=4)
+        )
+        self.assertEqual(option_selector.select_options(environment, 1, 2, None, [2, 3, 4, 5, 6]), [])
+        options = option_selector.select_options(environment, 1, 2, None, [2, 3, 4, 5, 6], allow_zero_options=False)
+        self.assertEqual(len(options), 4)
+        self.assertEqual(options[-1], 2)
+        self.assertEqual(len(set(options[:-1]) - {3, 4, 5, 6}), 0)
+
+    def get_item_selector(self, target_probability):
+        item_selector = MagicMock()
+        item_selector.get_target_probability.return_value = target_probability
+        item_selector.get_predictions.return_value = defaultdict(lambda: 0.5)
+        return item_selector
@@ -0,0 +1,150 @@
+#  -*- coding: utf-8 -*-
+from . import environment as environment
+from . import prediction as prediction
+import datetime
+import random
+import unittest
+
+
+class PredictMoreItemsTest(unittest.TestCase):
+
+    def test_prior_current(self):
+        self.check_predictions(prediction.PriorCurrentPredictiveModel())
+
+    def test_always_learning(self):
+        self.check_predictions(prediction.AlwaysLearningPredictiveModel())
+
+    def test_pfae_staircase(self):
+        self.check_predictions(prediction.PFAEStaircase())
+
+    def check_predictions(self, model):
+        random.seed(42)
+        env = environment.InMemoryEnvironment()
+        items = list(range(1, 21))
+        for item in items[5:]:
+            env.write('parent', 1, item=item, item_secondary=random.choice(items[:5]), symmetric=False, permanent=True)
+        time = datetime.datetime(2016, 1, 1)
+        answer = 0
+        for i in range(300):
+            answer += 1
+            user = random.randint(1, 5)
+            item = random.choice(items)
+            time += datetime.timedelta(seconds=random.randint(1, 100000))
+            correct = random.random() < 0.7
+            env.process_answer(user, item, item, item if correct else None, time, answer, 1000, 0)
+            model.predict_and_update(env, user, item, correct, time, answer)
+        time += datetime.timedelta(hours=1)
+        for user in range(1, 7):
+            for kwargs in [{}, {'options': [1, 2, 3]}, {'guess': 0.25}]:
+                expected = [model.predict(env, user, item, time, **kwargs) for item in items]
+                found = model.predict_more_items(env, user, items, time, **kwargs)
+                self.assertEqual(len(expected), len(found))
+                for e, f in zip(expected, found):
+                    self.assertAlmostEqual(e, f)
+
+
+class PredictAndUpdateManyTest(unittest.TestCase):
+
+    def test_prior_current(self):
+        self.check_predict_and_update_many(prediction.PriorCurrentPredictiveModel)
+
+    def test_always_learning(self):
+        self.check_predict_and_update_many(prediction.AlwaysLearningPredictiveModel)
+
+    def test_pfae_staircase(self):
+        self.check_predict_and_update_many(prediction.PFAEStaircase)
+
+    def test_shifted(self):
+        self.check_predict_and_update_many(lambda: prediction.ShiftedPredictiveModel(prediction.PriorCurrentPredictiveModel(), 0.1))
+
+    def check_predict_and_update_many(self, model_class):
+        random.seed(42)
+        items = list(range(1, 21))
+        time = datetime.datetime(2016, 1, 1)
+        answers = []
+        for answer_id in range(1, 301):
+            item = random.choice(items)
+            time += datetime.timedelta(seconds=random.randint(1, 100000))
+            correct = random.random() < 0.7
+            answers.append({
+                'user': random.randint(1, 5),
+                'item': item,
+                'correct': correct,
+                'time': time,
+                'answer_id': answer_id,
+                'item_asked': item,
+                'item_answered': item if correct else None,
+                'response_time': 1000,
+                'guess': 0,
+            })
+        environments = [environment.InMemoryEnvironment() for i in range(2)]
+        for env in environments:
+            for item in items[5:]:
+                env.write('parent', 1, item=item, item_secondary=items[item % 5], symmetric=False, permanent=True)
+        sequential = []
+        model = model_class()
+        for answer in answers:
+            sequential.append(model.predict_and_update(environments[0], **answer))
+            environments[0].process_answer(
+                answer['user'], answer['item'], answer['item_asked'], answer['item_answered'], answer['time'],
+                answer['answer_id'], answer['response_time'], answer['guess'])
+        batched = []
+        model = model_class()
+        for i in range(0, len(answers), 70):
+            batched += model.predict_and_update_many(environments[1], answers[i:i + 70], process_answers=True)
+        self.assertEqual(sequential, batched)
+        self.assertEqual(
+            sorted([row[:5] + row[6:] for row in environments[0].export_values()], key=str),
+            sorted([row[:5] + row[6:] for row in environments[1].export_values()], key=str))
+
+
+class PredictTest(unittest.TestCase):
+
+    def test_predict(self):
+        random.seed(42)
+        self.assertEqual((prediction._sigmoid(1), []), prediction.predict(1, []))
+        for options in range(1, 6):
+            for i in range(20):
+                skill_asked = random.uniform(-5, 5)
+                option_skills = [random.uniform(-5, 5) for _ in range(options)]
+                expected_asked, expected_options = _predict_by_enumeration(skill_asked, option_skills)
+                found_asked, found_options = prediction.predict(skill_asked, option_skills)
+                self.assertAlmostEqual(expected_asked, found_asked)
+                self.assertEqual(len(expected_options), len(found_options))
+                for e, f in zip(expected_options, found_options):
+                    self.assertAlmostEqual(e, f)
+                self.assertAlmostEqual(1, found_asked + sum(found_options))
+
+    def test_predict_more_questions(self):
+        random.seed(42)
+        questions = [
+            (random.uniform(-5, 5), [random.uniform(-5, 5) for _ in range(random.randint(0, 5))])
+            for i in range(50)
+        ]
+        option_skills = [[float('nan')] * 5 for _ in questions]
+        for question_options, (_, options) in zip(option_skills, questions):
+            question_options[:len(options)] = options
+        found_asked, found_options = prediction.predict_more_questions([s for s, _ in questions], option_skills)
+        for (skill_asked, options), f_asked, f_options in zip(questions, found_asked, found_options):
+            expected_asked, expected_options = prediction.predict(skill_asked, options)
+            self.assertAlmostEqual(expected_asked, f_asked)
+            for e, f in zip(expected_options + [0] * (5 - len(options)), f_options):
+                self.assertAlmostEqual(e, f)
+
+
+def _predict_by_enumeration(skill_asked, option_skills):
+    probs = [prediction._sigmoid(x) for x in [skill_asked] + option_skills]
+    asked_prob = 0
+    opt_wrong_probs = [0 for i in option_skills]
+    for state in range(2 ** len(probs)):
+        knows = [(state >> j) & 1 for j in range(len(probs))]
+        guess_options = 1 if knows[0] else sum([1 - x for x in knows])
+        current_prob = 1
+        for p, k in zip(probs, knows):
+            current_prob *= p if k else 1 - p
+        asked_prob += current_prob / guess_options
+        if not knows[0]:
+            for j in range(len(option_skills)):
+                if not knows[j + 1]:
+                    opt_wrong_probs[j] += current_prob / guess_options
+    return asked_prob, opt_wrong_probs
@@ -0,0 +1,38 @@
+#  -*- coding: utf-8 -*-
+from . import environment as environment
+from .structure import ItemStructure
+import unittest
+
+
+class ItemStructureTest(unittest.TestCase):
+
+    def test_relations(self):
+        structure = ItemStructure.from_relations([3, 4, 4, 5], [1, 1, 2, 2], [1, 1, 0.5, 1])
+        self.assertEqual([(1, 1.0), (2, 0.5)], structure.get_parents(4))
+        self.assertEqual([(3, 1.0), (4, 1.0)], structure.get_children(1))
+        self.assertEqual({1: [], 5: [(2, 1.0)], 42: []}, structure.get_parents_more_items([1, 5, 42]))
+        self.assertEqual(2, structure.number_of_parents(4))
+        self.assertEqual(0, structure.number_of_children(42))
+        structure = structure.update(4, 1).update(5, 6, 2)
+        self.assertEqual([(2, 0.5)], structure.get_parents(4))
+        self.assertEqual([(2, 1.0), (6, 2.0)], structure.get_parents(5))
+        self.assertEqual([(5, 2.0)], structure.get_children(6))
+        self.assertEqual([], ItemStructure.from_relations([], [], []).get_parents(1))
+
+    def test_update_many(self):
+        structure = ItemStructure.from_relations([3, 4, 4, 5], [1, 1, 2, 2], [1, 1, 0.5, 1])
+        structure = structure.update_many([(4, 1, None), (5, 6, 2), (3, 1, 3), (5, 6, None), (7, 6, 1)])
+        self.assertEqual([(2, 0.5)], structure.get_parents(4))
+        self.assertEqual([(2, 1.0)], structure.get_parents(5))
+        self.assertEqual([(1, 3.0)], structure.get_parents(3))
+        self.assertEqual([(7, 1.0)], structure.get_children(6))
+        self.assertIs(structure, structure.update_many([]))
+
+    def test_environment(self):
+        for env in [environment.InMemoryEnvironment(), environment.CompactInMemoryEnvironment()]:
+            env.write('parent', 1, item=3, item_secondary=1, symmetric=False, permanent=True)
+            self.assertEqual([(1, 1.0)], env.item_structure().get_parents(3))
+            env.write('parent', 1, item=3, item_secondary=2, symmetric=False, permanent=True)
+            env.delete('parent', item=3, item_secondary=1, symmetric=False)
+            self.assertEqual([(2, 1.0)], env.item_structure().get_parents(3))
+            self.assertEqual([], env.item_structure().get_children(1))
@@ -0,0 +1,31 @@
+#  -*- coding: utf-8 -*-
+from . import synthetic as synthetic
+import numpy
+import unittest
+
+
+class SyntheticDataTest(unittest.TestCase):
+
+    def test_answers(self):
+        data = synthetic.SyntheticData(number_of_items=100, number_of_users=20, number_of_parents=7, seed=42)
+        chunks = list(data.answers(2500, chunk_size=1000))
+        self.assertEqual([1000, 1000, 500], [len(chunk) for chunk in chunks])
+        answers = numpy.concatenate(chunks)
+        self.assertEqual(list(range(1, 2501)), answers['id'].tolist())
+        self.assertTrue(numpy.all(numpy.diff(answers['time']) > numpy.timedelta64(0, 'us')))
+        parents = dict((child, parent) for child, parent, _ in data.relations())
+        for answer in answers:
+            self.assertIn(answer['item_asked'], parents)
+            if answer['item_answered'] != -1:
+                self.assertEqual(parents[answer['item_asked']], parents[answer['item_answered']])
+            self.assertIn(answer['guess'], [0] + [1.0 / k for k in range(2, data.max_options + 1)])
+        self.assertEqual(
+            answers.tolist(),
+            numpy.concatenate(list(synthetic.SyntheticData(100, 20, 7, seed=42).answers(2500, chunk_size=1000))).tolist())
+
+    def test_siblings(self):
+        data = synthetic.SyntheticData(number_of_items=10, number_of_users=1, number_of_parents=3)
+        self.assertEqual(sorted(data.items.tolist()), sorted(sum([data.siblings(i) for i in [1, 5, 10]], [])))
+        for item in data.items.tolist():
+            self.assertIn(item, data.siblings(item))
+            self.assertEqual({data.parent(item)}, {data.parent(i) for i in data.siblings(item)})
@@ -1,8 +1,6 @@
 from collections import defaultdict
 from contextlib import closing
-from django.core.cache import cache
 from django.db import connection
-from proso_common.models import get_config
 from proso_models.environment import DatabaseEnvironment as ODatabaseEnvironment
 import logging
 
@@ -13,13 +11,8 @@ LOGGER = logging.getLogger('django.request')
 class DatabaseEnvironment(ODatabaseEnvironment):
 
     def confusing_factor_more_items(self, item, items, user=None):
-        cached_all = {}
-        confusing_factor_cache = cache.get('database_environment__confusing_factor', {})
-        for item_secondary in items:
-            cache_key = '{}_{}_{}'.format(item, item_secondary, user)
-            cached_item = confusing_factor_cache.get(cache_key)
-            if cached_item:
-                cached_all[item_secondary] = int(cached_item)
+        cache_keys = self._confusing_factor_cache_keys(item, items, user, symmetric=False)
+        cached_all = self._get_cached_confusing_factors(cache_keys)
         to_find = [i for i in items if i not in list(cached_all.keys())]
         if len(cached_all) != 0:
             LOGGER.debug('cache hit for confusing factor, item {}, {} other items and user {}'.format(item, len(cached_all), user))
@@ -81,12 +74,7 @@ class DatabaseEnvironment(ODatabaseEnvironment):
                     found[item_answered] = count
                 for i in to_find:
                     found[i] = 1000 * (found.get(i, 0.05) + 0 if len(context_mapping[item]) == 0 else (len(context_mapping[i] & context_mapping[item]) / len(context_mapping[i] | context_mapping[item])))
-                cache_expiration = get_config('proso_models', 'confusing_factor.cache_expiration', default=24 * 60 * 60)
-                # trying to decrease probability of race condition
-                confusing_factor_cache = cache.get('database_environment__confusing_factor', {})
-                for item_secondary, count in found.items():
-                    cache_key = '{}_{}_{}'.format(item, item_secondary, user)
-                    confusing_factor_cache[cache_key] = count
-                    cached_all[item_secondary] = count
-                cache.set('database_environment__confusing_factor', confusing_factor_cache, cache_expiration)
+                found = {i: found[i] for i in to_find}
+                self._set_cached_confusing_factors(cache_keys, found)
+                cached_all.update(found)
         return [cached_all[i] for i in items]
@@ -1,22 +1,45 @@
-from .models import Answer, Variable
-from contextlib import closing
+from .models import Answer, Audit, Variable, get_confusion_matrix_path, get_read_database
+from collections import defaultdict
+from contextlib import closing, contextmanager
 from datetime import datetime
 from django.conf import settings
 from django.core.cache import cache
-from django.db import connection
+from django.db import connection, connections
 from django.db import transaction
 from proso.django.db import is_on_postgresql
-from proso.models.environment import CommonEnvironment, InMemoryEnvironment
+from proso.models.columnar import write_copy_binary
+from proso.models.confusion import ConfusionMatrix
+from proso.models.environment import ArrayEnvironment, CommonEnvironment, CorrectnessRing, InMemoryEnvironment, CompactInMemoryEnvironment, VariableIndex
+from proso.models.structure import ItemStructure
 from proso_common.models import get_config
 import logging
+import numpy
 import os.path
 import re
+import threading
 
 LOGGER = logging.getLogger('django.request')
 
 # This is hack to emulate TRUE value on both psql and sqlite
 DATABASE_TRUE = '1 = 1'
 
+# path -> (modification time, memory-mapped confusion matrix)
+_CONFUSION_MATRICES = {}
+
+# info -> {'version': version of global variables, 'values': key -> value}
+_GLOBAL_VARIABLES = {}
+_GLOBAL_VARIABLE_MISSING = object()
+
+# (version, compiled structure of items) shared by all environments
+_ITEM_STRUCTURE = (None, None)
+ITEM_STRUCTURE_VERSION_KEY = 'database_environment__item_structure_version'
+ITEM_STRUCTURE_CHANGE_KEY = 'database_environment__item_structure_change_{}'
+ITEM_STRUCTURE_CHANGE_EXPIRATION = 24 * 60 * 60
+ITEM_STRUCTURE_MAX_REPLAYED_CHANGES = 100
+# (on commit callback, change) of the item structure made by the thread in
+# the transaction which has not been committed yet
+_ITEM_STRUCTURE_PENDING_CHANGES = threading.local()
+
 
 class InMemoryDatabaseFlushEnvironment(InMemoryEnvironment):
 
@@ -28,10 +51,14 @@ class InMemoryDatabaseFlushEnvironment(InMemoryEnvironment):
         InMemoryEnvironment.CONFUSING_FACTOR
     ]
 
-    def __init__(self, info):
-        # key -> user -> item_primary -> item_secondary -> [(time, value)]
-        InMemoryEnvironment.__init__(self)
+    FLUSH_CHUNK_SIZE = 1000000
+
+    def __init__(self, info, audit_retention=None, audit_spill_window=10):
+        super(InMemoryDatabaseFlushEnvironment, self).__init__(
+            audit_retention=audit_retention, audit_spill_dir=settings.DATA_DIR,
+            audit_spill_window=audit_spill_window)
         self._prefetched = {}
+        self._prefetched_index = VariableIndex()
         self._info_id = info.id
         self._to_delete = []
 
@@ -62,24 +89,38 @@ class InMemoryDatabaseFlushEnvironment(InMemoryEnvironment):
                     )
                 ''', [self._info_id])
             for row in cursor:
+                if self._contains(row[0], row[1], row[2], row[3]):
+                    # the variable has been already restored from a snapshot
+                    self._to_delete.append(row[6])
+                    continue
                 self._prefetched[row[0], row[1], row[2], row[3]] = (row[4].replace(tzinfo=None), row[5], row[6])
+                self._prefetched_index.add(row[0], row[1], row[2], row[3])
 
     def read(self, key, user=None, item=None, item_secondary=None, default=None, symmetric=True):
         prefetched = self._get_prefetched(key, user, item, item_secondary, symmetric)
         if prefetched:
             return prefetched[1]
         else:
-            return InMemoryEnvironment.read(
-                self, key, user=user, item=item, item_secondary=item_secondary,
+            return super(InMemoryDatabaseFlushEnvironment, self).read(
+                key, user=user, item=item, item_secondary=item_secondary,
                 default=default, symmetric=symmetric
             )
 
+    def get_items_with_values(self, key, item, user=None):
+        self._ensure_prefetched_indexed(key)
+        found = [
+            (item_secondary, self._prefetched[key, user, item, item_secondary][1])
+            for item_secondary in self._prefetched_index.with_item(key, user, item)
+        ]
+        return found + super(InMemoryDatabaseFlushEnvironment, self).get_items_with_values(key, item, user=user)
+
     def read_all_with_key(self, key):
-        found = []
-        for k, v in self._prefetched.items():
-            if k[0] == key:
-                found.append((k[1], k[2], k[3], v[1]))
-        return found + InMemoryEnvironment.read_all_with_key(self, key)
+        self._ensure_prefetched_indexed(key)
+        found = [
+            (user, item_primary, item_secondary, self._prefetched[key, user, item_primary, item_secondary][1])
+            for user, item_primary, item_secondary in self._prefetched_index.with_key(key)
+        ]
+        return found + super(InMemoryDatabaseFlushEnvironment, self).read_all_with_key(key)
 
     def write(self, key, value, user=None, item=None, item_secondary=None, time=None, audit=True, symmetric=True, permanent=False, answer=None):
         prefetched_key = self._prefetched_key(key, user, item, item_secondary, symmetric)
@@ -87,8 +128,9 @@ class InMemoryDatabaseFlushEnvironment(InMemoryEnvironment):
         if prefetched is not None:
             self._to_delete.append(prefetched[2])
             del self._prefetched[prefetched_key]
-        InMemoryEnvironment.write(
-            self, key, value, user=user, item=item,
+            self._prefetched_index.remove(*prefetched_key)
+        super(InMemoryDatabaseFlushEnvironment, self).write(
+            key, value, user=user, item=item,
             item_secondary=item_secondary, time=time, audit=audit,
             symmetric=symmetric, permanent=permanent, answer=answer
         )
@@ -98,47 +140,87 @@ class InMemoryDatabaseFlushEnvironment(InMemoryEnvironment):
         if prefetched:
             return prefetched[0]
         else:
-            return InMemoryEnvironment.time(
-                self, key, user=user, item=item,
+            return super(InMemoryDatabaseFlushEnvironment, self).time(
+                key, user=user, item=item,
                 item_secondary=item_secondary, symmetric=symmetric
             )
 
     def flush(self, clean):
-        filename_audit = os.path.join(settings.DATA_DIR, 'environment_flush_audit.csv')
-        filename_variable = os.path.join(settings.DATA_DIR, 'environment_flush_variable.csv')
-        with open(filename_audit, 'w') as file_audit:
-            for (key, u, i_p, i_s, t, a, v) in self.export_audit():
-                if key in self.DROP_KEYS:
-                    continue
-                file_audit.write(
-                    '%s,%s,%s,%s,%s,%s,%s,%s\n' % (key, u, i_p, i_s, t.strftime('%Y-%m-%d %H:%M:%S'), a, v, self._info_id))
-        with open(filename_variable, 'w') as file_variable:
-            for (key, u, i_p, i_s, p, t, a, v) in self.export_values():
-                file_variable.write(
-                    '%s,%s,%s,%s,%s,%s,%s,%s,%s,%s\n' % (key, u, i_p, i_s, v, 0, t, a, p, self._info_id))
+        filename_audit = os.path.join(settings.DATA_DIR, 'environment_flush_audit.bin')
+        filename_variable = os.path.join(settings.DATA_DIR, 'environment_flush_variable.bin')
+        drop_keys = numpy.array([key.encode() for key in self.DROP_KEYS])
+        with open(filename_audit, 'wb') as file_audit:
+            write_copy_binary(file_audit, (
+                [
+                    ('text', audit['key']),
+                    ('int4', audit['user']),
+                    ('int4', audit['item_primary']),
+                    ('int4', audit['item_secondary']),
+                    ('timestamp', audit['time']),
+                    ('int4', audit['answer']),
+                    ('float8', audit['value']),
+                    ('int4', self._info_id),
+                ]
+                for audit in (
+                    chunk[~numpy.isin(chunk['key'], drop_keys)]
+                    for chunk in self.export_audit_arrays(chunk_size=self.FLUSH_CHUNK_SIZE, include_spilled=False)
+                )
+            ))
+        audit_segments = self.audit_spill_segments()
+        with open(filename_variable, 'wb') as file_variable:
+            write_copy_binary(file_variable, (
+                [
+                    ('text', values['key']),
+                    ('int4', values['user']),
+                    ('int4', values['item_primary']),
+                    ('int4', values['item_secondary']),
+                    ('float8', values['value']),
+                    ('bool', False),
+                    ('timestamp', values['time']),
+                    ('int4', values['answer']),
+                    ('bool', values['permanent']),
+                    ('int4', self._info_id),
+                ]
+                for values in self.export_values_arrays(chunk_size=self.FLUSH_CHUNK_SIZE)
+            ))
         with transaction.atomic():
             with closing(connection.cursor()) as cursor:
                 cursor.execute('SET CONSTRAINTS ALL DEFERRED')
                 if self._to_delete:
                     cursor.execute('DELETE FROM proso_models_variable WHERE id IN (' + ','.join(map(str, self._to_delete)) + ')')
-                with open(filename_audit, 'r') as file_audit:
-                    cursor.copy_from(
-                        file_audit,
-                        'proso_models_audit',
-                        sep=',',
-                        null='None',
-                        columns=['key', 'user_id', 'item_primary_id', 'item_secondary_id', 'time', 'answer_id', 'value', 'info_id']
+                for filename in audit_segments:
+                    with open(filename, 'r') as file_audit:
+                        cursor.copy_from(
+                            file_audit,
+                            'proso_models_audit',
+                            sep=',',
+                            null='None',
+                            columns=['key', 'user_id', 'item_primary_id', 'item_secondary_id', 'time', 'answer_id', 'value', 'info_id']
+                        )
+                with open(filename_audit, 'rb') as file_audit:
+                    cursor.copy_expert(
+                        'COPY proso_models_audit (key, user_id, item_primary_id, item_secondary_id, time, answer_id, value, info_id) FROM STDIN WITH BINARY',
+                        file_audit
                     )
-                with open(filename_variable, 'r') as file_variable:
-                    cursor.copy_from(
-                        file_variable,
-                        'proso_models_variable',
-                        sep=',',
-                        null='None',
-                        columns=['key', 'user_id', 'item_primary_id', 'item_secondary_id', 'value', 'audit', 'updated', 'answer_id', 'permanent', 'info_id']
+                with open(filename_variable, 'rb') as file_variable:
+                    cursor.copy_expert(
+                        'COPY proso_models_variable (key, user_id, item_primary_id, item_secondary_id, value, audit, updated, answer_id, permanent, info_id) FROM STDIN WITH BINARY',
+                        file_variable
                     )
                 if clean:
                     cursor.execute('DELETE FROM proso_models_variable WHERE key IN (' + ','.join(['%s' for k in self.DROP_KEYS]) + ') AND info_id = %s', self.DROP_KEYS + [self._info_id])
+        self.discard_audit_spill()
+
+    def _format_audit_row(self, key, user, item_primary, item_secondary, time, answer, value):
+        # spilled audit segments are written in the same format, so they can
+        # be streamed to the database without any further processing
+        if key in self.DROP_KEYS:
+            return None
+        return '%s,%s,%s,%s,%s,%s,%s,%s\n' % (key, user, item_primary, item_secondary, time.strftime('%Y-%m-%d %H:%M:%S'), answer, value, self._info_id)
+
+    def _ensure_prefetched_indexed(self, key):
+        if not self._prefetched_index.is_indexed(key):
+            self._prefetched_index.build(key, (k[1:] for k in self._prefetched if k[0] == key))
 
     def _get_prefetched(self, key, user, item, item_secondary, symmetric):
         return self._prefetched.get(self._prefetched_key(key, user, item, item_secondary, symmetric))
@@ -150,6 +232,48 @@ class InMemoryDatabaseFlushEnvironment(InMemoryEnvironment):
         return (key, user, items[1], items[0])
 
 
+class CompactInMemoryDatabaseFlushEnvironment(InMemoryDatabaseFlushEnvironment, CompactInMemoryEnvironment):
+
+    """
+    The same as InMemoryDatabaseFlushEnvironment, but the variables are kept
+    in the flat storage of CompactInMemoryEnvironment. To use it for
+    recomputation, set 'proso_models.recompute_environment.class' to
+    'proso_models.environment.CompactInMemoryDatabaseFlushEnvironment'.
+    """
+    pass
+
+
+class ArrayDatabaseFlushEnvironment(InMemoryDatabaseFlushEnvironment, ArrayEnvironment):
+
+    """
+    The same as InMemoryDatabaseFlushEnvironment, but the variables of the
+    predictive models are kept in arrays of ArrayEnvironment. The audit of
+    DROP_KEYS is not kept at all, because it is not flushed anyway. To use it
+    for recomputation, set 'proso_models.recompute_environment.class' to
+    'proso_models.environment.ArrayDatabaseFlushEnvironment'.
+    """
+
+    def __init__(self, info, audit_retention=None, audit_spill_window=10):
+        retention = {key: self.AUDIT_RETENTION_NONE for key in self.DROP_KEYS}
+        retention.update(audit_retention if audit_retention is not None else {})
+        InMemoryDatabaseFlushEnvironment.__init__(self, info, audit_retention=retention, audit_spill_window=audit_spill_window)
+
+    def process_answer(self, user, item, asked, answered, time, answer, response_time, guess, **kwargs):
+        if self._prefetched:
+            # prefetched counters have to be read and written one by one
+            return InMemoryEnvironment.process_answer(self, user, item, asked, answered, time, answer, response_time, guess, **kwargs)
+        return ArrayEnvironment.process_answer(self, user, item, asked, answered, time, answer, response_time, guess, **kwargs)
+
+    def read_more_items(self, key, items, user=None, item=None, default=None, symmetric=True):
+        result = ArrayEnvironment.read_more_items(self, key, items, user=user, item=item, default=default, symmetric=symmetric)
+        if self._prefetched:
+            for i in items:
+                prefetched = self._get_prefetched(key, user, i, item, symmetric)
+                if prefetched:
+                    result[i] = prefetched[1]
+        return result
+
+
 class DatabaseEnvironment(CommonEnvironment):
 
     def __init__(self, info_id=None):
@@ -158,8 +282,20 @@ class DatabaseEnvironment(CommonEnvironment):
         self._before_answer = None
         self._avoid_audit = False
         self._info_id = info_id
+        # (key, user, item_primary, item_secondary) -> {'permanent', 'writes'}
+        self._write_buffer = None
+        self._use_variable_snapshots = True
+        self._variable_snapshot_cache = None
+        # global variables written by this environment are not committed yet,
+        # so they can't be read from the process-local cache
+        self._global_variables_written = False
+        # alias of the database for read-only queries, the primary database
+        # is used since the first write of this environment
+        self._read_database = None
+        self._read_from_primary = False
 
     def process_answer(self, user, item, asked, answered, time, answer_id, response_time, guess, **kwargs):
+        self._pin_to_primary()
         answer = Answer(
             user_id=user,
             item_id=item,
@@ -171,7 +307,8 @@ class DatabaseEnvironment(CommonEnvironment):
         answer.save()
 
     def audit(self, key, user=None, item=None, item_secondary=None, limit=100000, symmetric=True):
-        with closing(connection.cursor()) as cursor:
+        self._save_write_buffer()
+        with closing(self._read_connection().cursor()) as cursor:
             where, where_params = self._where_single(key, user, item, item_secondary, symmetric)
             cursor.execute(
                 'SELECT time, value FROM proso_models_audit WHERE '
@@ -181,7 +318,8 @@ class DatabaseEnvironment(CommonEnvironment):
             return [(self._ensure_is_datetime(t), v) for t, v in cursor.fetchall()]
 
     def get_items_with_values(self, key, item, user=None):
-        with closing(connection.cursor()) as cursor:
+        self._save_write_buffer()
+        with closing(self._read_connection().cursor()) as cursor:
             where, where_params = self._where_single(
                 key, user, item, None, force_null=False, symmetric=False, time_shift=False)
             cursor.execute(
@@ -196,7 +334,8 @@ class DatabaseEnvironment(CommonEnvironment):
             return cursor.fetchall()
 
     def get_items_with_values_more_items(self, key, items, user=None):
-        with closing(connection.cursor()) as cursor:
+        self._save_write_buffer()
+        with closing(self._read_connection().cursor()) as cursor:
             where, where_params = self._where_more_items(
                 key, items, user, None, force_null=['user_id'], symmetric=False, time_shift=False)
             cursor.execute(
@@ -215,15 +354,24 @@ class DatabaseEnvironment(CommonEnvironment):
             return result
 
     def read(self, key, user=None, item=None, item_secondary=None, default=None, symmetric=True):
-        with closing(connection.cursor()) as cursor:
+        if user is None and item is None and item_secondary is None and self._time is None and self._before_answer is None and not self._global_variables_written:
+            return self._read_global_variables([key], default)[key]
+        with closing(self._read_connection().cursor()) as cursor:
             where, where_params = self._where_single(key, user, item, item_secondary, symmetric=symmetric)
             if (self._time is None and self._before_answer is None) or self._avoid_audit:
+                buffered = self._buffered_value(key, user, item, item_secondary, symmetric)
+                if buffered is not None:
+                    return buffered
                 cursor.execute(
                     'SELECT value FROM proso_models_variable WHERE ' + where,
                     where_params)
                 fetched = cursor.fetchone()
                 return default if fetched is None else fetched[0]
             else:
+                shifted = self._shifted_values(lambda time_shift: self._where_single(
+                    key, user, item, item_secondary, symmetric=symmetric, time_shift=time_shift))
+                if shifted is not None:
+                    return shifted[0][4] if shifted else default
                 audit = self.audit(key, user, item, item_secondary, limit=1)
                 if len(audit) == 0:
                     return default
@@ -231,51 +379,74 @@ class DatabaseEnvironment(CommonEnvironment):
                     return audit[0][1]
 
     def read_more_items(self, key, items, user=None, item=None, default=None, symmetric=True):
-        with closing(connection.cursor()) as cursor:
+        with closing(self._read_connection().cursor()) as cursor:
             where, where_params = self._where_more_items(key, items, user, item, symmetric=symmetric)
+            shifted = None
             if (self._time is None and self._before_answer is None) or self._avoid_audit:
                 cursor.execute(
                     'SELECT item_primary_id, item_secondary_id, value FROM proso_models_variable WHERE '
                     + where,
                     where_params)
             else:
-                cursor.execute(
-                    '''SELECT DISTINCT ON
-                        (key, item_primary_id, item_secondary_id, user_id)
-                        item_primary_id, item_secondary_id, value FROM proso_models_audit WHERE
-                    ''' + where +
-                    ' ORDER BY key, item_primary_id, item_secondary_id, user_id, time DESC',
-                    where_params)
+                shifted = self._shifted_values(lambda time_shift: self._where_more_items(
+                    key, items, user, item, symmetric=symmetric, time_shift=time_shift))
+                if shifted is None:
+                    cursor.execute(
+                        '''SELECT DISTINCT ON
+                            (key, item_primary_id, item_secondary_id, user_id)
+                            item_primary_id, item_secondary_id, value FROM proso_models_audit WHERE
+                        ''' + where +
+                        ' ORDER BY key, item_primary_id, item_secondary_id, user_id, time DESC',
+                        where_params)
+            rows = cursor if shifted is None else [(ip, i_s, v) for _, _, ip, i_s, v in shifted]
             result = {i: default for i in items}
             if item is None:
-                result.update({x_y_z[0]: x_y_z[2] for x_y_z in cursor})
+                result.update({x_y_z[0]: x_y_z[2] for x_y_z in rows})
             else:
-                result.update({x_y_z1[0]: x_y_z1[2] if x_y_z1[1] == item else (x_y_z1[1], x_y_z1[2]) for x_y_z1 in cursor})
+                result.update({x_y_z1[0]: x_y_z1[2] if x_y_z1[1] == item else (x_y_z1[1], x_y_z1[2]) for x_y_z1 in rows})
+            if self._write_buffer and ((self._time is None and self._before_answer is None) or self._avoid_audit):
+                for i in items:
+                    buffered = self._buffered_value(key, user, i, item, symmetric)
+                    if buffered is not None:
+                        result[i] = buffered
             return result
 
     def read_more_keys(self, keys, user=None, item=None, item_secondary=None, default=None, symmetric=True):
-        with closing(connection.cursor()) as cursor:
+        if user is None and item is None and item_secondary is None and self._time is None and self._before_answer is None and not self._global_variables_written:
+            return self._read_global_variables(keys, default)
+        with closing(self._read_connection().cursor()) as cursor:
             where, where_params = self._where_single(keys, user, item, item_secondary, symmetric=symmetric)
+            shifted = None
             if (self._time is None and self._before_answer is None) or self._avoid_audit:
                 cursor.execute(
                     'SELECT key, value FROM proso_models_variable WHERE '
                     + where,
                     where_params)
             else:
-                cursor.execute(
-                    '''SELECT DISTINCT ON
-                        (key, item_primary_id, item_secondary_id, user_id)
-                        key, value FROM proso_models_audit WHERE
-                    ''' + where +
-                    ' ORDER BY key, item_primary_id, item_secondary_id, user_id, time DESC',
-                    where_params)
+                shifted = self._shifted_values(lambda time_shift: self._where_single(
+                    keys, user, item, item_secondary, symmetric=symmetric, time_shift=time_shift))
+                if shifted is None:
+                    cursor.execute(
+                        '''SELECT DISTINCT ON
+                            (key, item_primary_id, item_secondary_id, user_id)
+                            key, value FROM proso_models_audit WHERE
+                        ''' + where +
+                        ' ORDER BY key, item_primary_id, item_secondary_id, user_id, time DESC',
+                        where_params)
+            rows = cursor if shifted is None else [(k, v) for k, _, _, _, v in shifted]
             result = {i: default for i in keys}
-            for k, v in cursor:
+            for k, v in rows:
                 result[k] = v
+            if self._write_buffer and ((self._time is None and self._before_answer is None) or self._avoid_audit):
+                for k in keys:
+                    buffered = self._buffered_value(k, user, item, item_secondary, symmetric)
+                    if buffered is not None:
+                        result[k] = buffered
             return result
 
     def read_all_with_key(self, key):
-        with closing(connection.cursor()) as cursor:
+        self._save_write_buffer()
+        with closing(self._read_connection().cursor()) as cursor:
             where, where_params = self._where({'key': key})
             if (self._time is None and self._before_answer is None) or self._avoid_audit:
                 cursor.execute(
@@ -283,6 +454,9 @@ class DatabaseEnvironment(CommonEnvironment):
                     + where,
                     where_params)
             else:
+                shifted = self._shifted_values(lambda time_shift: self._where({'key': key}, time_shift=time_shift))
+                if shifted is not None:
+                    return [(u, ip, i_s, v) for _, u, ip, i_s, v in shifted]
                 cursor.execute(
                     '''SELECT DISTINCT ON
                         (key, item_primary_id, item_secondary_id, user_id)
@@ -293,7 +467,8 @@ class DatabaseEnvironment(CommonEnvironment):
             return cursor.fetchall()
 
     def time(self, key, user=None, item=None, item_secondary=None, symmetric=True):
-        with closing(connection.cursor()) as cursor:
+        self._save_write_buffer()
+        with closing(self._read_connection().cursor()) as cursor:
             where, where_params = self._where_single(key, user, item, item_secondary, symmetric=symmetric)
             if self._time is None:
                 cursor.execute(
@@ -309,7 +484,8 @@ class DatabaseEnvironment(CommonEnvironment):
                     return self._ensure_is_datetime(audit[0][0])
 
     def time_more_items(self, key, items, user=None, item=None, symmetric=True):
-        with closing(connection.cursor()) as cursor:
+        self._save_write_buffer()
+        with closing(self._read_connection().cursor()) as cursor:
             where, where_params = self._where_more_items(key, items, user, item, symmetric=symmetric)
             if self._time is None:
                 cursor.execute(
@@ -338,50 +514,52 @@ class DatabaseEnvironment(CommonEnvironment):
             raise Exception('Key has to be specified')
         if value is None:
             raise Exception('Value has to be specified')
-        items = [item_secondary, item]
-        if symmetric and item is not None and item_secondary is not None:
-            items = self._sorted(items)
-        data = {
-            'user_id': user,
-            'item_primary_id': items[1],
-            'item_secondary_id': items[0],
-            'key': key,
-        }
-        if not permanent:
-            data['info_id'] = self._info_id
-        # HACK: There is a race condition creating more variables, so it is
-        #       not possible to get exactly one. I hope this scenario does
-        #       not happen very often.
-        variables = list(Variable.objects.filter(**data))
-        if len(variables) == 0:
-            variable = Variable(**data)
-        else:
-            if len(variables) == 1:
-                variable = variables[0]
-            else:
-                LOGGER.error('There are duplicate variables ({}) with the following data: {}. Start cleaning.'.format(len(variables), data))
-                variable = max(variables, key=lambda variable: variable.id)
-                for var in [var for var in variables if var.id != variable.id]:
-                    LOGGER.error('Deleting duplicate variable {}'.format(var))
-                    var.delete()
-            if variable.permanent != permanent:
-                raise Exception("Variable %s changed permanency." % key)
-        if variable.value == value:
-            return
-        previous_value = variable.value
-        variable.value = value
-        variable.audit = audit
-        variable.permanent = permanent
-        variable.answer_id = answer
-        if not permanent:
-            variable.info_id = self._info_id
-        variable.updated = datetime.now() if time is None else time
-        variable.save()
-        self.call_write_hooks(key, value, user, item, item_secondary, time, previous_value, answer)
+        # Even a single write is saved by the upsert of the write buffer, so
+        # concurrent writes of the same new variable do not conflict.
+        with self.buffered_writes():
+            self._buffer_write(key, value, user, item, item_secondary, time, audit, symmetric, permanent, answer)
+
+    def write_many(self, writes):
+        """
+        The same as calling the write method for each given write, but all
+        touched variables are saved by one upsert and one bulk insert of
+        audit records (see buffered_writes).
+        """
+        with self.buffered_writes():
+            for write in writes:
+                DatabaseEnvironment.write(self, **write)
+
+    def update(self, *args, **kwargs):
+        # the updated value has to be read from the primary database
+        self._pin_to_primary()
+        CommonEnvironment.update(self, *args, **kwargs)
+
+    def update_many(self, updates):
+        self._pin_to_primary()
+        # the shifted environment without avoided audit reads the audit
+        if self._time is not None or (self._before_answer is not None and not self._avoid_audit):
+            return super(DatabaseEnvironment, self).update_many(updates)
+        identified = [(self._variable_identifier(**update), update) for update in updates]
+        variables = self._load_variables([identifier for identifier, _ in identified])
+        values = {identifier: variable['value'] for identifier, variable in variables.items()}
+        if self._write_buffer:
+            for identifier, _ in identified:
+                buffered = self._write_buffer.get(identifier[:4])
+                if buffered is not None:
+                    values[identifier] = buffered['writes'][-1]['value']
+        writes = []
+        for identifier, update in identified:
+            value = update['update_fun'](values.get(identifier, update['init_value']))
+            values[identifier] = value
+            write = {k: v for k, v in update.items() if k not in ['init_value', 'update_fun']}
+            write['value'] = value
+            writes.append(write)
+        self.write_many(writes)
 
     def delete(self, key, user=None, item=None, item_secondary=None, symmetric=True):
         if key is None:
             raise Exception('Key has to be specified')
+        self._save_write_buffer()
         items = [item_secondary, item]
         if symmetric and item is not None and item_secondary is not None:
             items = self._sorted(items)
@@ -396,13 +574,17 @@ class DatabaseEnvironment(CommonEnvironment):
             if not variable.permanent:
                 raise Exception("Can't delete variable %s which is not permanent." % key)
             variable.delete()
+            if user is None and item is None and item_secondary is None:
+                self._global_variables_changed()
+            if key == 'parent' and user is None:
+                self._item_structure_changed(items[1], items[0], None)
         except Variable.DoesNotExist:
             pass
 
     def number_of_answers(self, user=None, item=None, context=None):
         if item is not None and context is not None:
             raise Exception('Either item or context has to be unspecified')
-        with closing(connection.cursor()) as cursor:
+        with closing(self._read_connection().cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': item, 'context_id': context}, False, for_answers=True)
             cursor.execute(
                 'SELECT COUNT(id) FROM proso_models_answer WHERE '
@@ -412,7 +594,7 @@ class DatabaseEnvironment(CommonEnvironment):
     def number_of_correct_answers(self, user=None, item=None, context=None):
         if item is not None and context is not None:
             raise Exception('Either item or context has to be unspecified')
-        with closing(connection.cursor()) as cursor:
+        with closing(self._read_connection().cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': item, 'context_id': context}, False, for_answers=True)
             cursor.execute(
                 'SELECT COUNT(id) FROM proso_models_answer WHERE item_asked_id = item_answered_id AND '
@@ -422,7 +604,7 @@ class DatabaseEnvironment(CommonEnvironment):
     def number_of_first_answers(self, user=None, item=None, context=None):
         if item is not None and context is not None:
             raise Exception('Either item or context has to be unspecified')
-        with closing(connection.cursor()) as cursor:
+        with closing(self._read_connection().cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': item, 'context_id': context}, False, for_answers=True)
             cursor.execute(
                 'SELECT COUNT(1) FROM (SELECT 1 FROM proso_models_answer WHERE '
@@ -432,7 +614,7 @@ class DatabaseEnvironment(CommonEnvironment):
     def last_answer_time(self, user=None, item=None, context=None):
         if item is not None and context is not None:
             raise Exception('Either item or context has to be unspecified')
-        with closing(connection.cursor()) as cursor:
+        with closing(self._read_connection().cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': item, 'context_id': context}, False, for_answers=True)
             cursor.execute(
                 'SELECT MAX(time) FROM proso_models_answer WHERE '
@@ -440,7 +622,9 @@ class DatabaseEnvironment(CommonEnvironment):
             return self._ensure_is_datetime(cursor.fetchone()[0])
 
     def number_of_answers_more_items(self, items, user=None):
-        with closing(connection.cursor()) as cursor:
+        if self._time is None and self._before_answer is None:
+            return self._answer_aggregates_more_items('SUM(number_of_answers)', 'number_of_answers', items, user, 0)
+        with closing(self._read_connection().cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': items}, False, for_answers=True)
             cursor.execute(
                 'SELECT item_id, COUNT(id) FROM proso_models_answer WHERE '
@@ -452,7 +636,9 @@ class DatabaseEnvironment(CommonEnvironment):
             return result
 
     def number_of_correct_answers_more_items(self, items, user=None):
-        with closing(connection.cursor()) as cursor:
+        if self._time is None and self._before_answer is None:
+            return self._answer_aggregates_more_items('SUM(number_of_correct_answers)', 'number_of_correct_answers', items, user, 0)
+        with closing(self._read_connection().cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': items}, False, for_answers=True)
             cursor.execute(
                 'SELECT item_id, COUNT(id) FROM proso_models_answer WHERE item_asked_id = item_answered_id AND '
@@ -464,7 +650,9 @@ class DatabaseEnvironment(CommonEnvironment):
             return result
 
     def number_of_first_answers_more_items(self, items, user=None):
-        with closing(connection.cursor()) as cursor:
+        if self._time is None and self._before_answer is None:
+            return self._answer_aggregates_more_items('COUNT(DISTINCT user_id)', 'number_of_users', items, user, 0)
+        with closing(self._read_connection().cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': items}, False, for_answers=True)
             cursor.execute(
                 'SELECT item_id, COUNT(1) FROM (SELECT user_id, item_id FROM proso_models_answer WHERE '
@@ -476,7 +664,10 @@ class DatabaseEnvironment(CommonEnvironment):
             return result
 
     def last_answer_time_more_items(self, items, user=None):
-        with closing(connection.cursor()) as cursor:
+        if self._time is None and self._before_answer is None:
+            result = self._answer_aggregates_more_items('MAX(last_time)', 'last_time', items, user, None)
+            return {i: self._ensure_is_datetime(d) for i, d in result.items()}
+        with closing(self._read_connection().cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': items}, False, for_answers=True)
             cursor.execute(
                 'SELECT item_id, MAX(time) FROM proso_models_answer WHERE '
@@ -493,40 +684,116 @@ class DatabaseEnvironment(CommonEnvironment):
     def shift_answers(self, before_answer):
         self._before_answer = before_answer
 
+    def use_variable_snapshots(self, use_variable_snapshots):
+        """
+        Values of the shifted environment are read from the nearest previous
+        variable snapshot and the audit after it (see the snapshot_variables
+        command). Without snapshots, the whole audit before the time is
+        searched.
+        """
+        self._use_variable_snapshots = use_variable_snapshots
+
     def avoid_audit(self, avoid_audit):
         self._avoid_audit = avoid_audit
 
+    @contextmanager
+    def shifted_before_answer(self, before_answer):
+        """
+        Inside the block, the environment is shifted before the given answer
+        and avoids the audit. The previous shift is restored when the block
+        ends.
+        """
+        previous_answer, previous_avoid_audit = self._before_answer, self._avoid_audit
+        self.shift_answers(before_answer)
+        self.avoid_audit(True)
+        try:
+            yield
+        finally:
+            self.shift_answers(previous_answer)
+            self.avoid_audit(previous_avoid_audit)
+
+    @contextmanager
+    def buffered_writes(self):
+        """
+        Buffer all writes made inside the block and save them when the block
+        ends by one upsert of variables and one bulk insert of audit records.
+        The buffered values are visible to read, read_more_items and
+        read_more_keys, other reads of variables save the buffer first. The
+        buffer is discarded when the block raises an exception.
+        """
+        if self._write_buffer is not None:
+            yield
+            return
+        self._write_buffer = {}
+        self._pin_to_primary()
+        try:
+            yield
+            self._save_write_buffer()
+        finally:
+            self._write_buffer = None
+
     def rolling_success(self, user, window_size=10, context=None):
+        if window_size > CorrectnessRing.SIZE or self._time is not None or self._before_answer is not None:
+            fetched = [correct for _, correct in self._last_correctness(user, window_size, context=context)]
+            if len(fetched) < window_size:
+                return None
+            else:
+                return sum(fetched) / float(len(fetched))
+        cache_key = self._rolling_success_cache_key(user, context)
+        cached = cache.get(cache_key)
+        if cached is None:
+            LOGGER.debug('cache miss for rolling success, user {} and context {}'.format(user, context))
+            fetched = self._last_correctness(user, CorrectnessRing.SIZE, context=context)
+            ring = CorrectnessRing.from_history([correct for _, correct in fetched])
+            cache_expiration = get_config('proso_models', 'rolling_success.cache_expiration', default=24 * 60 * 60)
+            cache.set(cache_key, (ring.mask, ring.count, fetched[0][0] if fetched else None), cache_expiration)
+        else:
+            ring = CorrectnessRing(*cached[:2])
+        return ring.success(window_size)
+
+    def update_rolling_success(self, user, correct, answer=None, context=None):
+        cache_expiration = get_config('proso_models', 'rolling_success.cache_expiration', default=24 * 60 * 60)
+        for ctx in set([None, context]):
+            cache_key = self._rolling_success_cache_key(user, ctx)
+            cached = cache.get(cache_key)
+            if cached is None:
+                continue
+            mask, count, last_answer = cached
+            # the answer is already included when the ring was loaded after it was saved
+            if answer is not None and last_answer is not None and answer <= last_answer:
+                continue
+            ring = CorrectnessRing(mask, count)
+            ring.push(correct)
+            cache.set(cache_key, (ring.mask, ring.count, answer if answer is not None else last_answer), cache_expiration)
+
+    def _rolling_success_cache_key(self, user, context):
+        return 'database_environment__rolling_success_{}_{}'.format(user, context)
+
+    def _last_correctness(self, user, limit, context=None):
         where, where_params = self._where({'user_id': user, 'context_id': context}, False, for_answers=True)
-        with closing(connection.cursor()) as cursor:
+        with closing(self._read_connection().cursor()) as cursor:
             cursor.execute(
                 '''
-                SELECT item_asked_id = item_answered_id
+                SELECT id, item_asked_id = item_answered_id
                 FROM proso_models_answer
                 WHERE
                 ''' + where +
                 '''
                 ORDER BY id DESC
                 LIMIT %s
-                ''', where_params + [window_size])
-            fetched = [True if x[0] else False for x in cursor]
-            if len(fetched) < window_size:
-                return None
-            else:
-                return sum(fetched) / float(len(fetched))
+                ''', where_params + [limit])
+            return [(answer_id, True if correct else False) for answer_id, correct in cursor]
 
     def confusing_factor(self, item, item_secondary, user=None):
         return self.confusing_factor_more_items(item, [item_secondary], user=user)[0]
 
     def confusing_factor_more_items(self, item, items, user=None):
-        cached_all = {}
-        confusing_factor_cache = cache.get('database_environment__confusing_factor', {})
-        for item_secondary in items:
-            _items = self._sorted([item, item_secondary])
-            cache_key = '{}_{}_{}'.format(_items[0], _items[1], user)
-            cached_item = confusing_factor_cache.get(cache_key)
-            if cached_item:
-                cached_all[item_secondary] = int(cached_item)
+        if user is None and self._time is None and self._before_answer is None:
+            matrix = self._confusion_matrix()
+            if matrix is not None:
+                return matrix.get_more_items(item, items)
+        cache_keys = self._confusing_factor_cache_keys(item, items, user)
+        cached_all = self._get_cached_confusing_factors(cache_keys)
         to_find = [i for i in items if i not in list(cached_all.keys())]
         if len(cached_all) != 0:
             LOGGER.debug('cache hit for confusing factor, item {}, {} other items and user {}'.format(item, len(cached_all), user))
@@ -537,7 +804,7 @@ class DatabaseEnvironment(CommonEnvironment):
                 'item_asked_id': to_find,
             }, force_null=False, for_answers=True, conjuction=False)
             user_where, user_params = self._column_comparison('user_id', user, force_null=False)
-            with closing(connection.cursor()) as cursor:
+            with closing(self._read_connection().cursor()) as cursor:
                 cursor.execute(
                     '''
                     SELECT
@@ -546,7 +813,7 @@ class DatabaseEnvironment(CommonEnvironment):
                         COUNT(id) AS confusing_factor
                     FROM
                         proso_models_answer
-                    WHERE guess = 0 AND (item_asked_id = %s OR item_asked_id = %s) AND
+                    WHERE guess = 0 AND (item_asked_id = %s OR item_answered_id = %s) AND
                     ''' + user_where + ' AND (' + where + ') GROUP BY item_asked_id, item_answered_id', [item, item] + user_params + where_params)
                 found = {}
                 for item_asked, item_answered, count in cursor:
@@ -554,25 +821,442 @@ class DatabaseEnvironment(CommonEnvironment):
                         found[item_answered] = found.get(item_answered, 0) + count
                     else:
                         found[item_asked] = found.get(item_asked, 0) + count
-                for i in to_find:
-                    found[i] = found.get(i, 0)
-                cache_expiration = get_config('proso_models', 'confusing_factor.cache_expiration', default=24 * 60 * 60)
-                # trying to decrease probability of race condition
-                confusing_factor_cache = cache.get('database_environment__confusing_factor', {})
-                for item_secondary, count in found.items():
-                    _items = self._sorted([item, item_secondary])
-                    cache_key = '{}_{}_{}'.format(_items[0], _items[1], user)
-                    confusing_factor_cache[cache_key] = count
-                    cached_all[item_secondary] = count
-                cache.set('database_environment__confusing_factor', confusing_factor_cache, cache_expiration)
+                found = {i: found.get(i, 0) for i in to_find}
+                self._set_cached_confusing_factors(cache_keys, found)
+                cached_all.update(found)
         return [cached_all[i] for i in items]
 
+    def _confusion_matrix(self):
+        """
+        Returns:
+            proso.models.confusion.ConfusionMatrix: the precomputed confusion
+            matrix or None if it has not been built, the file is loaded again
+            when it is refreshed
+        """
+        path = get_confusion_matrix_path()
+        try:
+            modified = os.stat(path).st_mtime
+        except OSError:
+            return None
+        loaded = _CONFUSION_MATRICES.get(path)
+        if loaded is None or loaded[0] != modified:
+            loaded = (modified, ConfusionMatrix.load(path))
+            _CONFUSION_MATRICES[path] = loaded
+        if not loaded[1].meta.get('symmetric'):
+            # built by an older version in one direction only
+            return None
+        return loaded[1]
+
+    def _confusing_factor_cache_keys(self, item, items, user, symmetric=True):
+        """
+        Each pair of items has its own cache key, so the cached values are
+        fetched by one cache.get_many and concurrent workers do not overwrite
+        values computed by the others.
+
+        Returns:
+            dict: item_secondary -> cache key
+        """
+        cache_keys = {}
+        for item_secondary in items:
+            _items = self._sorted([item, item_secondary]) if symmetric else [item, item_secondary]
+            cache_keys[item_secondary] = 'database_environment__confusing_factor__{}_{}_{}'.format(_items[0], _items[1], user)
+        return cache_keys
+
+    def _get_cached_confusing_factors(self, cache_keys):
+        cached = cache.get_many(list(cache_keys.values()))
+        return {i: int(cached[k]) for i, k in cache_keys.items() if cached.get(k)}
+
+    def _set_cached_confusing_factors(self, cache_keys, confusing_factors):
+        # zero confusing factors are not cached, they are computed again
+        cache_expiration = get_config('proso_models', 'confusing_factor.cache_expiration', default=24 * 60 * 60)
+        cache.set_many({cache_keys[i]: value for i, value in confusing_factors.items() if value}, cache_expiration)
+
     def export_values():
         pass
 
     def export_audit():
         pass
 
+    def _variable_snapshot(self):
+        if self._variable_snapshot_cache is None or self._variable_snapshot_cache[0] != self._time:
+            with closing(self._read_connection().cursor()) as cursor:
+                cursor.execute(
+                    'SELECT id, time FROM proso_models_variablesnapshot WHERE time <= %s ORDER BY time DESC LIMIT 1',
+                    [self._time])
+                self._variable_snapshot_cache = (self._time, cursor.fetchone())
+        return self._variable_snapshot_cache[1]
+
+    def _shifted_values(self, where_fun):
+        """
+        Find the latest audited values before the shifted time as the values
+        from the nearest previous snapshot overridden by the audit after it.
+
+        Args:
+            where_fun (function): time_shift -> (where, where_params) of the
+                requested variables
+
+        Returns:
+            list: (key, user, item_primary, item_secondary, value) tuples or
+            None if snapshots can not be used
+        """
+        if not self._use_variable_snapshots or self._time is None or self._before_answer is not None or self._avoid_audit:
+            return None
+        snapshot = self._variable_snapshot()
+        if snapshot is None:
+            return None
+        snapshot_id, snapshot_time = snapshot
+        found = {}
+        with closing(self._read_connection().cursor()) as cursor:
+            where, where_params = where_fun(False)
+            cursor.execute(
+                '''
+                SELECT key, user_id, item_primary_id, item_secondary_id, value
+                FROM proso_models_variablesnapshotvalue
+                WHERE snapshot_id = %s AND (
+                ''' + where + ')', [snapshot_id] + where_params)
+            for row in cursor:
+                found[row[:4]] = row
+            where, where_params = where_fun(True)
+            cursor.execute(
+                '''
+                SELECT DISTINCT ON (key, item_primary_id, item_secondary_id, user_id)
+                    key, user_id, item_primary_id, item_secondary_id, value
+                FROM proso_models_audit
+                WHERE time >= %s AND (
+                ''' + where + ')' +
+                ' ORDER BY key, item_primary_id, item_secondary_id, user_id, time DESC',
+                [snapshot_time] + where_params)
+            for row in cursor:
+                found[row[:4]] = row
+        return list(found.values())
+
+    def _pin_to_primary(self):
+        self._read_from_primary = True
+
+    def _read_connection(self):
+        """
+        Connection for read-only queries, see
+        proso_models.models.get_read_database.
+        """
+        if self._read_from_primary:
+            return connection
+        if self._read_database is None:
+            self._read_database = get_read_database('environment.read_database')
+        return connections[self._read_database]
+
+    def _read_global_variables(self, keys, default):
+        """
+        Global variables (without user and items) are read by all requests,
+        so they are kept in the process-local cache. The cache is dropped
+        when the version of global variables stored in the shared cache
+        changes, i.e., when a global variable is written by any process.
+        """
+        version_key = self._global_variables_version_key()
+        version = cache.get(version_key)
+        if version is None:
+            cache.add(version_key, int(datetime.now().timestamp() * 1000000), None)
+            version = cache.get(version_key)
+        cached = _GLOBAL_VARIABLES.get(self._info_id)
+        if cached is None or cached['version'] != version:
+            cached = {'version': version, 'values': {}}
+            _GLOBAL_VARIABLES[self._info_id] = cached
+        values = cached['values']
+        to_find = [k for k in keys if k not in values]
+        if len(to_find) > 0:
+            found = {k: _GLOBAL_VARIABLE_MISSING for k in to_find}
+            # the primary database is used, since the replica could be behind
+            # the already incremented version
+            with closing(connection.cursor()) as cursor:
+                where, where_params = self._where_single(to_find)
+                cursor.execute('SELECT key, value FROM proso_models_variable WHERE ' + where, where_params)
+                for k, v in cursor:
+                    found[k] = v
+            values.update(found)
+        result = {k: default if values[k] is _GLOBAL_VARIABLE_MISSING else values[k] for k in keys}
+        if self._write_buffer:
+            for k in keys:
+                buffered = self._buffered_value(k, None, None, None, True)
+                if buffered is not None:
+                    result[k] = buffered
+        return result
+
+    def _global_variables_changed(self):
+        self._global_variables_written = True
+        version_key = self._global_variables_version_key()
+
+        def _increment_version():
+            try:
+                cache.incr(version_key)
+            except ValueError:
+                cache.set(version_key, int(datetime.now().timestamp() * 1000000), None)
+        # other processes could read the old value before the transaction is committed
+        transaction.on_commit(_increment_version)
+
+    def item_structure(self):
+        """
+        The structure is shared by all environments in the process. When the
+        'parent' variables change, the changes are stored in the shared cache
+        under an incremented version, so other processes replay them instead
+        of loading all relations again. The changes are published when the
+        transaction is committed, until then they are visible only within the
+        transaction.
+        """
+        pending = self._pending_item_structure_changes()
+        # the structure loaded in the transaction with pending changes is not shared
+        structure = self._shared_item_structure(share_loaded=len(pending) == 0)
+        return structure.update_many(pending)
+
+    def _shared_item_structure(self, share_loaded=True):
+        global _ITEM_STRUCTURE
+        version = cache.get(ITEM_STRUCTURE_VERSION_KEY)
+        if version is None:
+            cache.add(ITEM_STRUCTURE_VERSION_KEY, int(datetime.now().timestamp() * 1000000), None)
+            version = cache.get(ITEM_STRUCTURE_VERSION_KEY)
+        structure_version, structure = _ITEM_STRUCTURE
+        if structure is not None and structure_version == version:
+            return structure
+        if structure is not None and structure_version < version <= structure_version + ITEM_STRUCTURE_MAX_REPLAYED_CHANGES:
+            versions = range(structure_version + 1, version + 1)
+            changes = cache.get_many([ITEM_STRUCTURE_CHANGE_KEY.format(v) for v in versions])
+            if len(changes) == len(versions):
+                structure = structure.update_many([changes[ITEM_STRUCTURE_CHANGE_KEY.format(v)] for v in versions])
+            else:
+                structure = None
+        else:
+            structure = None
+        if structure is None:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    'SELECT item_primary_id, item_secondary_id, value FROM proso_models_variable WHERE key = %s AND user_id IS NULL AND permanent',
+                    ['parent'])
+                relations = cursor.fetchall()
+            structure = ItemStructure.from_relations(
+                [child for child, _, _ in relations],
+                [parent for _, parent, _ in relations],
+                [value for _, _, value in relations])
+            if not share_loaded:
+                return structure
+        _ITEM_STRUCTURE = (version, structure)
+        return structure
+
+    def _item_structure_changed(self, child, parent, value):
+
+        def _record_change():
+            try:
+                version = cache.incr(ITEM_STRUCTURE_VERSION_KEY)
+            except ValueError:
+                # without the previous version, all processes load the structure again
+                cache.set(ITEM_STRUCTURE_VERSION_KEY, int(datetime.now().timestamp() * 1000000), None)
+                return
+            cache.set(ITEM_STRUCTURE_CHANGE_KEY.format(version), (child, parent, value), ITEM_STRUCTURE_CHANGE_EXPIRATION)
+        # other processes must not see the change, if the transaction is rolled back
+        transaction.on_commit(_record_change)
+        if connection.in_atomic_block:
+            pending = getattr(_ITEM_STRUCTURE_PENDING_CHANGES, 'changes', [])
+            pending.append((_record_change, (child, parent, value)))
+            _ITEM_STRUCTURE_PENDING_CHANGES.changes = pending
+
+    def _pending_item_structure_changes(self):
+        pending = getattr(_ITEM_STRUCTURE_PENDING_CHANGES, 'changes', [])
+        if len(pending) == 0:
+            return []
+        # The callbacks of committed or rolled back transactions (or
+        # savepoints) are not registered anymore.
+        registered = {entry[1] for entry in connection.run_on_commit} if connection.in_atomic_block else set()
+        pending = [(callback, change) for callback, change in pending if callback in registered]
+        _ITEM_STRUCTURE_PENDING_CHANGES.changes = pending
+        return [change for _, change in pending]
+
+    def _global_variables_version_key(self):
+        return 'database_environment__global_variables_version_{}'.format(self._info_id)
+
+    def _answer_aggregates_more_items(self, user_column, item_column, items, user, default):
+        """
+        Read the materialized aggregates of answers (see
+        proso_models.models.AnswerAggregate). They reflect all answers, so
+        they can not be used when the time or answers are shifted.
+        """
+        where, where_params = self._where({'user_id': user, 'item_id': items}, force_null=True, for_answers=True)
+        with closing(self._read_connection().cursor()) as cursor:
+            if user is None:
+                cursor.execute(
+                    'SELECT item_id, ' + item_column + ' FROM proso_models_answeraggregate WHERE ' + where,
+                    where_params)
+            else:
+                cursor.execute(
+                    'SELECT item_id, ' + user_column + ' FROM proso_models_answeraggregate WHERE '
+                    + where + ' GROUP BY item_id',
+                    where_params)
+            result = {i: default for i in items}
+            for i, v in cursor:
+                result[i] = v
+            return result
+
+    def _buffer_write(self, key, value, user, item, item_secondary, time, audit, symmetric, permanent, answer):
+        items = [item_secondary, item]
+        if symmetric and item is not None and item_secondary is not None:
+            items = self._sorted(items)
+        buffered = self._write_buffer.setdefault((key, user, items[1], items[0]), {'permanent': permanent, 'writes': []})
+        if buffered['permanent'] != permanent:
+            raise Exception("Variable %s changed permanency." % key)
+        if buffered['writes'] and buffered['writes'][-1]['value'] == value:
+            return
+        buffered['writes'].append({
+            'value': value,
+            'audit': audit,
+            'answer': answer,
+            'time': time,
+            'updated': datetime.now() if time is None else time,
+            'item': item,
+            'item_secondary': item_secondary,
+        })
+
+    def _buffered_value(self, key, user, item, item_secondary, symmetric):
+        if not self._write_buffer:
+            return None
+        items = [item_secondary, item]
+        if symmetric and item is not None and item_secondary is not None:
+            items = self._sorted(items)
+        buffered = self._write_buffer.get((key, user, items[1], items[0]))
+        return None if buffered is None else buffered['writes'][-1]['value']
+
+    def _save_write_buffer(self):
+        if not self._write_buffer:
+            return
+        # writes made by the write hooks are not buffered
+        buffered, self._write_buffer = self._write_buffer, None
+        try:
+            previous = {}
+            if self._write_hooks:
+                loaded = self._load_variables([identity + (b['permanent'],) for identity, b in buffered.items()])
+                previous = {identifier[:4]: variable['value'] for identifier, variable in loaded.items()}
+            rows = []
+            for (key, user, item_primary, item_secondary), b in buffered.items():
+                last = b['writes'][-1]
+                rows.append((
+                    key, user, item_primary, item_secondary, last['value'], last['audit'],
+                    b['permanent'], last['answer'], last['updated'], None if b['permanent'] else self._info_id))
+            with closing(connection.cursor()) as cursor:
+                # the conflict target matches the proso_models_variable_identity index
+                cursor.execute(
+                    '''
+                    INSERT INTO proso_models_variable
+                        (key, user_id, item_primary_id, item_secondary_id, value, audit, permanent, answer_id, updated, info_id)
+                    VALUES ''' + ','.join(['(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)' for _ in rows]) + '''
+                    ON CONFLICT (COALESCE(info_id, -1), key, COALESCE(user_id, -1), COALESCE(item_primary_id, -1), COALESCE(item_secondary_id, -1))
+                    DO UPDATE SET
+                        value = EXCLUDED.value,
+                        audit = EXCLUDED.audit,
+                        answer_id = EXCLUDED.answer_id,
+                        updated = EXCLUDED.updated
+                    WHERE proso_models_variable.value <> EXCLUDED.value
+                    RETURNING key, user_id, item_primary_id, item_secondary_id
+                    ''', [x for row in rows for x in row])
+                changed = {tuple(row) for row in cursor.fetchall()}
+            audits = []
+            events = []
+            for identity, b in buffered.items():
+                # Without write hooks the original value is not loaded, so the
+                # intermediate writes of a variable whose final value has not
+                # changed are not audited.
+                if identity not in changed:
+                    continue
+                key, user, item_primary, item_secondary = identity
+                previous_value = previous.get(identity)
+                for write in b['writes']:
+                    if write['value'] == previous_value:
+                        continue
+                    if write['audit'] and not b['permanent']:
+                        audits.append(Audit(
+                            user_id=user,
+                            item_primary_id=item_primary,
+                            item_secondary_id=item_secondary,
+                            key=key,
+                            value=write['value'],
+                            time=write['updated'],
+                            info_id=self._info_id,
+                            answer_id=write['answer']))
+                    events.append((key, write['value'], user, write['item'], write['item_secondary'], write['time'], previous_value, write['answer']))
+                    previous_value = write['value']
+            if audits:
+                Audit.objects.bulk_create(audits)
+            if any(user is None and item_primary is None and item_secondary is None for _, user, item_primary, item_secondary in changed):
+                self._global_variables_changed()
+            for identity in changed:
+                key, user, item_primary, item_secondary = identity
+                if key == 'parent' and user is None:
+                    self._item_structure_changed(item_primary, item_secondary, buffered[identity]['writes'][-1]['value'])
+            with self.batched_write_hooks():
+                for event in events:
+                    self.call_write_hooks(*event)
+        finally:
+            self._write_buffer = {}
+
+    def _variable_identifier(self, key, user=None, item=None, item_secondary=None, symmetric=True, permanent=False, **kwargs):
+        if key is None:
+            raise Exception('Key has to be specified')
+        if 'value' in kwargs and kwargs['value'] is None:
+            raise Exception('Value has to be specified')
+        items = [item_secondary, item]
+        if symmetric and item is not None and item_secondary is not None:
+            items = self._sorted(items)
+        return (key, user, items[1], items[0], permanent)
+
+    def _load_variables(self, identifiers):
+        """
+        Load variables with the given (key, user, item_primary,
+        item_secondary, permanent) identifiers by one query. Duplicate
+        variables are cleaned in the same way as in the write method.
+
+        Returns:
+            dict: identifier -> {'id', 'value', 'permanent'}
+        """
+        identifiers = set(identifiers)
+        if len(identifiers) == 0:
+            return {}
+        conditions = []
+        params = []
+        for key, user, item_primary, item_secondary, permanent in identifiers:
+            data = {
+                'user_id': user,
+                'item_primary_id': item_primary,
+                'item_secondary_id': item_secondary,
+                'key': key,
+            }
+            if not permanent:
+                data['info_id'] = self._info_id
+            condition, condition_params = self._where(data, top_most=False)
+            conditions.append('(' + condition + ')')
+            params += condition_params
+        found = defaultdict(list)
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(
+                '''
+                SELECT id, key, user_id, item_primary_id, item_secondary_id, info_id, value, permanent
+                FROM proso_models_variable
+                WHERE
+                ''' + ' OR '.join(conditions), params)
+            for variable_id, key, user, item_primary, item_secondary, info_id, value, permanent in cursor:
+                variable = {'id': variable_id, 'value': value, 'permanent': permanent}
+                found[key, user, item_primary, item_secondary, True].append(variable)
+                if info_id == self._info_id:
+                    found[key, user, item_primary, item_secondary, False].append(variable)
+        result = {}
+        to_delete = set()
+        for identifier in identifiers:
+            variables = found.get(identifier)
+            if not variables:
+                continue
+            if len(variables) > 1:
+                LOGGER.error('There are duplicate variables ({}) with the following identifier: {}. Start cleaning.'.format(len(variables), identifier))
+                variables = sorted(variables, key=lambda variable: variable['id'])
+                to_delete |= {variable['id'] for variable in variables[:-1]}
+            result[identifier] = variables[-1]
+        if to_delete:
+            LOGGER.error('Deleting duplicate variables {}'.format(sorted(to_delete)))
+            Variable.objects.filter(id__in=to_delete).delete()
+        return result
+
     def _where_single(self, key, user=None, item=None, item_secondary=None, force_null=True, symmetric=True, time_shift=True, for_answers=False):
         if key is None:
             raise Exception('Key has to be specified')
@@ -682,3 +1366,126 @@ class DatabaseEnvironment(CommonEnvironment):
     def _sorted(self, xs):
         inter = sorted([x for x in xs if x is not None])
         return [None] * (len(xs) - len(inter)) + inter
+
+
+class CachedDatabaseEnvironment(DatabaseEnvironment):
+    """
+    Database environment memoizing reads for its whole lifetime, it is
+    intended to be shared by all parts of one request (see
+    proso_models.models.get_environment). The memoized values are dropped
+    before and after each local write (write hooks may read the environment)
+    and on each change of the time shift.
+    """
+
+    def __init__(self, info_id=None):
+        DatabaseEnvironment.__init__(self, info_id=info_id)
+        self._memo = {}
+
+    def clear_cache(self):
+        self._memo = {}
+
+    def read(self, key, user=None, item=None, item_secondary=None, default=None, symmetric=True):
+        return self._memoized(
+            DatabaseEnvironment.read, key,
+            user=user, item=item, item_secondary=item_secondary, default=default, symmetric=symmetric)
+
+    def read_more_items(self, key, items, user=None, item=None, default=None, symmetric=True):
+        return self._memoized(
+            DatabaseEnvironment.read_more_items, key, items,
+            user=user, item=item, default=default, symmetric=symmetric)
+
+    def read_more_keys(self, keys, user=None, item=None, item_secondary=None, default=None, symmetric=True):
+        return self._memoized(
+            DatabaseEnvironment.read_more_keys, keys,
+            user=user, item=item, item_secondary=item_secondary, default=default, symmetric=symmetric)
+
+    def time(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        return self._memoized(
+            DatabaseEnvironment.time, key,
+            user=user, item=item, item_secondary=item_secondary, symmetric=symmetric)
+
+    def time_more_items(self, key, items, user=None, item=None, symmetric=True):
+        return self._memoized(
+            DatabaseEnvironment.time_more_items, key, items,
+            user=user, item=item, symmetric=symmetric)
+
+    def number_of_answers_more_items(self, items, user=None):
+        return self._memoized(DatabaseEnvironment.number_of_answers_more_items, items, user=user)
+
+    def number_of_correct_answers_more_items(self, items, user=None):
+        return self._memoized(DatabaseEnvironment.number_of_correct_answers_more_items, items, user=user)
+
+    def number_of_first_answers_more_items(self, items, user=None):
+        return self._memoized(DatabaseEnvironment.number_of_first_answers_more_items, items, user=user)
+
+    def process_answer(self, *args, **kwargs):
+        self.clear_cache()
+        DatabaseEnvironment.process_answer(self, *args, **kwargs)
+        self.clear_cache()
+
+    def write(self, *args, **kwargs):
+        self.clear_cache()
+        DatabaseEnvironment.write(self, *args, **kwargs)
+        self.clear_cache()
+
+    def write_many(self, writes):
+        self.clear_cache()
+        DatabaseEnvironment.write_many(self, writes)
+        self.clear_cache()
+
+    def update_many(self, updates):
+        self.clear_cache()
+        DatabaseEnvironment.update_many(self, updates)
+        self.clear_cache()
+
+    def delete(self, *args, **kwargs):
+        self.clear_cache()
+        DatabaseEnvironment.delete(self, *args, **kwargs)
+        self.clear_cache()
+
+    @contextmanager
+    def buffered_writes(self):
+        try:
+            with DatabaseEnvironment.buffered_writes(self):
+                yield
+        finally:
+            # the memoized values may come from the discarded buffer
+            self.clear_cache()
+
+    def _pin_to_primary(self):
+        if not self._read_from_primary:
+            # the memoized values may come from the replica
+            self.clear_cache()
+        DatabaseEnvironment._pin_to_primary(self)
+
+    def shift_time(self, new_time):
+        if new_time != self._time:
+            self.clear_cache()
+        DatabaseEnvironment.shift_time(self, new_time)
+
+    def shift_answers(self, before_answer):
+        if before_answer != self._before_answer:
+            self.clear_cache()
+        DatabaseEnvironment.shift_answers(self, before_answer)
+
+    def avoid_audit(self, avoid_audit):
+        if avoid_audit != self._avoid_audit:
+            self.clear_cache()
+        DatabaseEnvironment.avoid_audit(self, avoid_audit)
+
+    def _memoized(self, method, *args, **kwargs):
+        memo_key = (method.__name__, self._hashable(args), self._hashable(sorted(kwargs.items())))
+        if memo_key not in self._memo:
+            self._memo[memo_key] = method(self, *args, **kwargs)
+        found = self._memo[memo_key]
+        # the callers are allowed to modify the returned collections
+        if isinstance(found, dict):
+            return dict(found)
+        if isinstance(found, list):
+            return list(found)
+        return found
+
+    def _hashable(self, value):
+        if isinstance(value, (list, tuple)):
+            return tuple(self._hashable(v) for v in value)
+        return value
@@ -1,9 +1,21 @@
-from .environment import DatabaseEnvironment
-from .models import Item
+from .environment import ArrayDatabaseFlushEnvironment, CachedDatabaseEnvironment, DatabaseEnvironment, InMemoryDatabaseFlushEnvironment, \
+    ITEM_STRUCTURE_VERSION_KEY
+from .models import Answer, AnswerAggregate, Audit, EnvironmentInfo, Item, Variable, get_environment, pin_to_primary_database
+from datetime import datetime, timedelta
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import transaction
+from mock import patch
+from proso.django.request import set_current_request
+from proso.models.prediction import PFAEStaircase
+from proso_common.models import Config
 import django.test as test
+import os
 import proso.models.environment as environment
+import shutil
+import tempfile
 
 
 class DatabaseEnvironmentTest(test.TestCase, environment.TestCommonEnvironment):
@@ -15,6 +27,10 @@ class DatabaseEnvironmentTest(test.TestCase, environment.TestCommonEnvironment):
         super(DatabaseEnvironmentTest, cls).setUpClass()
         settings.DEBUG = True
 
+    def setUp(self):
+        # rolling success is cached per user and ids can be reused between tests
+        cache.clear()
+
     def generate_item(self):
         item = Item()
         item.save()
@@ -31,3 +47,236 @@ class DatabaseEnvironmentTest(test.TestCase, environment.TestCommonEnvironment):
 
     def generate_environment(self):
         return DatabaseEnvironment()
+
+    def test_buffered_writes(self):
+        env = self.generate_environment()
+        user = self.generate_user()
+        items = [self.generate_item() for i in range(2)]
+        env.write('key', 1, user=user, item=items[0])
+        with env.buffered_writes():
+            env.update('key', 0, lambda x: x + 1, user=user, item=items[0])
+            env.write('key', 5, user=user, item=items[1], item_secondary=items[0])
+            env.write('permanent', 1, permanent=True)
+            self.assertEqual(2, env.read('key', user=user, item=items[0]))
+            self.assertEqual({'key': 2, 'other': None}, env.read_more_keys(['key', 'other'], user=user, item=items[0]))
+            self.assertEqual(1, Variable.objects.count())
+        self.assertEqual(3, Variable.objects.count())
+        self.assertEqual(2, env.read('key', user=user, item=items[0]))
+        self.assertEqual(5, env.read('key', user=user, item=items[0], item_secondary=items[1]))
+        self.assertEqual(3, Audit.objects.count())
+        with env.buffered_writes():
+            env.write('key', 2, user=user, item=items[0])
+        self.assertEqual(3, Audit.objects.count())
+
+    def test_buffered_write_many(self):
+        env = self.generate_environment()
+        user = self.generate_user()
+        items = [self.generate_item() for i in range(2)]
+        with env.buffered_writes():
+            env.write_many([{'key': 'key', 'value': 1, 'user': user, 'item': item} for item in items])
+            env.update_many([{'key': 'key', 'init_value': 0, 'update_fun': lambda x: x + 1, 'user': user, 'item': item} for item in items])
+            self.assertEqual(0, Variable.objects.filter(key='key').count())
+            self.assertEqual([2, 2], [env.read('key', user=user, item=item) for item in items])
+        self.assertEqual([2, 2], sorted(Variable.objects.filter(key='key').values_list('value', flat=True)))
+        # the same new variable written by another environment is upserted
+        DatabaseEnvironment().write('new', 1, user=user)
+        DatabaseEnvironment().write('new', 2, user=user)
+        self.assertEqual([2], list(Variable.objects.filter(key='new').values_list('value', flat=True)))
+
+    def test_global_variables_cache(self):
+        DatabaseEnvironment().write('global', 1)
+        env = self.generate_environment()
+        self.assertEqual({'global': 1, 'other': None}, env.read_more_keys(['global', 'other']))
+        Variable.objects.filter(key='global').update(value=2)
+        self.assertEqual(1, self.generate_environment().read('global'))
+        cache.incr(self.generate_environment()._global_variables_version_key())
+        self.assertEqual(2, self.generate_environment().read('global'))
+        env = self.generate_environment()
+        env.write('global', 3)
+        self.assertEqual(3, env.read('global'))
+
+    def test_item_structure(self):
+        items = [self.generate_item() for i in range(3)]
+        env = self.generate_environment()
+        self.assertEqual([], env.item_structure().get_parents(items[0]))
+        env.write('parent', 1, item=items[0], item_secondary=items[1], symmetric=False, permanent=True)
+        self.assertEqual([(items[1], 1)], self.generate_environment().item_structure().get_parents(items[0]))
+        with env.buffered_writes():
+            env.write('parent', 1, item=items[0], item_secondary=items[2], symmetric=False, permanent=True)
+        env.delete('parent', item=items[0], item_secondary=items[1], symmetric=False)
+        self.assertEqual([(items[0], 1)], self.generate_environment().item_structure().get_children(items[2]))
+        self.assertEqual([(items[2], 1)], self.generate_environment().item_structure().get_parents(items[0]))
+
+    def test_item_structure_rollback(self):
+        items = [self.generate_item() for i in range(2)]
+        env = self.generate_environment()
+        self.assertEqual([], env.item_structure().get_parents(items[0]))
+        version = cache.get(ITEM_STRUCTURE_VERSION_KEY)
+        try:
+            with transaction.atomic():
+                env.write('parent', 1, item=items[0], item_secondary=items[1], symmetric=False, permanent=True)
+                self.assertEqual([(items[1], 1)], env.item_structure().get_parents(items[0]))
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(version, cache.get(ITEM_STRUCTURE_VERSION_KEY))
+        self.assertEqual([], self.generate_environment().item_structure().get_parents(items[0]))
+
+    def test_shifted_before_answer(self):
+        env = self.generate_environment()
+        user = self.generate_user()
+        item = self.generate_item()
+        for i in range(3):
+            env.process_answer(user, item, item, item, datetime.now(), None, 1000, 0)
+        answers = list(Answer.objects.filter(user_id=user).order_by('id').values_list('id', flat=True))
+        env.shift_answers(answers[2])
+        with env.shifted_before_answer(answers[1]):
+            self.assertEqual(1, env.number_of_answers(user=user))
+        self.assertEqual(2, env.number_of_answers(user=user))
+
+    def test_confusion_matrix(self):
+        env = self.generate_environment()
+        user = self.generate_user()
+        items = [self.generate_item() for i in range(3)]
+        for asked, answered in [(0, 1), (0, 1), (1, 0), (2, 0), (1, 1)]:
+            env.process_answer(user, items[asked], items[asked], items[answered], datetime.now(), None, 1000, 0)
+        matrix_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, matrix_dir)
+        path = os.path.join(matrix_dir, 'confusion_matrix.bin')
+        with patch('proso_models.environment.get_confusion_matrix_path', return_value=path):
+            expected = [
+                self.generate_environment().confusing_factor_more_items(items[0], items[1:]),
+                self.generate_environment().confusing_factor_more_items(items[1], [items[0], items[2]]),
+                self.generate_environment().confusing_factor(items[2], items[0]),
+            ]
+            self.assertEqual([[3, 1], [3, 0], 1], expected)
+            cache.clear()
+            call_command('build_confusion_matrix', output=path)
+            self.assertEqual(expected, [
+                self.generate_environment().confusing_factor_more_items(items[0], items[1:]),
+                self.generate_environment().confusing_factor_more_items(items[1], [items[0], items[2]]),
+                self.generate_environment().confusing_factor(items[2], items[0]),
+            ])
+
+    def test_environment_outside_request(self):
+        self.assertIsNot(get_environment(), get_environment())
+
+    def test_answer_aggregates_rebuild(self):
+        env = self.generate_environment()
+        users = [self.generate_user() for i in range(3)]
+        items = [self.generate_item() for i in range(3)]
+        for u in users:
+            for i in items[u % 2:]:
+                env.process_answer(u, i, i, i if u % 3 else None, datetime.now(), None, 1000, 0)
+                env.process_answer(u, i, i, i, datetime.now(), None, 1000, 0)
+        expected = [
+            env.number_of_answers_more_items(items),
+            env.number_of_correct_answers_more_items(items, user=users[0]),
+            env.number_of_first_answers_more_items(items),
+        ]
+        fields = ['user_id', 'item_id', 'context_id', 'number_of_answers', 'number_of_correct_answers', 'number_of_users']
+        aggregates = sorted(AnswerAggregate.objects.values_list(*fields), key=str)
+        AnswerAggregate.objects.rebuild()
+        self.assertEqual(aggregates, sorted(AnswerAggregate.objects.values_list(*fields), key=str))
+        self.assertEqual(expected, [
+            env.number_of_answers_more_items(items),
+            env.number_of_correct_answers_more_items(items, user=users[0]),
+            env.number_of_first_answers_more_items(items),
+        ])
+
+
+class CachedDatabaseEnvironmentTest(DatabaseEnvironmentTest):
+
+    def generate_environment(self):
+        return CachedDatabaseEnvironment()
+
+    def test_memoized_read(self):
+        env = self.generate_environment()
+        user = self.generate_user()
+        item = self.generate_item()
+        env.write('key', 1, user=user, item=item)
+        self.assertEqual(1, env.read('key', user=user, item=item))
+        DatabaseEnvironment().write('key', 2, user=user, item=item)
+        self.assertEqual(1, env.read('key', user=user, item=item))
+        env.write('other', 1)
+        self.assertEqual(2, env.read('key', user=user, item=item))
+        self.assertEqual([2], env.read_more_items('key', [item], user=user))
+
+
+class FlushEnvironmentTest(test.TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.users = [User.objects.create(username=str(i)).id for i in range(3)]
+        self.items = [Item.objects.create().id for i in range(4)]
+        config = Config.objects.from_content({'class': 'proso.models.prediction.PFAEStaircase'})
+        self.infos = [EnvironmentInfo.objects.create(config=config, revision=i) for i in range(2)]
+        Variable.objects.create(key='parent', item_primary_id=self.items[1], item_secondary_id=self.items[0], value=1, permanent=True, audit=False)
+        for info in self.infos:
+            Variable.objects.create(key='prior_skill', user_id=self.users[0], value=0.5, info=info, audit=False)
+            Variable.objects.create(key='difficulty', item_primary_id=self.items[1], value=-0.5, info=info, audit=False)
+
+    def test_array_flush(self):
+        self.assertEqual(
+            self.replay_and_flush(InMemoryDatabaseFlushEnvironment(self.infos[0])),
+            self.replay_and_flush(ArrayDatabaseFlushEnvironment(self.infos[1])))
+
+    def replay_and_flush(self, env):
+        env.prefetch(self.users, self.items)
+        answers = []
+        for i in range(30):
+            user = self.users[i % len(self.users)]
+            item = self.items[i % len(self.items)]
+            answered = item if i % 4 else self.items[(i + 1) % len(self.items)]
+            answers.append({
+                'user': user,
+                'item': item,
+                'correct': item == answered,
+                'time': datetime(2016, 1, 1) + timedelta(minutes=i),
+                'item_answered': answered,
+                'item_asked': item,
+                'guess': 0,
+                'answer_id': None,
+                'response_time': 1000,
+            })
+        for start in range(0, len(answers), 7):
+            PFAEStaircase().predict_and_update_many(env, answers[start:start + 7], process_answers=True)
+        env.flush(False)
+        variables = Variable.objects.filter(info_id=env._info_id).values_list('key', 'user_id', 'item_primary_id', 'item_secondary_id', 'value')
+        return (
+            sorted([(key, user, item_primary, item_secondary, round(value, 6)) for key, user, item_primary, item_secondary, value in variables], key=str),
+            Audit.objects.filter(info_id=env._info_id).count(),
+        )
+
+
+class ReadDatabaseTest(test.TestCase):
+
+    multi_db = True
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='reader')
+        self.item = Item.objects.create().id
+        request = test.RequestFactory().get('/')
+        request.user = self.user
+        set_current_request(request)
+
+    @patch.dict(os.environ, {'PROSO_MODELS_ENVIRONMENT_READ_DATABASE': 'replica'})
+    def test_read_database(self):
+        # the replica database is not replicated, so it looks like a replica
+        # which is behind
+        env = DatabaseEnvironment()
+        env.write('key', 1, user=self.user.id, item=self.item)
+        env.process_answer(self.user.id, self.item, self.item, self.item, datetime.now(), None, 1000, 0)
+        self.assertEqual(1, env.read('key', user=self.user.id, item=self.item))
+        self.assertEqual(1, env.number_of_answers(user=self.user.id))
+        env = DatabaseEnvironment()
+        self.assertIsNone(env.read('key', user=self.user.id, item=self.item))
+        self.assertEqual(0, env.number_of_answers(user=self.user.id))
+
+    @patch.dict(os.environ, {'PROSO_MODELS_ENVIRONMENT_READ_DATABASE': 'replica', 'PROSO_MODELS_READ_YOUR_WRITES_TIMEOUT': '60'})
+    def test_read_your_writes(self):
+        DatabaseEnvironment().write('key', 1, user=self.user.id, item=self.item)
+        self.assertIsNone(DatabaseEnvironment().read('key', user=self.user.id, item=self.item))
+        pin_to_primary_database(self.user.id)
+        self.assertEqual(1, DatabaseEnvironment().read('key', user=self.user.id, item=self.item))
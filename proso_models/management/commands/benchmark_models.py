@@ -0,0 +1,143 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from proso.models import benchmark
+from proso.models.synthetic import SyntheticData
+from proso.reflection import get_class
+import datetime
+import json
+import os
+import platform
+import proso.release
+import subprocess
+
+
+class Command(BaseCommand):
+
+    help = 'Benchmark the environment, predictive model and item/option selection on synthetic data.'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--answers',
+            dest='answers',
+            type=int,
+            default=100000,
+            help='number of synthetic answers replayed by the predictive model'),
+        make_option(
+            '--items',
+            dest='items',
+            type=int,
+            default=1000),
+        make_option(
+            '--users',
+            dest='users',
+            type=int,
+            default=1000),
+        make_option(
+            '--parents',
+            dest='parents',
+            type=int,
+            default=20),
+        make_option(
+            '--seed',
+            dest='seed',
+            type=int,
+            default=42),
+        make_option(
+            '--model',
+            dest='model',
+            type=str,
+            default='proso.models.prediction.PFAEStaircase'),
+        make_option(
+            '--environment',
+            dest='environment',
+            type=str,
+            default='proso.models.environment.InMemoryEnvironment'),
+        make_option(
+            '--benchmarks',
+            dest='benchmarks',
+            type=str,
+            default=None,
+            help='comma separated names of benchmarks, all by default: {}'.format(', '.join(benchmark.BENCHMARKS))),
+        make_option(
+            '--samples',
+            dest='samples',
+            type=int,
+            default=100),
+        make_option(
+            '--repeat',
+            dest='repeat',
+            type=int,
+            default=3),
+        make_option(
+            '--chunk-size',
+            dest='chunk_size',
+            type=int,
+            default=1000,
+            help='number of answers processed by the predictive model at once'),
+        make_option(
+            '--output',
+            dest='output',
+            type=str,
+            default=None),
+        make_option(
+            '--compare',
+            dest='compare',
+            type=str,
+            default=None,
+            help='JSON file with results of the previous run to compare with'),
+    )
+
+    def handle(self, *args, **options):
+        benchmarks = None
+        if options['benchmarks'] is not None:
+            benchmarks = options['benchmarks'].split(',')
+            unknown = set(benchmarks) - set(benchmark.BENCHMARKS)
+            if unknown:
+                raise CommandError('There are unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+        data = SyntheticData(
+            number_of_items=options['items'], number_of_users=options['users'],
+            number_of_parents=options['parents'], seed=options['seed'])
+        results = benchmark.run(
+            data, options['answers'],
+            predictive_model_factory=get_class(options['model']),
+            environment_factory=get_class(options['environment']),
+            repeat=options['repeat'], samples=options['samples'],
+            chunk_size=options['chunk_size'], benchmarks=benchmarks)
+        report = {
+            'time': datetime.datetime.now().isoformat(),
+            'version': proso.release.VERSION,
+            'commit': current_commit(),
+            'python': platform.python_version(),
+            'parameters': {
+                key: options[key]
+                for key in ['answers', 'items', 'users', 'parents', 'seed', 'model', 'environment', 'samples', 'repeat', 'chunk_size']
+            },
+            'results': results,
+        }
+        for name, result in sorted(results.items()):
+            print(' -- {}: {:.1f} operations per second'.format(name, result['per_second'] or float('inf')))
+        if options['compare'] is not None:
+            with open(options['compare'], 'r') as previous_file:
+                previous = json.load(previous_file)
+            report['compare'] = {
+                'commit': previous.get('commit'),
+                'ratios': benchmark.compare(previous['results'], results),
+            }
+            for name, ratio in report['compare']['ratios'].items():
+                print(' -- {}: {:.2f}x compared to {}'.format(name, ratio, previous.get('commit')))
+        filename = options['output']
+        if filename is None:
+            filename = os.path.join(settings.DATA_DIR, 'benchmark_models_{}.json'.format(report['commit'] or 'unknown'))
+        with open(filename, 'w') as outfile:
+            json.dump(report, outfile, indent=2, sort_keys=True)
+        print(' -- saving report to:', filename)
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
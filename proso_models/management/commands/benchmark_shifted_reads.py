@@ -0,0 +1,63 @@
+from contextlib import closing
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from optparse import make_option
+from proso.time import timer
+from proso_models.environment import DatabaseEnvironment
+from proso_models.models import get_active_environment_info
+
+
+class Command(BaseCommand):
+
+    help = 'Compare reads of the environment shifted in time with and without variable snapshots.'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--time',
+            dest='time',
+            type=str,
+            default=None,
+            help='time of the shift in the format YYYY-MM-DD_HH:MM:SS, now by default'),
+        make_option(
+            '--samples',
+            dest='samples',
+            type=int,
+            default=100),
+    )
+
+    def handle(self, *args, **options):
+        time = datetime.now() if options['time'] is None else datetime.strptime(options['time'], '%Y-%m-%d_%H:%M:%S')
+        info_id = get_active_environment_info()['id']
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(
+                '''
+                SELECT key, user_id, item_primary_id
+                FROM proso_models_audit
+                WHERE time < %s AND item_secondary_id IS NULL AND info_id = %s
+                ORDER BY RANDOM()
+                LIMIT %s
+                ''', [time, info_id, options['samples']])
+            samples = cursor.fetchall()
+        if len(samples) == 0:
+            raise CommandError('There is no audit before {}.'.format(time))
+        results = {}
+        durations = {}
+        for use_snapshots in [False, True]:
+            environment = DatabaseEnvironment(info_id)
+            environment.shift_time(time)
+            environment.use_variable_snapshots(use_snapshots)
+            results[use_snapshots] = []
+            timer('benchmark_shifted_reads')
+            for key, user, item in samples:
+                results[use_snapshots].append(environment.read_more_items(key, [item], user=user))
+            durations[use_snapshots] = timer('benchmark_shifted_reads')
+        environment = DatabaseEnvironment(info_id)
+        timer('benchmark_shifted_reads')
+        for key, user, item in samples:
+            environment.read_more_items(key, [item], user=user)
+        durations['current'] = timer('benchmark_shifted_reads')
+        for duration_key, name in [('current', 'current'), (False, 'audit only'), (True, 'snapshots')]:
+            self.stdout.write('{:>12}: {:.2f} ms per read'.format(name, 1000 * durations[duration_key] / len(samples)))
+        if results[False] != results[True]:
+            raise CommandError('The reads with and without snapshots differ.')
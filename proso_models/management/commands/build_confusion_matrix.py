@@ -0,0 +1,65 @@
+from contextlib import closing
+from django.core.management.base import BaseCommand
+from django.db import connection
+from optparse import make_option
+from proso.models.confusion import ConfusionMatrix
+from proso_models.models import get_confusion_matrix_path
+import os
+
+
+class Command(BaseCommand):
+
+    help = 'Build or incrementally refresh the confusion matrix of items used by option selection.'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--full',
+            dest='full',
+            action='store_true',
+            default=False,
+            help='build the matrix from all answers instead of adding the new ones'),
+        make_option(
+            '--output',
+            dest='output',
+            type=str,
+            default=None),
+    )
+
+    def handle(self, *args, **options):
+        path = options['output'] if options['output'] else get_confusion_matrix_path()
+        matrix = None
+        last_answer = 0
+        if not options['full'] and os.path.exists(path):
+            matrix = ConfusionMatrix.load(path)
+            if matrix.meta.get('symmetric'):
+                last_answer = matrix.meta['answer']
+            else:
+                matrix = None
+        with closing(connection.cursor()) as cursor:
+            cursor.execute('SELECT MAX(id) FROM proso_models_answer')
+            max_answer = cursor.fetchone()[0]
+            if max_answer is None or max_answer <= last_answer:
+                self.stdout.write('The confusion matrix is up to date.')
+                return
+            cursor.execute(
+                '''
+                SELECT item_asked_id, item_answered_id, COUNT(1)
+                FROM proso_models_answer
+                WHERE
+                    id > %s AND id <= %s AND guess = 0
+                    AND item_answered_id IS NOT NULL AND item_asked_id != item_answered_id
+                GROUP BY item_asked_id, item_answered_id
+                ''', [last_answer, max_answer])
+            fetched = cursor.fetchall()
+        asked, answered, counts = zip(*fetched) if fetched else ([], [], [])
+        # confusing factors are symmetric, so each pair is stored in both
+        # directions and a row holds all confusions of its item
+        asked, answered, counts = asked + answered, answered + asked, counts + counts
+        meta = {'answer': max_answer, 'symmetric': True}
+        if matrix is None:
+            matrix = ConfusionMatrix.from_counts(asked, answered, counts, meta=meta)
+        else:
+            matrix = matrix.merge(asked, answered, counts, meta=meta)
+        matrix.save(path)
+        self.stdout.write('The confusion matrix with {} items and {} pairs saved to {}.'.format(
+            len(matrix.items), len(matrix.data), path))
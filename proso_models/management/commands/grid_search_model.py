@@ -0,0 +1,183 @@
+from contextlib import closing
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from multiprocessing import Pool, cpu_count
+from optparse import make_option
+from proso.django.config import instantiate_from_json
+from proso.models.evaluation import answers_to_array, evaluate, replay
+from proso.time import timer
+from proso_models.models import EnvironmentInfo, get_config
+import itertools
+import json
+import numpy
+import os
+import tempfile
+
+
+class Command(BaseCommand):
+
+    help = 'Evaluate the predictive model with all combinations of the given parameters on the stored answers.'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--model',
+            dest='model',
+            type=str,
+            default=None,
+            help='class of the predictive model, the configured one by default'),
+        make_option(
+            '--grid',
+            dest='grid',
+            type=str,
+            default=None,
+            help='JSON object (or file containing it) mapping parameters to lists of values'),
+        make_option(
+            '--workers',
+            dest='workers',
+            type=int,
+            default=None,
+            help='number of worker processes, the number of CPUs by default'),
+        make_option(
+            '--limit',
+            dest='limit',
+            type=int,
+            default=None),
+        make_option(
+            '--chunk-size',
+            dest='chunk_size',
+            type=int,
+            default=1000,
+            help='number of answers processed by the predictive model at once'),
+        make_option(
+            '--output',
+            dest='output',
+            type=str,
+            default=None),
+    )
+
+    def handle(self, *args, **options):
+        if options['grid'] is None:
+            raise CommandError('The grid of parameters has to be specified.')
+        grid = load_grid(options['grid'])
+        model_config = dict(get_config('proso_models', 'predictive_model', default={}))
+        if options['model'] is not None:
+            model_config = {'class': options['model']}
+        if 'class' not in model_config:
+            raise CommandError('The class of the predictive model has to be specified.')
+        workers = options['workers'] if options['workers'] is not None else cpu_count()
+        if workers < 1:
+            raise CommandError('The number of workers has to be positive.')
+        timer('grid_search_load')
+        answers = self.load_answers(options['limit'])
+        relations = self.load_relations()
+        print(' -- loaded', len(answers), 'answers and', len(relations), 'parent relations:', timer('grid_search_load'), 'seconds')
+        combinations = expand_grid(grid)
+        print(' -- evaluating', len(combinations), 'combinations by', workers, 'workers')
+        timer('grid_search_evaluate')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            answers_file = os.path.join(tmp_dir, 'answers.npy')
+            numpy.save(answers_file, answers)
+            del answers
+            tasks = [
+                (model_config['class'], dict(model_config.get('parameters', {}), **parameters), options['chunk_size'])
+                for parameters in combinations
+            ]
+            with closing(Pool(workers, _init_worker, (answers_file, relations))) as pool:
+                results = pool.map(_evaluate_combination, tasks, chunksize=1)
+        print(' -- evaluating, time:', timer('grid_search_evaluate'), 'seconds')
+        report = {
+            'model': model_config['class'],
+            'parameters': model_config.get('parameters', {}),
+            'grid': grid,
+            'results': [
+                dict(parameters=parameters, **result)
+                for parameters, result in zip(combinations, results)
+            ],
+        }
+        # min keeps the first of equal results, so the best one is deterministic too
+        report['best'] = min(report['results'], key=lambda r: r['rmse'])['parameters'] if results else None
+        filename = options['output']
+        if filename is None:
+            filename = os.path.join(settings.DATA_DIR, 'grid_search_model_report_{}.json'.format(model_config['class'].split('.')[-1]))
+        with open(filename, 'w') as outfile:
+            json.dump(report, outfile, indent=2, sort_keys=True)
+        for result in report['results']:
+            print('     -', json.dumps(result['parameters'], sort_keys=True), 'RMSE:', result['rmse'], 'log-loss:', result['log_loss'])
+        print(' -- saving report to:', filename)
+
+    def load_answers(self, limit):
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(
+                '''
+                SELECT
+                    id,
+                    user_id,
+                    item_id,
+                    item_asked_id,
+                    item_answered_id,
+                    time,
+                    response_time,
+                    guess
+                FROM proso_models_answer
+                ORDER BY id
+                ''' + ('' if limit is None else 'LIMIT %s'), [] if limit is None else [limit])
+            return answers_to_array(cursor.fetchall())
+
+    def load_relations(self):
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(
+                '''
+                SELECT item_primary_id, item_secondary_id, value
+                FROM proso_models_variable
+                INNER JOIN proso_models_environmentinfo
+                    ON proso_models_environmentinfo.id = proso_models_variable.info_id
+                WHERE key = 'parent'
+                    AND user_id IS NULL
+                    AND permanent
+                    AND proso_models_environmentinfo.status = %s
+                ORDER BY item_primary_id, item_secondary_id
+                ''', [EnvironmentInfo.STATUS_ACTIVE])
+            return cursor.fetchall()
+
+
+def load_grid(grid):
+    if os.path.exists(grid):
+        with open(grid, 'r') as grid_file:
+            grid = grid_file.read()
+    try:
+        grid = json.loads(grid)
+    except ValueError:
+        raise CommandError('The grid is not valid JSON.')
+    if not isinstance(grid, dict) or not all(isinstance(values, list) and len(values) > 0 for values in grid.values()):
+        raise CommandError('The grid has to map parameters to non-empty lists of values.')
+    return grid
+
+
+def expand_grid(grid):
+    """
+    Returns:
+        list: all combinations of parameters (as dicts) in the deterministic
+        order given by the sorted names of parameters and the order of values
+    """
+    names = sorted(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+_WORKER_ANSWERS = None
+_WORKER_RELATIONS = None
+
+
+def _init_worker(answers_file, relations):
+    global _WORKER_ANSWERS
+    global _WORKER_RELATIONS
+    # the answers are shared by memory mapping the same read-only file
+    _WORKER_ANSWERS = numpy.load(answers_file, mmap_mode='r')
+    _WORKER_RELATIONS = relations
+
+
+def _evaluate_combination(task):
+    model_class, parameters, chunk_size = task
+    predictive_model = instantiate_from_json({'class': model_class, 'parameters': parameters})
+    predictions, correct = replay(predictive_model, _WORKER_ANSWERS, _WORKER_RELATIONS, chunk_size=chunk_size)
+    return evaluate(predictions, correct)
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from proso_models.models import AnswerAggregate
+
+
+class Command(BaseCommand):
+
+    help = 'Recompute the materialized aggregates of answers from scratch.'
+
+    def handle(self, *args, **options):
+        AnswerAggregate.objects.rebuild()
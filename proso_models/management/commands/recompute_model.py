@@ -1,5 +1,6 @@
 from clint.textui import progress
 from contextlib import closing
+from datetime import datetime
 from django.conf import settings
 from django.core.cache import cache
 from django.core.management.base import BaseCommand, CommandError
@@ -7,18 +8,20 @@ from django.db import connection
 from django.db import transaction
 from optparse import make_option
 from proso.list import flatten
+from proso.metric import brier, rmse
 from proso_models.models import instantiate_from_config, get_config, Item
 from proso.django.config import set_default_config_name
 from proso.django.db import is_on_postgresql
 from proso.models.environment import InMemoryEnvironment
+from proso_models.environment import InMemoryDatabaseFlushEnvironment
 from proso.time import timer
 from proso_common.models import Config
 from proso_models.models import EnvironmentInfo, ENVIRONMENT_INFO_CACHE_KEY
 from proso_models.models import get_predictive_model
 import json
-import math
 import matplotlib.pyplot as plt
 import numpy
+import os
 import sys
 
 
@@ -74,7 +77,41 @@ class Command(BaseCommand):
             '--force',
             dest='force',
             action='store_true',
-            default=False)
+            default=False),
+        make_option(
+            '--snapshot',
+            dest='snapshot',
+            type=str,
+            default=None),
+        make_option(
+            '--snapshot-every',
+            dest='snapshot_every',
+            type=int,
+            default=1000000),
+        make_option(
+            '--chunk-size',
+            dest='chunk_size',
+            type=int,
+            default=1000,
+            help='number of answers processed by the predictive model at once'),
+        make_option(
+            '--warm-start-keys',
+            dest='warm_start_keys',
+            type=str,
+            default=None,
+            help='comma separated keys of variables copied from the active environment (with --initial), e.g., prior_skill,difficulty'),
+        make_option(
+            '--from-answer',
+            dest='from_answer',
+            type=int,
+            default=None,
+            help='id of the first answer replayed after the warm start, the copied variables are taken from the audit before it'),
+        make_option(
+            '--from-time',
+            dest='from_time',
+            type=str,
+            default=None,
+            help='time (%Y-%m-%d %H:%M:%S) of the first answer replayed after the warm start'),
     )
 
     def handle(self, *args, **options):
@@ -114,54 +151,57 @@ class Command(BaseCommand):
         info = self.load_environment_info(options['initial'], options['config_name'], True)
         environment = InMemoryEnvironment(audit_enabled=False)
         environment = self.load_environment(info)
+        self.check_snapshot(environment, options)
+        processed = 0
+        if options['snapshot'] is not None and os.path.exists(options['snapshot']):
+            processed = environment.restore(options['snapshot'])['processed']
+            print('restored from snapshot:', processed)
         users, items = self.load_user_and_item_ids(info, options['batch_size'])
         items += list(set(flatten(Item.objects.get_reachable_parents(items).values())))
         environment.prefetch(users, items)
         predictive_model = get_predictive_model(info.to_json())
-        with closing(connection.cursor()) as cursor:
-            cursor.execute('SELECT COUNT(*) FROM proso_models_answer')
-            answers_total = cursor.fetchone()[0]
-            if options['limit'] is not None:
-                answers_total = min(answers_total, options['limit'])
-            print('total:', answers_total)
-            processed = 0
-            prediction = numpy.empty(answers_total)
-            correct = numpy.empty(answers_total)
-            while processed < answers_total:
-                cursor.execute(
-                    '''
-                    SELECT
-                        id,
-                        user_id,
-                        item_id,
-                        item_asked_id,
-                        item_answered_id,
-                        time,
-                        response_time,
-                        guess
-                    FROM proso_models_answer
-                    ORDER BY id
-                    OFFSET %s LIMIT %s
-                    ''', [processed, options['batch_size']])
-                for (answer_id, user, item, asked, answered, time, response_time, guess) in cursor:
-                    correct[processed] = asked == answered
-                    prediction[processed] = predictive_model.predict_and_update(
-                        environment,
-                        user,
-                        item,
-                        asked == answered,
-                        time,
-                        item_answered=answered,
-                        item_asked=asked,
-                        guess=guess,
-                        answer_id=answer_id,
-                        response_time=response_time,
-                    )
-                    environment.process_answer(user, item, asked, answered, time, answer_id, response_time, guess)
-                    processed += 1
-                    if processed >= answers_total:
+        try:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute('SELECT COUNT(*) FROM proso_models_answer')
+                answers_total = cursor.fetchone()[0]
+                if options['limit'] is not None:
+                    answers_total = min(answers_total, options['limit'])
+                print('total:', answers_total)
+                skipped = processed
+                prediction = numpy.empty(max(0, answers_total - skipped))
+                correct = numpy.empty(max(0, answers_total - skipped))
+                while processed < answers_total:
+                    cursor.execute(
+                        '''
+                        SELECT
+                            id,
+                            user_id,
+                            item_id,
+                            item_asked_id,
+                            item_answered_id,
+                            time,
+                            response_time,
+                            guess
+                        FROM proso_models_answer
+                        ORDER BY id
+                        OFFSET %s LIMIT %s
+                        ''', [processed, options['batch_size']])
+                    rows = cursor.fetchmany(answers_total - processed)
+                    if len(rows) == 0:
                         break
-                print('processed:', processed)
+                    for start in range(0, len(rows), options['chunk_size']):
+                        answers = [_answer(*row) for row in rows[start:start + options['chunk_size']]]
+                        chunk = slice(processed - skipped, processed - skipped + len(answers))
+                        correct[chunk] = [a['correct'] for a in answers]
+                        prediction[chunk] = predictive_model.predict_and_update_many(environment, answers, process_answers=True)
+                        processed += len(answers)
+                    print('processed:', processed)
+            if options['snapshot'] is not None:
+                environment.snapshot(options['snapshot'], meta={'processed': processed})
+                print('Saving snapshot to:', options['snapshot'])
+        finally:
+            # the audit is not flushed in the dry run
+            environment.discard_audit_spill()
         filename = settings.DATA_DIR + '/recompute_model_report_{}.json'.format(predictive_model.__class__.__name__)
         model_report = report(prediction, correct)
         with open(filename, 'w') as outfile:
@@ -200,6 +240,12 @@ class Command(BaseCommand):
     def handle_recompute(self, options):
         timer('recompute_all')
         info = self.load_environment_info(options['initial'], options['config_name'], False)
+        if options['warm_start_keys'] is not None:
+            if not options['initial']:
+                raise CommandError("The warm start is possible only for the initial recomputation.")
+            self.warm_start(info, options['warm_start_keys'].split(','), self.load_from_answer(options))
+        elif options['from_answer'] is not None or options['from_time'] is not None:
+            raise CommandError("The first replayed answer can be given only for the warm start.")
         if options['finish']:
             to_process = self.number_of_answers_to_process(info)
             if self.number_of_answers_to_process(info) >= options['batch_size'] and not options['force']:
@@ -213,49 +259,67 @@ class Command(BaseCommand):
         print(' -- preparing phase')
         timer('recompute_prepare')
         environment = self.load_environment(info)
-        users, items = self.load_user_and_item_ids(info, options['batch_size'])
-        items += list(set(flatten(Item.objects.get_reachable_parents(items).values())))
-        environment.prefetch(users, items)
-        predictive_model = get_predictive_model(info.to_json())
-        print(' -- preparing phase, time:', timer('recompute_prepare'), 'seconds')
-        timer('recompute_model')
-        print(' -- model phase')
-        with closing(connection.cursor()) as cursor:
-            cursor.execute(
-                '''
-                SELECT
-                    id,
-                    user_id,
-                    item_id,
-                    item_asked_id,
-                    item_answered_id,
-                    time,
-                    response_time,
-                    guess
-                FROM proso_models_answer
-                ORDER BY id
-                OFFSET %s LIMIT %s
-                ''', [info.load_progress, options['batch_size']])
-            progress_bar = progress.bar(cursor, every=max(1, cursor.rowcount // 100), expected_size=cursor.rowcount)
-            info.load_progress += cursor.rowcount
-            for (answer_id, user, item, asked, answered, time, response_time, guess) in progress_bar:
-                predictive_model.predict_and_update(
-                    environment,
-                    user,
-                    item,
-                    asked == answered,
-                    time,
-                    item_answered=answered,
-                    item_asked=asked,
-                    guess=guess,
-                    answer_id=answer_id,
-                    response_time=response_time,
-                )
-                environment.process_answer(user, item, asked, answered, time, answer_id, response_time, guess)
-        print(' -- model phase, time:', timer('recompute_model'), 'seconds')
-        timer('recompute_flush')
-        print(' -- flushing phase')
-        environment.flush(clean=options['finish'])
+        self.check_snapshot(environment, options)
+        load_progress = info.load_progress
+        resumed = 0
+        if options['snapshot'] is not None and os.path.exists(options['snapshot']):
+            meta = environment.restore(options['snapshot'])
+            if meta.get('info') != info.id or meta.get('load_progress') != load_progress:
+                raise CommandError("The snapshot %s does not belong to the currently loading environment." % options['snapshot'])
+            resumed = meta['processed']
+            print(' -- restored from snapshot, already processed answers:', resumed)
+        try:
+            users, items = self.load_user_and_item_ids(info, options['batch_size'])
+            items += list(set(flatten(Item.objects.get_reachable_parents(items).values())))
+            environment.prefetch(users, items)
+            predictive_model = get_predictive_model(info.to_json())
+            print(' -- preparing phase, time:', timer('recompute_prepare'), 'seconds')
+            timer('recompute_model')
+            print(' -- model phase')
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    '''
+                    SELECT
+                        id,
+                        user_id,
+                        item_id,
+                        item_asked_id,
+                        item_answered_id,
+                        time,
+                        response_time,
+                        guess
+                    FROM proso_models_answer
+                    ORDER BY id
+                    OFFSET %s LIMIT %s
+                    ''', [load_progress + resumed, max(0, options['batch_size'] - resumed)])
+                rows = cursor.fetchall()
+                info.load_progress += resumed + len(rows)
+                processed = resumed
+                chunk_size = options['chunk_size']
+                if options['snapshot'] is not None:
+                    # snapshots are taken between chunks
+                    chunk_size = min(chunk_size, options['snapshot_every'])
+                chunks = range(0, len(rows), chunk_size)
+                for start in progress.bar(chunks, every=max(1, len(chunks) // 100), expected_size=len(chunks)):
+                    answers = [_answer(*row) for row in rows[start:start + chunk_size]]
+                    predictive_model.predict_and_update_many(environment, answers, process_answers=True)
+                    processed += len(answers)
+                    if options['snapshot'] is not None and processed // options['snapshot_every'] > (processed - len(answers)) // options['snapshot_every']:
+                        environment.snapshot(options['snapshot'], meta={
+                            'info': info.id,
+                            'load_progress': load_progress,
+                            'processed': processed,
+                        })
+            print(' -- model phase, time:', timer('recompute_model'), 'seconds')
+            timer('recompute_flush')
+            print(' -- flushing phase')
+            environment.flush(clean=options['finish'])
+        except BaseException:
+            # the spilled audit is useless without the state kept in memory
+            environment.discard_audit_spill()
+            raise
+        if options['snapshot'] is not None and os.path.exists(options['snapshot']):
+            os.remove(options['snapshot'])
         print(' -- flushing phase, time:', timer('recompute_flush'), 'seconds, total number of answers:', info.load_progress)
         if options['finish']:
             timer('recompute_finish')
@@ -292,12 +356,133 @@ class Command(BaseCommand):
             self._environment_info = EnvironmentInfo.objects.get(config=config, status=EnvironmentInfo.STATUS_LOADING)
         return self._environment_info
 
+    def load_from_answer(self, options):
+        if options['from_answer'] is not None and options['from_time'] is not None:
+            raise CommandError("Only one of --from-answer and --from-time can be given.")
+        if options['from_answer'] is not None:
+            return options['from_answer']
+        with closing(connection.cursor()) as cursor:
+            if options['from_time'] is not None:
+                try:
+                    from_time = datetime.strptime(options['from_time'], '%Y-%m-%d %H:%M:%S')
+                except ValueError:
+                    raise CommandError("The time has to be in format %Y-%m-%d %H:%M:%S.")
+                cursor.execute('SELECT MIN(id) FROM proso_models_answer WHERE time >= %s', [from_time])
+                from_answer = cursor.fetchone()[0]
+                if from_answer is not None:
+                    return from_answer
+            cursor.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM proso_models_answer')
+            return cursor.fetchone()[0]
+
+    def warm_start(self, info, keys, from_answer):
+        """
+        Copy the variables with the given keys from the active environment,
+        the values before the given answer are taken from its audit (or the
+        current values are copied when no answer is after the given one).
+        The keys of variables missing in the audit (written without audit or
+        with the audit not retained) are refused. The counters of answers before the given one are computed from the
+        answers, so the following recomputation replays only the answers
+        since the given one.
+        """
+        timer('recompute_warm_start')
+        print(' -- warm start phase')
+        try:
+            previous_info = EnvironmentInfo.objects.get(status=EnvironmentInfo.STATUS_ACTIVE)
+        except EnvironmentInfo.DoesNotExist:
+            raise CommandError("There is no active environment to start from.")
+        keys = [key for key in keys if key]
+        drop_keys = [key for key in keys if key in InMemoryDatabaseFlushEnvironment.DROP_KEYS]
+        if len(drop_keys) > 0:
+            raise CommandError("The keys {} are computed from the answers and can not be copied.".format(', '.join(drop_keys)))
+        with transaction.atomic():
+            with closing(connection.cursor()) as cursor:
+                cursor.execute('SELECT COUNT(*) FROM proso_models_answer WHERE id >= %s', [from_answer])
+                nothing_to_replay = cursor.fetchone()[0] == 0
+                keys_in = ','.join(['%s'] * len(keys))
+                if len(keys) > 0 and not nothing_to_replay:
+                    # variables written without audit can not be taken from it
+                    cursor.execute(
+                        '''
+                        SELECT DISTINCT key
+                        FROM proso_models_variable AS variable
+                        WHERE info_id = %s AND NOT permanent AND key IN (''' + keys_in + ''') AND NOT EXISTS (
+                            SELECT 1
+                            FROM proso_models_audit AS audit
+                            WHERE
+                                audit.info_id = variable.info_id AND audit.key = variable.key
+                                AND audit.user_id IS NOT DISTINCT FROM variable.user_id
+                                AND audit.item_primary_id IS NOT DISTINCT FROM variable.item_primary_id
+                                AND audit.item_secondary_id IS NOT DISTINCT FROM variable.item_secondary_id
+                        )
+                        ''', [previous_info.id] + keys)
+                    not_audited = sorted(key for key, in cursor.fetchall())
+                    if len(not_audited) > 0:
+                        raise CommandError("The keys {} are not fully covered by the audit and can not be copied.".format(', '.join(not_audited)))
+                if len(keys) == 0:
+                    copied = 0
+                elif nothing_to_replay:
+                    cursor.execute(
+                        '''
+                        INSERT INTO proso_models_variable
+                            (user_id, item_primary_id, item_secondary_id, permanent, key, value, audit, updated, info_id, answer_id)
+                        SELECT
+                            user_id, item_primary_id, item_secondary_id, permanent, key, value, FALSE, updated, %s, answer_id
+                        FROM proso_models_variable
+                        WHERE info_id = %s AND NOT permanent AND key IN (''' + keys_in + ''')
+                        ''', [info.id, previous_info.id] + keys)
+                    copied = cursor.rowcount
+                else:
+                    cursor.execute(
+                        '''
+                        INSERT INTO proso_models_variable
+                            (user_id, item_primary_id, item_secondary_id, permanent, key, value, audit, updated, info_id, answer_id)
+                        SELECT DISTINCT ON (key, user_id, item_primary_id, item_secondary_id)
+                            user_id, item_primary_id, item_secondary_id, FALSE, key, value, FALSE, time, %s, answer_id
+                        FROM proso_models_audit
+                        WHERE info_id = %s AND answer_id < %s AND key IN (''' + keys_in + ''')
+                        ORDER BY key, user_id, item_primary_id, item_secondary_id, answer_id DESC, time DESC, id DESC
+                        ''', [info.id, previous_info.id, from_answer] + keys)
+                    copied = cursor.rowcount
+                counters = 0
+                for key, user, item, item_secondary, value, where in WARM_START_COUNTERS:
+                    group_by = ', '.join(column for column in [user, item, item_secondary] if column != 'NULL')
+                    cursor.execute(
+                        '''
+                        INSERT INTO proso_models_variable
+                            (user_id, item_primary_id, item_secondary_id, permanent, key, value, audit, updated, info_id, answer_id)
+                        SELECT
+                            ''' + ', '.join([user, item, item_secondary]) + ''', FALSE, %s, ''' + value + ''', FALSE, MAX(time), %s, MAX(id)
+                        FROM proso_models_answer
+                        WHERE id < %s''' + ('' if where is None else ' AND ' + where) +
+                        ('' if group_by == '' else ' GROUP BY ' + group_by) +
+                        ' HAVING COUNT(*) > 0', [key, info.id, from_answer])
+                    counters += cursor.rowcount
+                cursor.execute(
+                    '''
+                    INSERT INTO proso_models_variable
+                        (user_id, item_primary_id, item_secondary_id, permanent, key, value, audit, updated, info_id, answer_id)
+                    SELECT DISTINCT ON (user_id)
+                        user_id, NULL, NULL, FALSE, %s, ''' + _CORRECT + ''', FALSE, time, %s, id
+                    FROM proso_models_answer
+                    WHERE id < %s
+                    ORDER BY user_id, id DESC
+                    ''', [InMemoryEnvironment.LAST_CORRECTNESS, info.id, from_answer])
+                counters += cursor.rowcount
+                cursor.execute('SELECT COUNT(*) FROM proso_models_answer WHERE id < %s', [from_answer])
+                info.load_progress = cursor.fetchone()[0]
+            info.save()
+        print(' -- warm start phase, time:', timer('recompute_warm_start'), 'seconds, copied', copied, 'variables, computed', counters, 'counters, skipped', info.load_progress, 'answers')
+
     def load_environment(self, info):
         return instantiate_from_config(
             'proso_models', 'recompute_environment',
             default_class='proso_models.environment.InMemoryDatabaseFlushEnvironment',
             pass_parameters=[info])
 
+    def check_snapshot(self, environment, options):
+        if options['snapshot'] is not None and environment.spills_audit():
+            raise CommandError("The snapshot can not be used together with the 'spill' audit retention.")
+
     def load_user_and_item_ids(self, info, batch_size):
         with closing(connection.cursor()) as cursor:
             cursor.execute(
@@ -332,42 +517,48 @@ class Command(BaseCommand):
                 return fetched[0]
 
 
-def report(predictions, real):
-    return {
-        'rmse': rmse(predictions, real),
-        'brier': brier(predictions, real),
-    }
+_CORRECT = 'CASE WHEN item_asked_id = item_answered_id THEN 1 ELSE 0 END'
+_CONFUSED = 'guess = 0 AND item_answered_id IS NOT NULL AND item_asked_id <> item_answered_id'
 
+# (key, user, item, item_secondary, value, where) of the counters written by
+# InMemoryEnvironment.process_answer, the symmetric variables have the greater
+# item as the primary one
+WARM_START_COUNTERS = [
+    (InMemoryEnvironment.NUMBER_OF_ANSWERS, 'NULL', 'NULL', 'NULL', 'COUNT(*)', None),
+    (InMemoryEnvironment.NUMBER_OF_ANSWERS, 'user_id', 'NULL', 'NULL', 'COUNT(*)', None),
+    (InMemoryEnvironment.NUMBER_OF_ANSWERS, 'NULL', 'item_id', 'NULL', 'COUNT(*)', None),
+    (InMemoryEnvironment.NUMBER_OF_ANSWERS, 'user_id', 'item_id', 'NULL', 'COUNT(*)', None),
+    (InMemoryEnvironment.NUMBER_OF_CORRECT_ANSWERS, 'NULL', 'NULL', 'NULL', 'COUNT(*)', 'item_asked_id = item_answered_id'),
+    (InMemoryEnvironment.NUMBER_OF_CORRECT_ANSWERS, 'user_id', 'NULL', 'NULL', 'COUNT(*)', 'item_asked_id = item_answered_id'),
+    (InMemoryEnvironment.NUMBER_OF_CORRECT_ANSWERS, 'NULL', 'item_id', 'NULL', 'COUNT(*)', 'item_asked_id = item_answered_id'),
+    (InMemoryEnvironment.NUMBER_OF_CORRECT_ANSWERS, 'user_id', 'item_id', 'NULL', 'COUNT(*)', 'item_asked_id = item_answered_id'),
+    (InMemoryEnvironment.NUMBER_OF_FIRST_ANSWERS, 'NULL', 'NULL', 'NULL', 'COUNT(DISTINCT (user_id, item_id))', None),
+    (InMemoryEnvironment.NUMBER_OF_FIRST_ANSWERS, 'user_id', 'NULL', 'NULL', 'COUNT(DISTINCT item_id)', None),
+    (InMemoryEnvironment.NUMBER_OF_FIRST_ANSWERS, 'NULL', 'item_id', 'NULL', 'COUNT(DISTINCT user_id)', None),
+    (InMemoryEnvironment.NUMBER_OF_FIRST_ANSWERS, 'user_id', 'item_id', 'NULL', '1', None),
+    (InMemoryEnvironment.CONFUSING_FACTOR, 'NULL', 'GREATEST(item_asked_id, item_answered_id)', 'LEAST(item_asked_id, item_answered_id)', 'COUNT(*)', _CONFUSED),
+    (InMemoryEnvironment.CONFUSING_FACTOR, 'user_id', 'GREATEST(item_asked_id, item_answered_id)', 'LEAST(item_asked_id, item_answered_id)', 'COUNT(*)', _CONFUSED),
+]
 
-def rmse(predictions, real):
-    return math.sqrt(numpy.mean((predictions - real) ** 2))
 
+def _answer(answer_id, user, item, asked, answered, time, response_time, guess):
+    return {
+        'user': user,
+        'item': item,
+        'correct': asked == answered,
+        'time': time,
+        'item_answered': answered,
+        'item_asked': asked,
+        'guess': guess,
+        'answer_id': answer_id,
+        'response_time': response_time,
+    }
 
-def brier(predictions, real, bins=20):
-    counts = numpy.zeros(bins)
-    correct = numpy.zeros(bins)
-    prediction = numpy.zeros(bins)
-    for p, r in zip(predictions, real):
-        bin = min(int(p * bins), bins - 1)
-        counts[bin] += 1
-        correct[bin] += r
-        prediction[bin] += p
-    prediction_means = prediction / counts
-    prediction_means[numpy.isnan(prediction_means)] = ((numpy.arange(bins) + 0.5) / bins)[numpy.isnan(prediction_means)]
-    correct_means = correct / counts
-    correct_means[numpy.isnan(correct_means)] = 0
-    size = len(predictions)
-    answer_mean = sum(correct) / size
+
+def report(predictions, real):
     return {
-        "reliability": sum(counts * (correct_means - prediction_means) ** 2) / size,
-        "resolution": sum(counts * (correct_means - answer_mean) ** 2) / size,
-        "uncertainty": answer_mean * (1 - answer_mean),
-        "detail": {
-            "bin_count": bins,
-            "bin_counts": list(counts),
-            "bin_prediction_means": list(prediction_means),
-            "bin_correct_means": list(correct_means),
-        }
+        'rmse': rmse(predictions, real),
+        'brier': brier(predictions, real),
     }
 
 
@@ -0,0 +1,68 @@
+from contextlib import closing
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db import transaction
+from optparse import make_option
+from proso_models.models import VariableSnapshot
+
+
+class Command(BaseCommand):
+
+    help = 'Take a snapshot of the latest audited values of variables used by environments shifted in time.'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--time',
+            dest='time',
+            type=str,
+            default=None,
+            help='time of the snapshot in the format YYYY-MM-DD_HH:MM:SS, now by default'),
+        make_option(
+            '--keep',
+            dest='keep',
+            type=int,
+            default=None,
+            help='number of the latest snapshots to keep, the older ones are deleted'),
+    )
+
+    def handle(self, *args, **options):
+        time = datetime.now() if options['time'] is None else datetime.strptime(options['time'], '%Y-%m-%d_%H:%M:%S')
+        if VariableSnapshot.objects.filter(time__gte=time).exists():
+            raise CommandError('There is already a snapshot taken at {} or later.'.format(time))
+        previous = VariableSnapshot.objects.order_by('-time').first()
+        with transaction.atomic():
+            snapshot = VariableSnapshot.objects.create(time=time)
+            with closing(connection.cursor()) as cursor:
+                if previous is None:
+                    source = '''
+                        SELECT 0 AS source, info_id, key, user_id, item_primary_id, item_secondary_id, value, time
+                        FROM proso_models_audit
+                        WHERE time < %s
+                    '''
+                    params = [time]
+                else:
+                    # the previous snapshot overridden by the audit after it
+                    source = '''
+                        SELECT 0 AS source, info_id, key, user_id, item_primary_id, item_secondary_id, value, NULL AS time
+                        FROM proso_models_variablesnapshotvalue
+                        WHERE snapshot_id = %s
+                        UNION ALL
+                        SELECT 1 AS source, info_id, key, user_id, item_primary_id, item_secondary_id, value, time
+                        FROM proso_models_audit
+                        WHERE time >= %s AND time < %s
+                    '''
+                    params = [previous.id, previous.time, time]
+                cursor.execute(
+                    '''
+                    INSERT INTO proso_models_variablesnapshotvalue
+                        (snapshot_id, info_id, key, user_id, item_primary_id, item_secondary_id, value)
+                    SELECT DISTINCT ON (info_id, key, user_id, item_primary_id, item_secondary_id)
+                        %s, info_id, key, user_id, item_primary_id, item_secondary_id, value
+                    FROM (''' + source + ''') AS source
+                    ORDER BY info_id, key, user_id, item_primary_id, item_secondary_id, source DESC, time DESC
+                    ''', [snapshot.id] + params)
+                self.stdout.write('Snapshot at {} contains {} values.'.format(time, cursor.rowcount))
+        if options['keep'] is not None:
+            to_keep = VariableSnapshot.objects.order_by('-time').values_list('id', flat=True)[:options['keep']]
+            VariableSnapshot.objects.exclude(id__in=list(to_keep)).delete()
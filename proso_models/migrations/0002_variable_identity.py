@@ -0,0 +1,29 @@
+from __future__ import unicode_literals
+from django.db import migrations
+
+
+IDENTITY = 'COALESCE(info_id, -1), key, COALESCE(user_id, -1), COALESCE(item_primary_id, -1), COALESCE(item_secondary_id, -1)'
+
+
+class Migration(migrations.Migration):
+    """
+    The unique constraint on (info, key, user, item_primary, item_secondary)
+    does not apply to NULL columns, so duplicate variables can be created by
+    concurrent writes. The expression index makes the identity unique and
+    serves as a conflict target of the upsert in DatabaseEnvironment.
+    """
+
+    dependencies = [
+        ('proso_models', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'DELETE FROM proso_models_variable WHERE id NOT IN (SELECT MAX(id) FROM proso_models_variable GROUP BY ' + IDENTITY + ')',
+            migrations.RunSQL.noop
+        ),
+        migrations.RunSQL(
+            'CREATE UNIQUE INDEX proso_models_variable_identity ON proso_models_variable (' + IDENTITY + ')',
+            'DROP INDEX proso_models_variable_identity'
+        ),
+    ]
@@ -0,0 +1,48 @@
+from __future__ import unicode_literals
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import proso_models.models
+
+
+def rebuild_answer_aggregates(apps, schema_editor):
+    AnswerAggregate = apps.get_model('proso_models', 'AnswerAggregate')
+    AnswerAggregate.objects.rebuild()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('proso_models', '0002_variable_identity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnswerAggregate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number_of_answers', models.IntegerField(default=0)),
+                ('number_of_correct_answers', models.IntegerField(default=0)),
+                ('number_of_users', models.IntegerField(default=0)),
+                ('first_time', models.DateTimeField()),
+                ('last_time', models.DateTimeField()),
+                ('context', models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to='proso_models.PracticeContext')),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='item_answer_aggregates', to='proso_models.Item')),
+                ('user', models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            managers=[
+                ('objects', proso_models.models.AnswerAggregateManager()),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='answeraggregate',
+            index_together=set([('user', 'item')]),
+        ),
+        migrations.RunSQL(
+            'CREATE UNIQUE INDEX proso_models_answeraggregate_identity ON proso_models_answeraggregate '
+            '(COALESCE(user_id, -1), item_id, COALESCE(context_id, -1))',
+            'DROP INDEX proso_models_answeraggregate_identity'
+        ),
+        migrations.RunPython(rebuild_answer_aggregates, migrations.RunPython.noop),
+    ]
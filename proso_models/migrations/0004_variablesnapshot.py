@@ -0,0 +1,43 @@
+from __future__ import unicode_literals
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('proso_models', '0003_answeraggregate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VariableSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField(unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='VariableSnapshotValue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=50)),
+                ('value', models.FloatField()),
+                ('info', models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to='proso_models.EnvironmentInfo')),
+                ('item_primary', models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='item_primary_snapshot_values', to='proso_models.Item')),
+                ('item_secondary', models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='item_secondary_snapshot_values', to='proso_models.Item')),
+                ('snapshot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='values', to='proso_models.VariableSnapshot')),
+                ('user', models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='variablesnapshotvalue',
+            index_together=set([('snapshot', 'key'), ('snapshot', 'key', 'user'), ('snapshot', 'key', 'item_primary'), ('snapshot', 'key', 'user', 'item_primary')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='audit',
+            index_together=set([('info', 'key', 'user'), ('info', 'key', 'user', 'item_primary'), ('info', 'key', 'user', 'item_primary', 'item_secondary'), ('info', 'key', 'item_primary'), ('info', 'key'), ('key', 'user', 'item_primary', 'time')]),
+        ),
+    ]
@@ -0,0 +1,34 @@
+from __future__ import unicode_literals
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proso_models', '0004_variablesnapshot'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='environmentinfo',
+            name='status',
+            field=models.IntegerField(choices=[(0, 'disabled'), (1, 'loading'), (2, 'enabled'), (3, 'active'), (4, 'shadow')], default=1),
+        ),
+        migrations.CreateModel(
+            name='CalibrationBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.IntegerField()),
+                ('number_of_answers', models.IntegerField(default=0)),
+                ('number_of_correct_answers', models.IntegerField(default=0)),
+                ('sum_of_predictions', models.FloatField(default=0)),
+                ('sum_of_squared_errors', models.FloatField(default=0)),
+                ('info', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='calibration_buckets', to='proso_models.EnvironmentInfo')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='calibrationbucket',
+            unique_together=set([('info', 'bucket')]),
+        ),
+    ]
@@ -1,9 +1,10 @@
 from collections import defaultdict
 from contextlib import closing
 from datetime import datetime, timedelta
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
-from django.db import connection
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, close_old_connections, connection, connections
 from django.db import models
 from django.db import transaction
 from django.db.models import Count, F
@@ -12,14 +13,15 @@ from django.dispatch import receiver
 from functools import reduce
 from itertools import zip_longest
 from proso.django.cache import cache_pure
-from proso.django.cache import get_request_cache, is_cache_prepared, get_from_request_permenent_cache, set_to_request_permanent_cache
+from proso.django.cache import get_request_cache, is_cache_prepared, is_request_active, get_from_request_permenent_cache, set_to_request_permanent_cache
 from proso.django.config import instantiate_from_json
 from proso.django.models import ModelDiffMixin, disable_for_loaddata
-from proso.django.request import load_query_json, get_time
+from proso.django.request import load_query_json, get_time, get_user_id
 from proso.django.response import HttpError
 from proso.func import fixed_point
 from proso.list import flatten
 from proso.metric import binomial_confidence_mean, confidence_value_to_json
+from proso.models.evaluation import calibration_buckets, summarize_calibration
 from proso.models.item_selection import TestWrapperItemSelection
 from proso.time import timeit
 from proso_common.models import Config, instantiate_from_config, instantiate_from_config_list, get_global_config, get_config, add_custom_config_filter, get_events_logger, instantiate_from_config_lazy
@@ -30,16 +32,26 @@ import hashlib
 import importlib
 import json
 import logging
+import os
 import proso.list
 import random
 import re
+import threading
 
 
 ENVIRONMENT_INFO_CACHE_EXPIRATION = 30 * 60
 ENVIRONMENT_INFO_CACHE_KEY = 'proso_models_env_info'
+ENVIRONMENT_CACHE_KEY = 'proso_models_environment'
 ITEM_SELECTOR_CACHE_KEY = 'proso_models_item_selector'
+READ_YOUR_WRITES_CACHE_KEY = 'proso_models_read_your_writes_{}'
+SHADOW_ENVIRONMENT_INFOS_CACHE_KEY = 'proso_models_shadow_env_infos_{}'
+SHADOW_CALIBRATION_BUCKETS = 10
 LOGGER = logging.getLogger('django.request')
 
+_ENVIRONMENT_WRITE_HOOKS_DISPATCHERS = {}
+_ENVIRONMENT_WRITE_HOOKS_DISPATCHERS_LOCK = threading.Lock()
+_SHADOW_PREDICTIVE_MODELS_DISPATCHERS = {}
+
 
 ################################################################################
 # getters
@@ -66,18 +78,101 @@ def get_active_environment_info():
 
 
 def get_environment():
+    """
+    Within a request, the environment is shared by all callers, so the
+    default CachedDatabaseEnvironment reads each value at most once. Outside
+    a request (e.g. in management commands or background threads), a new
+    environment is returned, so it sees writes of other processes.
+    """
+    if is_request_active():
+        cached = get_from_request_permenent_cache(ENVIRONMENT_CACHE_KEY)
+        if cached is not None:
+            return cached
     environment = instantiate_from_config(
         'proso_models', 'environment',
-        default_class='proso_models.environment.DatabaseEnvironment',
+        default_class='proso_models.environment.CachedDatabaseEnvironment',
         pass_parameters=[get_active_environment_info()['id']]
     )
     for hook in get_environment_write_hooks():
         environment.add_write_hook(hook)
+    if is_request_active():
+        set_to_request_permanent_cache(ENVIRONMENT_CACHE_KEY, environment)
     return environment
 
 
 def get_environment_write_hooks():
-    return instantiate_from_config_list('proso_models', 'environment_write_hooks')
+    """
+    Write hooks are called synchronously within each write by default. When
+    'proso_models.environment_write_hooks_dispatcher' is configured (e.g.
+    {"parameters": {"backpressure": "drop"}}), the hooks are wrapped by one
+    process-wide dispatcher delivering their events from a background thread,
+    see proso.models.environment.AsyncWriteHookDispatcher.
+    """
+    dispatcher_config = get_config('proso_models', 'environment_write_hooks_dispatcher')
+    if dispatcher_config is None:
+        return instantiate_from_config_list('proso_models', 'environment_write_hooks')
+    hooks_config = get_config('proso_models', 'environment_write_hooks', default=[])
+    if len(hooks_config) == 0:
+        return []
+    dispatcher_key = json.dumps([hooks_config, dispatcher_config], sort_keys=True)
+    with _ENVIRONMENT_WRITE_HOOKS_DISPATCHERS_LOCK:
+        dispatcher = _ENVIRONMENT_WRITE_HOOKS_DISPATCHERS.get(dispatcher_key)
+        if dispatcher is None:
+            dispatcher = instantiate_from_json(
+                dispatcher_config,
+                default_class='proso.models.environment.AsyncWriteHookDispatcher',
+                pass_parameters=[instantiate_from_config_list('proso_models', 'environment_write_hooks')]
+            )
+            _ENVIRONMENT_WRITE_HOOKS_DISPATCHERS[dispatcher_key] = dispatcher
+    return [dispatcher]
+
+
+def get_confusion_matrix_path():
+    """
+    Path to the precomputed confusion matrix of items (see the
+    build_confusion_matrix command), it is used only if the file exists.
+    """
+    return get_config(
+        'proso_models', 'confusion_matrix.path',
+        default=os.path.join(settings.DATA_DIR, 'confusion_matrix.bin'))
+
+
+def get_read_database(key):
+    """
+    Alias of the database used for read-only queries, e.g., a read replica.
+
+    Args:
+        key (str): configuration key of the alias in the proso_models app,
+            'environment.read_database' or 'analytics_database'
+
+    Returns:
+        str: the configured alias, or the primary database alias when nothing
+        is configured or the current user is pinned to the primary database
+        (see pin_to_primary_database)
+    """
+    alias = get_config('proso_models', key, default=DEFAULT_DB_ALIAS)
+    if alias != DEFAULT_DB_ALIAS and is_pinned_to_primary_database(get_user_id()):
+        return DEFAULT_DB_ALIAS
+    return alias
+
+
+def pin_to_primary_database(user):
+    """
+    Read-your-writes guard: the replica can be behind the primary database,
+    so the reads of the given user go to the primary database for
+    'proso_models.read_your_writes.timeout' seconds. The guard is disabled
+    when the timeout is not configured.
+    """
+    timeout = get_config('proso_models', 'read_your_writes.timeout')
+    if timeout is None or user is None:
+        return
+    cache.set(READ_YOUR_WRITES_CACHE_KEY.format(user), True, int(timeout))
+
+
+def is_pinned_to_primary_database(user):
+    if user is None or get_config('proso_models', 'read_your_writes.timeout') is None:
+        return False
+    return cache.get(READ_YOUR_WRITES_CACHE_KEY.format(user), False)
 
 
 def get_predictive_model(environment_info=None):
@@ -87,6 +182,75 @@ def get_predictive_model(environment_info=None):
     return instantiate_from_json(environment_info['config'])
 
 
+def get_shadow_environment_infos():
+    """
+    Candidate predictive models from 'proso_models.shadow_predictive_models'
+    (e.g. [{"name": "faster", "class": "...", "parameters": {...}}]) predict
+    and update each answer off the request path, see
+    ShadowPredictiveModels. Each candidate has its own environment info in
+    the shadow status, so its variables are isolated from the active model.
+
+    Returns:
+        list: (name, environment info as JSON) pairs of the candidates
+    """
+    candidates = get_config('proso_models', 'shadow_predictive_models', default=[])
+    if len(candidates) == 0:
+        return []
+    cache_key = SHADOW_ENVIRONMENT_INFOS_CACHE_KEY.format(get_content_hash(json.dumps(candidates, sort_keys=True)))
+    cached = cache.get(cache_key)
+    if cached is None:
+        cached = []
+        for candidate in candidates:
+            model_config = {key: value for key, value in candidate.items() if key != 'name'}
+            name = candidate.get('name', model_config['class'].split('.')[-1])
+            info = _get_shadow_environment_info(Config.objects.from_content(model_config))
+            if info is None:
+                LOGGER.warning('Shadow predictive model {} is skipped, it is the active one.'.format(name))
+                continue
+            cached.append((name, info.to_json()))
+        cache.set(cache_key, cached, ENVIRONMENT_INFO_CACHE_EXPIRATION)
+    return cached
+
+
+def _get_shadow_environment_info(config):
+    infos = list(EnvironmentInfo.objects.select_related('config').filter(config=config).order_by('-revision'))
+    for info in infos:
+        if info.status == EnvironmentInfo.STATUS_SHADOW:
+            return info
+        if info.status == EnvironmentInfo.STATUS_ACTIVE:
+            return None
+    try:
+        with transaction.atomic():
+            return EnvironmentInfo.objects.create(
+                config=config, status=EnvironmentInfo.STATUS_SHADOW, revision=infos[0].revision + 1 if infos else 0)
+    except IntegrityError:
+        # the environment info has been just created by another process
+        return EnvironmentInfo.objects.select_related('config').get(config=config, status=EnvironmentInfo.STATUS_SHADOW)
+
+
+def get_shadow_predictive_models_dispatcher():
+    """
+    The answers are passed to the shadow predictive models by one
+    process-wide dispatcher from a background thread. It is configured by
+    'proso_models.shadow_predictive_models_dispatcher', by default the
+    answers are dropped when the queue is full, so slow candidates never slow
+    down the requests.
+    """
+    dispatcher_config = get_config('proso_models', 'shadow_predictive_models_dispatcher', default={})
+    dispatcher_key = json.dumps(dispatcher_config, sort_keys=True)
+    with _ENVIRONMENT_WRITE_HOOKS_DISPATCHERS_LOCK:
+        dispatcher = _SHADOW_PREDICTIVE_MODELS_DISPATCHERS.get(dispatcher_key)
+        if dispatcher is None:
+            dispatcher = instantiate_from_json(
+                dispatcher_config,
+                default_class='proso.models.environment.AsyncWriteHookDispatcher',
+                default_parameters={'backpressure': 'drop'},
+                pass_parameters=[[ShadowPredictiveModels()]]
+            )
+            _SHADOW_PREDICTIVE_MODELS_DISPATCHERS[dispatcher_key] = dispatcher
+    return dispatcher
+
+
 def get_item_selector():
     cached = get_from_request_permenent_cache(ITEM_SELECTOR_CACHE_KEY)
     if cached is None:
@@ -151,7 +315,7 @@ EMPTY_CURVE = {
 def survival_curve_time(length, context=None, users=None, number_of_users=1000):
     if users is not None and len(users) == 0:
         return EMPTY_CURVE
-    with closing(connection.cursor()) as cursor:
+    with closing(connections[get_read_database('analytics_database')].cursor()) as cursor:
         where, where_params = _get_where_for_answers(
             context,
             users if (users is None or len(users) <= number_of_users) else random.sample(users, number_of_users),
@@ -180,7 +344,7 @@ def survival_curve_time(length, context=None, users=None, number_of_users=1000):
 def survival_curve_answers(length, context=None, users=None, number_of_users=1000):
     if users is not None and len(users) == 0:
         return EMPTY_CURVE
-    with closing(connection.cursor()) as cursor:
+    with closing(connections[get_read_database('analytics_database')].cursor()) as cursor:
         where, where_params = _get_where_for_answers(
             context,
             users if (users is None or len(users) <= number_of_users) else random.sample(users, number_of_users),
@@ -206,14 +370,14 @@ def survival_curve_answers(length, context=None, users=None, number_of_users=100
 
 
 def learning_curve(length, context=None, users=None, number_of_users=1000):
-    with closing(connection.cursor()) as cursor:
+    with closing(connections[get_read_database('analytics_database')].cursor()) as cursor:
         cursor.execute("SELECT id FROM proso_models_answermeta WHERE content LIKE '%%random_without_options%%'")
         meta_ids = [str(x[0]) for x in cursor.fetchall()]
     if len(meta_ids) == 0:
         return EMPTY_CURVE
     if users is not None and len(users) == 0:
         return EMPTY_CURVE
-    with closing(connection.cursor()) as cursor:
+    with closing(connections[get_read_database('analytics_database')].cursor()) as cursor:
         where, where_params = _get_where_for_answers(
             context,
             users if (users is None or len(users) <= number_of_users) else random.sample(users, number_of_users),
@@ -297,7 +461,7 @@ def recommend_users(register_time_interval, number_of_answers_interval, success_
             '''.format(variable_name)
     else:
         variable_join = ''
-    with closing(connection.cursor()) as cursor:
+    with closing(connections[get_read_database('analytics_database')].cursor()) as cursor:
         cursor.execute(
             '''
             SELECT
@@ -524,12 +688,14 @@ class EnvironmentInfo(models.Model):
     STATUS_LOADING = 1
     STATUS_ENABLED = 2
     STATUS_ACTIVE = 3
+    STATUS_SHADOW = 4
 
     STATUS = (
         (STATUS_DISABLED, 'disabled'),
         (STATUS_LOADING, 'loading'),
         (STATUS_ENABLED, 'enabled'),
         (STATUS_ACTIVE, 'active'),
+        (STATUS_SHADOW, 'shadow'),
     )
 
     status = models.IntegerField(choices=STATUS, default=1)
@@ -1449,10 +1615,238 @@ class Audit(models.Model):
             ['info', 'key', 'user'],
             ['info', 'key', 'item_primary'],
             ['info', 'key', 'user', 'item_primary'],
-            ['info', 'key', 'user', 'item_primary', 'item_secondary']
+            ['info', 'key', 'user', 'item_primary', 'item_secondary'],
+            ['key', 'user', 'item_primary', 'time'],
         ]
 
 
+class VariableSnapshot(models.Model):
+    """
+    The latest audited values of all variables before the given time, see
+    the snapshot_variables command. Shifted environments read the nearest
+    previous snapshot and only the audit after it.
+    """
+
+    time = models.DateTimeField(unique=True)
+
+    class Meta:
+        app_label = 'proso_models'
+
+
+class VariableSnapshotValue(models.Model):
+
+    snapshot = models.ForeignKey(VariableSnapshot, related_name='values')
+    info = models.ForeignKey(EnvironmentInfo, null=True, blank=True, default=None)
+    user = models.ForeignKey(User, null=True, blank=True, default=None)
+    item_primary = models.ForeignKey(
+        Item,
+        null=True,
+        blank=True,
+        default=None,
+        related_name='item_primary_snapshot_values')
+    item_secondary = models.ForeignKey(
+        Item,
+        null=True,
+        blank=True,
+        default=None,
+        related_name='item_secondary_snapshot_values')
+    key = models.CharField(max_length=50)
+    value = models.FloatField()
+
+    class Meta:
+        app_label = 'proso_models'
+        index_together = [
+            ['snapshot', 'key'],
+            ['snapshot', 'key', 'user'],
+            ['snapshot', 'key', 'item_primary'],
+            ['snapshot', 'key', 'user', 'item_primary'],
+        ]
+
+
+class AnswerAggregateManager(models.Manager):
+
+    use_in_migrations = True
+
+    def add_answer(self, answer):
+        """
+        Include the given (just saved) answer to the aggregates of its user,
+        item and context and to the aggregates of its item.
+        """
+        with transaction.atomic():
+            with closing(connection.cursor()) as cursor:
+                # The row of the item is locked until the end of the transaction,
+                # so concurrent first answers of the same user are counted once.
+                cursor.execute(
+                    '''
+                    INSERT INTO proso_models_answeraggregate
+                        (user_id, item_id, context_id, number_of_answers, number_of_correct_answers, number_of_users, first_time, last_time)
+                    VALUES (NULL, %s, NULL, 0, 0, 0, %s, %s)
+                    ON CONFLICT (COALESCE(user_id, -1), item_id, COALESCE(context_id, -1)) DO NOTHING
+                    ''', [answer.item_id, answer.time, answer.time])
+                cursor.execute(
+                    'SELECT id FROM proso_models_answeraggregate WHERE user_id IS NULL AND item_id = %s AND context_id IS NULL FOR UPDATE',
+                    [answer.item_id])
+                cursor.execute(
+                    'SELECT COUNT(1) FROM proso_models_answeraggregate WHERE user_id = %s AND item_id = %s',
+                    [answer.user_id, answer.item_id])
+                first = cursor.fetchone()[0] == 0
+                correct = 1 if answer.item_asked_id == answer.item_answered_id else 0
+                cursor.execute(
+                    '''
+                    INSERT INTO proso_models_answeraggregate
+                        (user_id, item_id, context_id, number_of_answers, number_of_correct_answers, number_of_users, first_time, last_time)
+                    VALUES
+                        (%s, %s, %s, 1, %s, 1, %s, %s),
+                        (NULL, %s, NULL, 1, %s, %s, %s, %s)
+                    ON CONFLICT (COALESCE(user_id, -1), item_id, COALESCE(context_id, -1))
+                    DO UPDATE SET
+                        number_of_answers = proso_models_answeraggregate.number_of_answers + 1,
+                        number_of_correct_answers = proso_models_answeraggregate.number_of_correct_answers + EXCLUDED.number_of_correct_answers,
+                        number_of_users = CASE
+                            WHEN proso_models_answeraggregate.user_id IS NULL THEN proso_models_answeraggregate.number_of_users + EXCLUDED.number_of_users
+                            ELSE proso_models_answeraggregate.number_of_users END,
+                        first_time = CASE
+                            WHEN EXCLUDED.first_time < proso_models_answeraggregate.first_time THEN EXCLUDED.first_time
+                            ELSE proso_models_answeraggregate.first_time END,
+                        last_time = CASE
+                            WHEN EXCLUDED.last_time > proso_models_answeraggregate.last_time THEN EXCLUDED.last_time
+                            ELSE proso_models_answeraggregate.last_time END
+                    ''', [
+                        answer.user_id, answer.item_id, answer.context_id, correct, answer.time, answer.time,
+                        answer.item_id, correct, 1 if first else 0, answer.time, answer.time,
+                    ])
+
+    def rebuild(self):
+        """
+        Compute all aggregates from scratch. Answers saved during the rebuild
+        may be missed, so the rebuild should not run in parallel with the
+        practice.
+        """
+        with transaction.atomic():
+            with closing(connection.cursor()) as cursor:
+                cursor.execute('DELETE FROM proso_models_answeraggregate')
+                cursor.execute(
+                    '''
+                    INSERT INTO proso_models_answeraggregate
+                        (user_id, item_id, context_id, number_of_answers, number_of_correct_answers, number_of_users, first_time, last_time)
+                    SELECT
+                        user_id, item_id, context_id, COUNT(1),
+                        SUM(CASE WHEN item_asked_id = item_answered_id THEN 1 ELSE 0 END),
+                        1, MIN(time), MAX(time)
+                    FROM proso_models_answer
+                    GROUP BY user_id, item_id, context_id
+                    ''')
+                cursor.execute(
+                    '''
+                    INSERT INTO proso_models_answeraggregate
+                        (user_id, item_id, context_id, number_of_answers, number_of_correct_answers, number_of_users, first_time, last_time)
+                    SELECT
+                        NULL, item_id, NULL, COUNT(1),
+                        SUM(CASE WHEN item_asked_id = item_answered_id THEN 1 ELSE 0 END),
+                        COUNT(DISTINCT user_id), MIN(time), MAX(time)
+                    FROM proso_models_answer
+                    GROUP BY item_id
+                    ''')
+
+
+class AnswerAggregate(models.Model):
+    """
+    Incrementally maintained aggregates of answers. There is one row for
+    each (user, item, context) and one row with NULL user and context for
+    each item, where number_of_users is the number of users answering the
+    item.
+    """
+
+    user = models.ForeignKey(User, null=True, blank=True, default=None)
+    item = models.ForeignKey(Item, related_name='item_answer_aggregates')
+    context = models.ForeignKey(PracticeContext, null=True, blank=True, default=None)
+    number_of_answers = models.IntegerField(default=0)
+    number_of_correct_answers = models.IntegerField(default=0)
+    number_of_users = models.IntegerField(default=0)
+    first_time = models.DateTimeField()
+    last_time = models.DateTimeField()
+
+    objects = AnswerAggregateManager()
+
+    class Meta:
+        app_label = 'proso_models'
+        index_together = [
+            ['user', 'item'],
+        ]
+
+
+class CalibrationBucketManager(models.Manager):
+
+    def add(self, info_id, aggregates):
+        """
+        Include the given aggregates of evaluated answers (see
+        proso.models.evaluation.calibration_buckets) to the buckets of the
+        given environment info.
+        """
+        if len(aggregates) == 0:
+            return
+        values = []
+        params = []
+        for bucket, (count, correct, prediction_sum, error_sum) in sorted(aggregates.items()):
+            values.append('(%s, %s, %s, %s, %s, %s)')
+            params += [info_id, bucket, count, correct, prediction_sum, error_sum]
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(
+                '''
+                INSERT INTO proso_models_calibrationbucket
+                    (info_id, bucket, number_of_answers, number_of_correct_answers, sum_of_predictions, sum_of_squared_errors)
+                VALUES
+                ''' + ', '.join(values) + '''
+                ON CONFLICT (info_id, bucket)
+                DO UPDATE SET
+                    number_of_answers = proso_models_calibrationbucket.number_of_answers + EXCLUDED.number_of_answers,
+                    number_of_correct_answers = proso_models_calibrationbucket.number_of_correct_answers + EXCLUDED.number_of_correct_answers,
+                    sum_of_predictions = proso_models_calibrationbucket.sum_of_predictions + EXCLUDED.sum_of_predictions,
+                    sum_of_squared_errors = proso_models_calibrationbucket.sum_of_squared_errors + EXCLUDED.sum_of_squared_errors
+                ''', params)
+
+    def summarize(self, info_ids):
+        """
+        Returns:
+            dict: environment info id -> brier score, its decomposition and
+            calibration of the predictions (see
+            proso.models.evaluation.summarize_calibration)
+        """
+        aggregates = {info_id: {} for info_id in info_ids}
+        for bucket in self.filter(info_id__in=info_ids):
+            aggregates[bucket.info_id][bucket.bucket] = (
+                bucket.number_of_answers,
+                bucket.number_of_correct_answers,
+                bucket.sum_of_predictions,
+                bucket.sum_of_squared_errors,
+            )
+        return {
+            info_id: summarize_calibration(info_aggregates, buckets=SHADOW_CALIBRATION_BUCKETS)
+            for info_id, info_aggregates in aggregates.items()
+        }
+
+
+class CalibrationBucket(models.Model):
+    """
+    Online evaluation of the predictions made by the model of the
+    environment info: the answers are aggregated in equally wide buckets by
+    the predicted probability.
+    """
+
+    info = models.ForeignKey(EnvironmentInfo, related_name='calibration_buckets')
+    bucket = models.IntegerField()
+    number_of_answers = models.IntegerField(default=0)
+    number_of_correct_answers = models.IntegerField(default=0)
+    sum_of_predictions = models.FloatField(default=0)
+    sum_of_squared_errors = models.FloatField(default=0)
+
+    objects = CalibrationBucketManager()
+
+    class Meta:
+        app_label = 'proso_models'
+        unique_together = ('info', 'bucket')
+
+
 def get_content_hash(content):
     return hashlib.sha1(content.encode()).hexdigest()
 
@@ -1484,6 +1878,56 @@ def custom_filter_for_filters(identifier_filter):
     return _custom_filter_for_filters
 
 
+class ShadowPredictiveModels:
+    """
+    Consumer of the answers passed by the dispatcher (see
+    get_shadow_predictive_models_dispatcher). Each shadow predictive model
+    predicts and updates the answers in its own environment and its
+    predictions are evaluated together with the predictions of the active
+    model, see CalibrationBucket.
+    """
+
+    def events(self, batch):
+        """
+        Args:
+            batch (list): (answer, environment info id, prediction) tuples,
+                where the answer is a dictionary with keyword arguments of
+                predict_and_update and the prediction was made by the model
+                of the (active) environment info
+        """
+        close_old_connections()
+        answers = [answer for answer, _, _ in batch]
+        correct = [answer['correct'] for answer in answers]
+        for info_id in sorted({info_id for _, info_id, _ in batch}):
+            CalibrationBucket.objects.add(info_id, calibration_buckets(
+                [prediction for _, i, prediction in batch if i == info_id],
+                [answer['correct'] for answer, i, _ in batch if i == info_id],
+                buckets=SHADOW_CALIBRATION_BUCKETS))
+        for name, info in get_shadow_environment_infos():
+            try:
+                with transaction.atomic():
+                    predictions = self.predict_and_update(info, answers)
+                    CalibrationBucket.objects.add(info['id'], calibration_buckets(predictions, correct, buckets=SHADOW_CALIBRATION_BUCKETS))
+            except Exception:
+                LOGGER.exception('Shadow predictive model {} failed to process {} answers.'.format(name, len(answers)))
+
+    def predict_and_update(self, info, answers):
+        environment = instantiate_from_config(
+            'proso_models', 'environment',
+            default_class='proso_models.environment.CachedDatabaseEnvironment',
+            pass_parameters=[info['id']]
+        )
+        predictive_model = get_predictive_model(info)
+        predictions = []
+        # the same as the active model, see update_predictive_model
+        environment.avoid_audit(True)
+        for answer in answers:
+            environment.shift_answers(answer['answer_id'])
+            with environment.buffered_writes():
+                predictions.append(predictive_model.predict_and_update(environment, **answer))
+        return predictions
+
+
 ################################################################################
 # Signals
 ################################################################################
@@ -1565,21 +2009,68 @@ def update_predictive_model(sender, instance, **kwargs):
         return
     environment = get_environment()
     # We want to make the prediction before the answer is saved,
-    # but we need answer id to track it.
-    environment.shift_answers(instance.pk)
-    environment.avoid_audit(True)
-    predictive_model = get_predictive_model()
-    predictive_model.predict_and_update(
-        environment,
+    # but we need answer id to track it. The environment is shared by the
+    # rest of the request, so its previous shift is restored.
+    with environment.shifted_before_answer(instance.pk):
+        predictive_model = get_predictive_model()
+        # all variables of the answer are saved at once
+        with environment.buffered_writes():
+            prediction = predictive_model.predict_and_update(
+                environment,
+                instance.user_id,
+                instance.item_id,
+                instance.item_asked_id == instance.item_answered_id,
+                instance.time,
+                instance.pk,
+                item_answered=instance.item_answered_id,
+                item_asked=instance.item_asked_id,
+                response_time=instance.response_time,
+            )
+    # the shared ring must not contain answers of rolled back transactions
+    transaction.on_commit(lambda: environment.update_rolling_success(
         instance.user_id,
-        instance.item_id,
         instance.item_asked_id == instance.item_answered_id,
-        instance.time,
-        instance.pk,
-        item_answered=instance.item_answered_id,
-        item_asked=instance.item_asked_id,
-        response_time=instance.response_time,
-    )
+        answer=instance.pk,
+        context=instance.context_id,
+    ))
+    shadow_answer(instance, prediction)
+
+
+def shadow_answer(answer, prediction):
+    """
+    Pass the given answer and the prediction of the active model to the
+    shadow predictive models, when the transaction is committed.
+    """
+    if len(get_config('proso_models', 'shadow_predictive_models', default=[])) == 0:
+        return
+    event = ({
+        'user': answer.user_id,
+        'item': answer.item_id,
+        'correct': answer.item_asked_id == answer.item_answered_id,
+        'time': answer.time,
+        'answer_id': answer.pk,
+        'item_answered': answer.item_answered_id,
+        'item_asked': answer.item_asked_id,
+        'response_time': answer.response_time,
+    }, get_active_environment_info()['id'], prediction)
+    dispatcher = get_shadow_predictive_models_dispatcher()
+    transaction.on_commit(lambda: dispatcher.events([event]))
+
+
+@receiver(post_save)
+@disable_for_loaddata
+def pin_answering_user_to_primary_database(sender, instance, **kwargs):
+    if not issubclass(sender, Answer) or not kwargs['created']:
+        return
+    pin_to_primary_database(instance.user_id)
+
+
+@receiver(post_save)
+@disable_for_loaddata
+def update_answer_aggregates(sender, instance, **kwargs):
+    if not issubclass(sender, Answer) or not kwargs['created']:
+        return
+    AnswerAggregate.objects.add_answer(instance)
 
 
 @receiver(post_save, sender=Variable)
@@ -1,5 +1,11 @@
-from .models import Item, ItemRelation, get_environment
+from .models import Answer, CalibrationBucket, EnvironmentInfo, Item, ItemRelation, ShadowPredictiveModels, Variable, \
+    get_active_environment_info, get_environment, get_shadow_environment_infos
+from datetime import datetime
+from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.management import call_command
+from mock import patch
+from proso_common.models import get_config
 from proso_flashcards.models import Flashcard, Category
 from testproject.testapp.models import ExtendedContext, ExtendedTerm
 import django.test as test
@@ -235,3 +241,59 @@ class TestItemManager(test.TestCase):
             Item.objects.translate_identifiers(['flashcard/africa-bw', 'category/world'], 'cs'),
             {'category/world': 2, 'flashcard/africa-bw': 188}
         )
+
+
+SHADOW_PREDICTIVE_MODELS = [{
+    'name': 'candidate',
+    'class': 'proso.models.prediction.PFAEStaircase',
+}]
+
+
+def _get_config_with_shadow(app_name, key, **kwargs):
+    if app_name == 'proso_models' and key == 'shadow_predictive_models':
+        return SHADOW_PREDICTIVE_MODELS
+    return get_config(app_name, key, **kwargs)
+
+
+class ShadowPredictiveModelsTest(test.TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self._user = User.objects.create(username='shadow').id
+        self._items = [Item.objects.create().id for i in range(3)]
+
+    @patch('proso_models.models.get_config', side_effect=_get_config_with_shadow)
+    def test_shadow_predictive_models(self, get_config_mock):
+        active = get_active_environment_info()
+        batch = []
+        for i, item in enumerate(self._items * 2):
+            answer = Answer.objects.create(
+                user_id=self._user, item_id=item, item_asked_id=item, item_answered_id=item if i % 2 else None,
+                response_time=1000, time=datetime.now(), type='test')
+            batch.append(({
+                'user': self._user,
+                'item': item,
+                'correct': answer.item_asked_id == answer.item_answered_id,
+                'time': answer.time,
+                'answer_id': answer.id,
+                'item_answered': answer.item_answered_id,
+                'item_asked': answer.item_asked_id,
+                'response_time': answer.response_time,
+            }, active['id'], 0.5))
+        active_variables = Variable.objects.filter(info_id=active['id']).count()
+        ShadowPredictiveModels().events(batch)
+        shadows = get_shadow_environment_infos()
+        self.assertEqual(['candidate'], [name for name, _ in shadows])
+        shadow = shadows[0][1]
+        self.assertEqual(EnvironmentInfo.STATUS_SHADOW, EnvironmentInfo.objects.get(id=shadow['id']).status)
+        self.assertNotEqual(active['id'], shadow['id'])
+        self.assertEqual(active_variables, Variable.objects.filter(info_id=active['id']).count())
+        self.assertTrue(Variable.objects.filter(info_id=shadow['id'], user_id=self._user).exists())
+        stats = CalibrationBucket.objects.summarize([active['id'], shadow['id']])
+        self.assertEqual(6, stats[active['id']]['number_of_answers'])
+        self.assertAlmostEqual(0.25, stats[active['id']]['brier'])
+        self.assertEqual(6, stats[shadow['id']]['number_of_answers'])
+        ShadowPredictiveModels().events(batch[:2])
+        stats = CalibrationBucket.objects.summarize([active['id'], shadow['id']])
+        self.assertEqual(8, stats[active['id']]['number_of_answers'])
+        self.assertEqual(8, stats[shadow['id']]['number_of_answers'])
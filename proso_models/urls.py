@@ -18,6 +18,7 @@ urlpatterns = patterns(
     url(r'^practice/', 'practice', name='models_practice'),
     url(r'^read/(?P<key>[\w_]+)', 'read', name='models_read'),
     url(r'^recommend_users/', 'recommend_users', name='models_recommend_user'),
+    url(r'^shadow_stats/', 'shadow_stats', name='models_shadow_stats'),
     url(r'^status/', 'status', name='models_status'),
     url(r'^to_practice/', 'to_practice', name='models_to_practice'),
     url(r'^to_practice_counts/', 'to_practice_counts', name='models_to_practice_counts'),
@@ -1,7 +1,8 @@
 from .models import get_environment, get_predictive_model, get_item_selector, get_active_environment_info, \
     Answer, Item, recommend_users as models_recommend_users, PracticeContext, PracticeSet,\
     learning_curve as models_learning_curve, get_filter, get_mastery_trashold, get_time_for_knowledge_overview, \
-    survival_curve_answers as models_survival_curve_answers, survival_curve_time as models_survival_curve_time
+    survival_curve_answers as models_survival_curve_answers, survival_curve_time as models_survival_curve_time, \
+    get_shadow_environment_infos, get_shadow_predictive_models_dispatcher, CalibrationBucket
 from django.contrib.admin.views.decorators import staff_member_required
 from django.db import transaction
 from django.http import HttpResponse, HttpResponseBadRequest
@@ -448,6 +449,29 @@ def recommend_users(request):
     return render_json(request, recommended, template='models_json.html', help_text=recommend_users.__doc__)
 
 
+@staff_member_required
+def shadow_stats(request):
+    '''
+    Online evaluation of the active predictive model and the shadow
+    predictive models ('proso_models.shadow_predictive_models') on the same
+    answers: brier score, its decomposition and calibration of predictions.
+    Only the answers saved since the shadow predictive models are configured
+    are evaluated. The number of dropped answers is reported for the current
+    process only.
+    '''
+    active = get_active_environment_info()
+    candidates = [(active['config']['class'].split('.')[-1], active)] + get_shadow_environment_infos()
+    stats = CalibrationBucket.objects.summarize([info['id'] for _, info in candidates])
+    return render_json(request, {
+        'object_type': 'shadow_stats',
+        'dropped': getattr(get_shadow_predictive_models_dispatcher(), 'dropped', None),
+        'models': [
+            dict(stats[info['id']], name=name, active=info['id'] == active['id'], environment_info=info)
+            for name, info in candidates
+        ],
+    }, template='models_json.html', help_text=shadow_stats.__doc__)
+
+
 @allow_lazy_user
 def audit(request, key):
     if 'user' in request.GET:
@@ -80,6 +80,11 @@ if TESTING:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': os.path.join(BASE_DIR, 'testproject.sqlite3')
+        },
+        # not replicated, tests of read-only queries use it as a lagging replica
+        'replica': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'testproject_replica.sqlite3')
         }
     }
 else: